@@ -68,6 +68,7 @@ setup(name='user-sync',
               'winkerberos',
               'pywin32'
           ],
+          'asyncio': ['aiohttp'],
           'test': test_deps,
           'setup': setup_deps,
       },
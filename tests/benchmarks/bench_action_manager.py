@@ -0,0 +1,41 @@
+"""
+Measure the cost of queueing and sending actions through an ActionManager, for growing numbers of actions.
+The per-action cost should stay flat as the number of actions grows.
+
+    PYTHONPATH=. python tests/benchmarks/bench_action_manager.py [counts...]
+"""
+import logging
+import sys
+import time
+
+from user_sync.connector.umapi import ActionManager, Commands
+
+
+class FakeConnection(object):
+    # a mock would keep every call, and so every action, which is exactly what we're measuring
+    @staticmethod
+    def execute_multiple(actions, immediate=True):
+        return 0, len(actions), len(actions)
+
+
+def run(count):
+    action_manager = ActionManager(FakeConnection(), 'org_id', logging.getLogger('bench'), batch_size=10,
+                                   max_queued_actions=10000)
+    start = time.perf_counter()
+    for i in range(count):
+        username = 'user%d@example.com' % i
+        commands = Commands(identity_type='federatedID', email=username, username=username, domain='example.com')
+        commands.add_groups({'group1'})
+        action_manager.add_action(action_manager.create_action(commands))
+    action_manager.flush()
+    return time.perf_counter() - start
+
+
+def main(counts):
+    for count in counts:
+        seconds = run(count)
+        print('%8d actions: %8.2f s  %8.2f us/action' % (count, seconds, seconds * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [1000, 10000, 100000, 500000])
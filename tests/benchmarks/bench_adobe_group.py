@@ -0,0 +1,37 @@
+"""
+Measure the AdobeGroup operations done per user and per group with many mapped groups: creating the groups,
+building the adobe_group_filter set, testing membership in it, and looking up groups by qualified name.
+
+    PYTHONPATH=. python tests/benchmarks/bench_adobe_group.py [counts...]
+"""
+import sys
+import time
+
+from user_sync.rules import AdobeGroup
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def run(count):
+    AdobeGroup.clear()
+    names = ['Group %d' % i if i % 4 else 'org%d::Group %d' % (i % 3, i) for i in range(count)]
+    results = [('create', timed(lambda: [AdobeGroup.create(name) for name in names]))]
+    group_filter = set()
+    results.append(('filter set', timed(lambda: group_filter.update(AdobeGroup.iter_groups()))))
+    probes = [AdobeGroup.create(name, index=False) for name in names[::10]]
+    results.append(('membership', timed(lambda: [probe in group_filter for probe in probes])))
+    results.append(('lookup', timed(lambda: [AdobeGroup.lookup(name) for name in names])))
+    return results
+
+
+def main(counts):
+    for count in counts:
+        print('%6d groups: %s' % (count, ', '.join('%s %.4f s' % result for result in run(count))))
+
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [1000, 10000])
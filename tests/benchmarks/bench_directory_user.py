@@ -0,0 +1,113 @@
+"""
+Compare the memory held by directory users built as dicts (as connectors used to build them, with a copy of
+their source attributes) with the memory held by DirectoryUser records.  Attribute values are built
+separately for each user, as they are when parsed from an LDAP or CSV source.  Also compare the CPU time
+to build the users and to run them through the rules (read_desired_user_groups), best of a few runs.
+
+    PYTHONPATH=. python tests/benchmarks/bench_directory_user.py [counts...]
+"""
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+from user_sync.connector.helper import create_blank_user
+from user_sync.rules import AdobeGroup, RuleProcessor
+
+EXTENDED_ATTRIBUTES = ['department', 'title', 'employeeNumber']
+
+
+def make_user(i, user):
+    email = 'user%d@%s' % (i, 'example.com')
+    values = {
+        'email': email,
+        'identity_type': ''.join(['federated', 'ID']),
+        'username': email,
+        'domain': ''.join(['example', '.com']),
+        'givenName': 'First%d' % i,
+        'sn': 'Last%d' % i,
+        'c': ''.join(['U', 'S']),
+        'department': 'Department %d' % (i % 50),
+        'title': 'Title %d' % (i % 20),
+        'employeeNumber': str(i),
+    }
+    user['email'] = email
+    user['identity_type'] = values['identity_type']
+    user['username'] = email
+    user['domain'] = values['domain']
+    user['firstname'] = values['givenName']
+    user['lastname'] = values['sn']
+    user['country'] = values['c']
+    user['groups'].append('Group %d' % (i % 10))
+    return values
+
+
+def make_dict_user(i):
+    user = {'identity_type': None, 'username': None, 'domain': None, 'firstname': None, 'lastname': None,
+            'email': None, 'groups': [], 'country': None}
+    source_attributes = make_user(i, user)
+    user['source_attributes'] = source_attributes.copy()
+    return user
+
+
+def make_directory_user(i):
+    user = create_blank_user()
+    user['source_attributes'] = make_user(i, user)
+    return user
+
+
+def measure(make, count):
+    tracemalloc.start()
+    users = [make(i) for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del users
+    return size
+
+
+def best_time(make_users, function, runs=5):
+    """
+    :return: the shortest time function took on a list of new users, over a few runs
+    """
+    best = None
+    for _ in range(runs):
+        users = make_users()
+        start = time.perf_counter()
+        function(users)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_rules(users):
+    AdobeGroup.clear()
+    mappings = {'Group %d' % i: [AdobeGroup.create('Adobe Group %d' % i)] for i in range(10)}
+    rule_processor = RuleProcessor({})
+    rule_processor.prepare_umapi_infos()
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = users
+    rule_processor.read_desired_user_groups(mappings, directory_connector)
+
+
+def time_users(make, count):
+    build = best_time(lambda: range(count), lambda numbers: [make(i) for i in numbers])
+    rules = best_time(lambda: [make(i) for i in range(count)], run_rules)
+    return build, rules
+
+
+def main(counts):
+    for count in counts:
+        dict_size = measure(make_dict_user, count)
+        record_size = measure(make_directory_user, count)
+        print('%8d users: dict %6d bytes/user, DirectoryUser %6d bytes/user (%.0f%%)' %
+              (count, dict_size // count, record_size // count, 100.0 * record_size / dict_size))
+        dict_build, dict_rules = time_users(make_dict_user, count)
+        record_build, record_rules = time_users(make_directory_user, count)
+        print('%8d users: build dict %.2f us/user, DirectoryUser %.2f us/user; '
+              'rules dict %.2f us/user, DirectoryUser %.2f us/user' %
+              (count, dict_build * 1e6 / count, record_build * 1e6 / count,
+               dict_rules * 1e6 / count, record_rules * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,53 @@
+"""
+Measure the functions that normalize group names, emails and usernames for every user, with the group names
+and user keys repeating as they do in a run (each user is keyed once on each side, and there are a few
+hundred distinct groups).  Each is measured with plain strip().lower() normalization (before) and with
+the normalize_shared_string cache (after).
+
+    PYTHONPATH=. python tests/benchmarks/bench_normalize.py [user count]
+"""
+import sys
+import time
+from unittest import mock
+
+import user_sync.helper
+import user_sync.rules
+from user_sync.rules import RuleProcessor
+
+
+def plain_normalize_string(string_value):
+    return string_value.strip().lower() if string_value is not None else None
+
+
+def best_time(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        user_sync.helper._normalized_strings.clear()
+        user_sync.helper._previous_normalized_strings.clear()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def compare(name, function, count):
+    with mock.patch.object(user_sync.rules, 'normalize_shared_string', plain_normalize_string):
+        before = best_time(function)
+    after = best_time(function)
+    print('%18s: before %6.3f us/user, after %6.3f us/user' % (name, before * 1e6 / count, after * 1e6 / count))
+
+
+def main(count):
+    groups = ['Group Number %d' % i for i in range(300)]
+    user_groups = [[groups[(i + j * 37) % len(groups)] for j in range(8)] for i in range(count)]
+    emails = ['User%d@Example.com' % i for i in range(count)]
+    rule_processor = RuleProcessor({})
+
+    compare('normalize_groups', lambda: [rule_processor.normalize_groups(user) for user in user_groups], count)
+    compare('get_user_key (x2)', lambda: [rule_processor.get_user_key('federatedID', email, 'example.com', email)
+                                          for _ in range(2) for email in emails], count)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,59 @@
+"""
+Compare the memory held by the user keys of a run, for a directory map and a umapi map over the same users:
+"id_type,username,domain" strings built separately for each side (as get_user_key used to build them) against
+UserKeys shared through the RuleProcessor's UserKeyRegistry.  The parts of each key are built separately for
+each side, as they are when read from the directory and from UMAPI.  Also time reading the parts of a key
+back, which the string keys did by splitting.
+
+    PYTHONPATH=. python tests/benchmarks/bench_user_keys.py [counts...]
+"""
+import sys
+import timeit
+import tracemalloc
+
+from user_sync.rules import RuleProcessor
+
+
+def make_parts(i):
+    return 'federatedID', 'user%d@example.com' % i, ''.join(['example', '.com'])
+
+
+def separate_keys(count):
+    directory_map = {u','.join(make_parts(i)): i for i in range(count)}
+    umapi_map = {u','.join(make_parts(i)): i for i in range(count)}
+    return directory_map, umapi_map
+
+
+def registry_keys(count):
+    rule_processor = RuleProcessor({})
+    directory_map = {rule_processor.get_user_key(*make_parts(i)): i for i in range(count)}
+    umapi_map = {rule_processor.get_user_key(*make_parts(i)): i for i in range(count)}
+    return rule_processor.user_keys, directory_map, umapi_map
+
+
+def measure(make, count):
+    tracemalloc.start()
+    held = make(count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return size
+
+
+def main(counts):
+    for count in counts:
+        separate_size = measure(separate_keys, count)
+        registry_size = measure(registry_keys, count)
+        print('%8d users: separate keys %4d bytes/user, UserKeyRegistry %4d bytes/user (%.0f%%)' %
+              (count, separate_size // count, registry_size // count, 100.0 * registry_size / separate_size))
+    string_key = u','.join(make_parts(0))
+    rule_processor = RuleProcessor({})
+    user_key = rule_processor.get_user_key(*make_parts(0))
+    runs = 1000000
+    split_time = min(timeit.repeat(lambda: tuple(string_key.split(',')), number=runs, repeat=5))
+    parse_time = min(timeit.repeat(lambda: rule_processor.parse_user_key(user_key), number=runs, repeat=5))
+    print('parse a key: split string %.0f ns, UserKey %.0f ns' % (split_time * 1e9 / runs, parse_time * 1e9 / runs))
+
+
+if __name__ == '__main__':
+    main([int(c) for c in sys.argv[1:]] or [10000, 100000])
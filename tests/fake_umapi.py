@@ -0,0 +1,147 @@
+"""
+A local stand-in for the UMAPI service, for testing the UMAPI connector without a network.
+It serves the users, groups and action endpoints for one organization from memory.
+"""
+import asyncio
+import threading
+
+from aiohttp import web
+
+
+class FakeUmapi(object):
+    def __init__(self, org_id, users=None, groups=None, page_size=3):
+        """
+        :param users: list of user dicts (with email, username, domain, type and groups)
+        :param groups: list of group names
+        """
+        self.org_id = org_id
+        self.users = {u['email'].lower(): u for u in users or []}
+        self.groups = list(groups or [])
+        self.page_size = page_size
+        # responses to give (as status, headers) before handling the next requests normally
+        self.throttled_responses = []
+        self.requests = []
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.url = None
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get('/v2/usermanagement/users/{org_id}/{page}', self.get_users)
+        app.router.add_get('/v2/usermanagement/users/{org_id}/{page}/{group}', self.get_users)
+        app.router.add_get('/v2/usermanagement/groups/{org_id}/{page}', self.get_groups)
+        app.router.add_post('/v2/usermanagement/action/{org_id}', self.post_action)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        port = self.runner.addresses[0][1]
+        self.url = 'http://127.0.0.1:%d/v2/usermanagement' % port
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def check_request(self, request):
+        self.requests.append((request.method, request.path))
+        if request.match_info['org_id'] != self.org_id:
+            raise web.HTTPNotFound()
+        if self.throttled_responses:
+            status, headers = self.throttled_responses.pop(0)
+            return web.Response(status=status, headers=headers)
+
+    def page_response(self, object_type, values, page):
+        start = page * self.page_size
+        page_values = values[start:start + self.page_size]
+        page_count = (len(values) + self.page_size - 1) // self.page_size
+        headers = {
+            'X-Total-Count': str(len(values)),
+            'X-Page-Count': str(page_count),
+            'X-Current-Page': str(page + 1),
+            'X-Page-Size': str(self.page_size),
+        }
+        body = {'result': 'success', 'lastPage': start + self.page_size >= len(values), object_type: page_values}
+        return web.json_response(body, headers=headers)
+
+    async def get_users(self, request):
+        throttled = self.check_request(request)
+        if throttled is not None:
+            return throttled
+        group = request.match_info.get('group')
+        users = [dict(u) for u in self.users.values()
+                 if group is None or group.lower() in (g.lower() for g in u.get('groups', []))]
+        return self.page_response('users', users, int(request.match_info['page']))
+
+    async def get_groups(self, request):
+        throttled = self.check_request(request)
+        if throttled is not None:
+            return throttled
+        groups = [{'groupName': g, 'type': 'SYSADMIN_GROUP' if g.startswith('_') else 'USER_GROUP',
+                   'memberCount': sum(1 for u in self.users.values() if g in u.get('groups', []))}
+                  for g in self.groups]
+        return self.page_response('groups', groups, int(request.match_info['page']))
+
+    async def post_action(self, request):
+        throttled = self.check_request(request)
+        if throttled is not None:
+            return throttled
+        actions = await request.json()
+        errors = []
+        for index, action in enumerate(actions):
+            for step, command in enumerate(action['do']):
+                error = self.apply_command(action, command)
+                if error:
+                    errors.append({'index': index, 'step': step, 'requestID': action.get('requestID'),
+                                   'errorCode': error[0], 'message': error[1]})
+                    break
+        failed = len({e['index'] for e in errors})
+        body = {'result': 'success' if not errors else 'partial', 'completed': len(actions) - failed,
+                'notCompleted': failed, 'completedInTestMode': 0}
+        if errors:
+            body['errors'] = errors
+        return web.json_response(body)
+
+    def apply_command(self, action, command):
+        """
+        :return: tuple (error code, message) if the command fails
+        """
+        (name, params), = command.items()
+        if 'usergroup' in action:
+            group = action['usergroup']
+            if name == 'createUserGroup':
+                if group not in self.groups:
+                    self.groups.append(group)
+                return None
+            if group not in self.groups:
+                return 'error.group.not_found', 'no group %s' % group
+            for email in params['user']:
+                user = self.users.get(email.lower())
+                if user is None:
+                    return 'error.user.not_found', 'no user %s' % email
+                if name == 'add' and group not in user['groups']:
+                    user['groups'].append(group)
+                elif name == 'remove' and group in user['groups']:
+                    user['groups'].remove(group)
+            return None
+        email = action['user'].lower()
+        if name.startswith('create') or name == 'addAdobeID':
+            self.users.setdefault(email, {'email': params.get('email', action['user']), 'username': action['user'],
+                                          'domain': email.split('@')[1], 'type': 'federatedID', 'groups': []})
+            return None
+        user = self.users.get(email)
+        if user is None:
+            return 'error.user.not_found', 'no user %s' % email
+        if name == 'update':
+            user.update(params)
+        elif name in ('add', 'remove'):
+            for group in params.get('group', []):
+                if group not in self.groups:
+                    return 'error.group.not_found', 'no group %s' % group
+                if name == 'add' and group not in user['groups']:
+                    user['groups'].append(group)
+                elif name == 'remove' and group in user['groups']:
+                    user['groups'].remove(group)
+        elif name == 'removeFromOrg':
+            del self.users[email]
+        return None
@@ -0,0 +1,105 @@
+import copy
+import pickle
+from unittest import mock
+
+import pytest
+
+import user_sync.connector.helper
+from user_sync.connector.helper import create_blank_user, DirectoryUser, share_string, SourceAttributes
+
+
+@pytest.fixture
+def user():
+    user = create_blank_user()
+    user['email'] = 'user@example.com'
+    user['username'] = 'user'
+    user['domain'] = ''.join(['example', '.com'])
+    user['source_attributes'] = {'email': 'user@example.com', 'givenName': 'User', 'sn': None}
+    return user
+
+
+def test_blank_user():
+    user = create_blank_user()
+    assert isinstance(user, DirectoryUser)
+    assert user == {'identity_type': None, 'username': None, 'domain': None, 'firstname': None,
+                    'lastname': None, 'email': None, 'groups': [], 'country': None}
+    assert 'source_attributes' not in user
+    assert user.get('member_groups', []) == []
+    with pytest.raises(KeyError):
+        _ = user['source_attributes']
+
+
+def test_mapping_interface(user):
+    user['uid'] = 'abc'
+    user['member_groups'] = ['G1']
+    assert list(user) == ['identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups',
+                          'country', 'member_groups', 'source_attributes', 'uid']
+    assert len(user) == 11
+    assert user['uid'] == 'abc'
+    user.update({'firstname': 'New', 'extra': 1})
+    assert user['firstname'] == 'New' and user['extra'] == 1
+    del user['uid']
+    assert 'uid' not in user
+    del user['member_groups']
+    assert 'member_groups' not in user
+    with pytest.raises(KeyError):
+        del user['member_groups']
+    with pytest.raises(KeyError):
+        _ = user['keys']
+
+
+def test_shared_fields(user):
+    other = create_blank_user()
+    other['domain'] = ''.join(['example', '.com'])
+    other['firstname'] = ''.join(['Us', 'er'])
+    assert other['domain'] is user['domain']
+    assert other['firstname'] is user['source_attributes']['givenName']
+
+
+def test_share_string_is_bounded():
+    with mock.patch.object(user_sync.connector.helper, 'SHARED_STRING_CACHE_SIZE', 10), \
+            mock.patch.object(user_sync.connector.helper, '_shared_strings', {}), \
+            mock.patch.object(user_sync.connector.helper, '_previous_shared_strings', {}):
+        kept = share_string(''.join(['Ke', 'pt']))
+        for i in range(100):
+            assert share_string('Value %d' % i) == 'Value %d' % i
+            # a value that is seen again stays shared
+            assert share_string(''.join(['Ke', 'pt'])) is kept
+            assert len(user_sync.connector.helper._shared_strings) <= 10
+            assert len(user_sync.connector.helper._previous_shared_strings) <= 10
+    assert share_string(None) is None
+
+
+def test_source_attributes(user):
+    other = create_blank_user()
+    other['source_attributes'] = {'email': 'other@example.com', 'givenName': 'Other', 'sn': 'Last'}
+    source_attributes = user['source_attributes']
+    assert isinstance(source_attributes, SourceAttributes)
+    assert source_attributes['givenName'] == 'User'
+    assert source_attributes == {'email': 'user@example.com', 'givenName': 'User', 'sn': None}
+    assert source_attributes._index is other['source_attributes']._index
+    copied = source_attributes.copy()
+    assert type(copied) is dict
+    copied['sn'] = 'Changed'
+    assert user['source_attributes']['sn'] is None
+
+
+def test_source_attributes_compacted_when_set():
+    user = create_blank_user()
+    user['source_attributes'] = {'email': 'user@example.com', 'givenName': 'User'}
+    assert type(user.get('source_attributes')) is SourceAttributes
+    user['source_attributes'] = None
+    assert user['source_attributes'] is None
+
+
+def test_copies(user):
+    user['uid'] = 'abc'
+    for copied in (user.copy(), copy.deepcopy(user), pickle.loads(pickle.dumps(user))):
+        assert isinstance(copied, DirectoryUser)
+        assert copied == user
+    copied = user.copy()
+    copied['uid'] = 'def'
+    assert user['uid'] == 'abc'
+    del user['groups']
+    assert 'groups' not in user.copy()
+    assert 'member_groups' not in pickle.loads(pickle.dumps(user))
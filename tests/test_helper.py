@@ -0,0 +1,25 @@
+from unittest import mock
+
+import user_sync.helper
+from user_sync.helper import normalize_shared_string
+
+
+def test_normalize_shared_string():
+    assert normalize_shared_string(None) is None
+    first = normalize_shared_string(' Group A ')
+    assert first == 'group a'
+    assert normalize_shared_string('group A') is first
+    assert normalize_shared_string('group a') is first
+
+
+def test_normalize_shared_string_is_bounded():
+    with mock.patch.object(user_sync.helper, 'NORMALIZE_CACHE_SIZE', 10), \
+            mock.patch.object(user_sync.helper, '_normalized_strings', {}), \
+            mock.patch.object(user_sync.helper, '_previous_normalized_strings', {}):
+        kept = normalize_shared_string('Kept')
+        for i in range(100):
+            assert normalize_shared_string('Group %d' % i) == 'group %d' % i
+            # a string that is used again stays in the cache
+            assert normalize_shared_string('Kept') is kept
+            assert len(user_sync.helper._normalized_strings) <= 12
+            assert len(user_sync.helper._previous_normalized_strings) <= 12
@@ -30,6 +30,13 @@ def test_add_umapi_user(example_user):
     assert post_sync_data.umapi_data[None][email_id] == example_user
 
 
+def test_groups_are_only_lowercased(example_user):
+    post_sync_data = PostSyncData()
+    email_id = 'user@example.com'
+    post_sync_data.update_umapi_data(None, email_id, ['Group1 ', ' GROUP2'], [], **example_user)
+    assert post_sync_data.umapi_data[None][email_id]['groups'] == {'group1 ', ' group2'}
+
+
 def test_add_groups(example_user):
     post_sync_data = PostSyncData()
     email_id = 'user@example.com'
@@ -0,0 +1,347 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from unittest import mock
+
+import pytest
+
+from user_sync.error import AssertionException
+from user_sync.rules import AdditionalGroupMatcher, AdobeGroup, RuleProcessor, UmapiConnectors
+
+
+def make_connectors(count):
+    secondaries = {}
+    for i in range(count):
+        connector = mock.MagicMock()
+        connector.name = 'umapi.org%d' % i
+        secondaries['org%d' % i] = connector
+    return UmapiConnectors(mock.MagicMock(), secondaries)
+
+
+@pytest.mark.parametrize('parallelism', [1, 3, 20])
+def test_for_each_secondary_keeps_connector_order(parallelism):
+    rule_processor = RuleProcessor({'secondary_parallelism': parallelism})
+    umapi_connectors = make_connectors(8)
+    active = []
+    most_active = [0]
+    lock = threading.Lock()
+
+    def process(umapi_name, umapi_connector, suffix):
+        with lock:
+            active.append(umapi_name)
+            most_active[0] = max(most_active[0], len(active))
+        # the earlier secondaries finish last
+        time.sleep(0.01 * (8 - int(umapi_name[3:])))
+        with lock:
+            active.remove(umapi_name)
+        return umapi_connector.name + suffix
+
+    results = rule_processor.for_each_secondary(umapi_connectors, process, '!')
+    assert results == [('org%d' % i, 'umapi.org%d!' % i) for i in range(8)]
+    assert most_active[0] == min(parallelism, 8)
+
+
+def test_for_each_secondary_raises_errors():
+    rule_processor = RuleProcessor({'secondary_parallelism': 4})
+
+    def process(umapi_name, umapi_connector):
+        if umapi_name == 'org2':
+            raise ValueError(umapi_name)
+
+    with pytest.raises(ValueError):
+        rule_processor.for_each_secondary(make_connectors(4), process)
+
+
+def test_manage_strays_in_parallel_secondaries():
+    rule_processor = RuleProcessor({'secondary_parallelism': 4, 'remove_strays': True})
+    umapi_connectors = make_connectors(5)
+    strays = {'federatedID,user%d@example.com,' % i: None for i in range(3)}
+    rule_processor.stray_key_map = {None: strays}
+    for umapi_name in umapi_connectors.get_secondary_connectors():
+        rule_processor.stray_key_map[umapi_name] = dict(strays)
+    rule_processor.manage_strays(umapi_connectors)
+    for connector in umapi_connectors.connectors:
+        assert connector.send_commands.call_count == 3
+        assert connector.flush.call_count == 1
+
+
+def test_secondaries_keep_their_own_user_state():
+    rule_processor = RuleProcessor({'secondary_parallelism': 4})
+    org1, org2 = rule_processor.get_umapi_info('org1'), rule_processor.get_umapi_info('org2')
+    rule_processor.filter_adobeID_user(org1, {'type': 'adobeID', 'email': 'User@example.com'})
+    assert rule_processor.is_adobeID_email_exist('user@example.com', org1)
+    assert not rule_processor.is_adobeID_email_exist('user@example.com', org2)
+
+    rule_processor.map_email_override(org1, {'email': 'user@example.com', 'username': 'other@example.com'})
+    assert rule_processor.get_stray_commands('federatedID,other@example.com,', org1).username == 'user@example.com'
+    assert rule_processor.get_stray_commands('federatedID,other@example.com,', org2).username == 'other@example.com'
+
+    # creating the user in a secondary doesn't change the shared directory user
+    directory_user = {'identity_type': 'federatedID', 'username': 'other@example.com', 'domain': 'example.com',
+                      'email': 'user@example.com', 'firstname': None, 'lastname': None, 'country': 'US'}
+    rule_processor.directory_user_by_user_key['federatedID,other@example.com,'] = directory_user
+    connector = mock.MagicMock()
+    connector.trusted = True
+    rule_processor.create_umapi_user('federatedID,other@example.com,', set(), org2, connector)
+    assert connector.send_commands.call_args[0][0].username == 'user@example.com'
+    assert directory_user['username'] == 'other@example.com'
+
+
+def test_stray_commands_carry_the_umapi_email():
+    rule_processor = RuleProcessor({})
+    umapi_info = rule_processor.get_umapi_info(None)
+    user_key = rule_processor.get_user_key('federatedID', 'uone', 'example.com')
+    assert rule_processor.get_stray_commands(user_key, umapi_info).email is None
+    umapi_info.add_umapi_user(user_key, {'email': 'User.One@example.com', 'username': 'uone',
+                                         'domain': 'example.com'})
+    commands = rule_processor.get_stray_commands(user_key, umapi_info)
+    assert (commands.email, commands.username, commands.domain) == ('User.One@example.com', 'uone', 'example.com')
+
+
+def test_create_umapi_groups_skips_existing_groups():
+    rule_processor = RuleProcessor({})
+    umapi_connectors = make_connectors(2)
+    umapi_connectors.get_primary_connector().name = 'umapi.primary'
+    for umapi_name in (None, 'org0', 'org1'):
+        umapi_info = rule_processor.get_umapi_info(umapi_name)
+        for group in ('Existing', 'New 1', 'new 1', 'New 2'):
+            umapi_info.add_mapped_group(group)
+    for connector in umapi_connectors.connectors:
+        connector.iter_groups.return_value = iter([{'groupName': 'EXISTING'}])
+        connector.create_groups.return_value = []
+    umapi_connectors.get_secondary_connectors()['org1'].create_groups.return_value = [('New 2', 'no access')]
+    rule_processor.create_umapi_groups(umapi_connectors)
+    for connector in umapi_connectors.connectors:
+        assert connector.create_groups.call_count == 1
+        assert len(connector.create_groups.call_args[0][0]) == 2
+    assert rule_processor.action_summary['adobe_user_groups_created'] == 5
+
+
+@pytest.mark.parametrize('options,member_count,plan', [
+    ({}, 10, 'groups'),
+    ({}, 1000, 'lookups'),
+    ({'remove_strays': True}, 10, 'lookups'),
+])
+def test_included_umapi_users_plan(options, member_count, plan):
+    rule_processor = RuleProcessor(dict(options, secondary_fetch='restricted'))
+    primary_info = rule_processor.get_umapi_info(None)
+    for i in range(5):
+        user_key = 'federatedID,user%d@example.com,' % i
+        primary_info.add_umapi_user(user_key, {'email': 'user%d@example.com' % i})
+        rule_processor.included_user_keys.add(user_key)
+    umapi_info = rule_processor.get_umapi_info('org0')
+    umapi_info.add_mapped_group('Group A')
+    connector = mock.MagicMock()
+    connector.estimate_group_read_pages.side_effect = lambda groups: (member_count + 199) // 200 * len(groups)
+    rule_processor.get_included_umapi_users(umapi_info, connector)
+    if plan == 'groups':
+        connector.iter_users_in_groups.assert_called_once_with(['Group A'])
+        assert not connector.lookup_users.called
+    else:
+        connector.lookup_users.assert_called_once_with(['user%d@example.com' % i for i in range(5)])
+        assert not connector.iter_users_in_groups.called
+
+
+@pytest.mark.parametrize('options,targeted,will_process_strays', [
+    ({}, False, False),
+    ({'targeted_lookups': 'auto'}, True, False),
+    ({'targeted_lookups': 'auto', 'exclude_strays': False, 'process_groups': True}, False, True),
+    ({'targeted_lookups': 'always', 'exclude_strays': True, 'process_groups': True}, True, False),
+    ({'targeted_lookups': 'never'}, False, False),
+])
+def test_will_use_targeted_lookups(options, targeted, will_process_strays):
+    rule_processor = RuleProcessor(options)
+    rule_processor.filtered_directory_user_by_user_key = {
+        'federatedID,user%d@example.com,' % i: {'username': 'user%d@example.com' % i} for i in range(10)}
+    connector = mock.MagicMock()
+    connector.is_snapshot_current.return_value = False
+    connector.get_user_page_info.return_value = (5000, 25, 200)
+    assert rule_processor.will_use_targeted_lookups(connector) == targeted
+    assert rule_processor.will_process_strays == will_process_strays
+
+
+@pytest.mark.parametrize('options', [
+    {'process_groups': True},
+    {'stray_list_output_path': 'strays.csv'},
+    {'exclude_strays': True, 'stray_list_input_path': 'strays.csv'},
+])
+def test_targeted_lookups_always_rejected_with_adobe_only_users(options, tmp_path):
+    if 'stray_list_input_path' in options:
+        options['stray_list_input_path'] = str(tmp_path / 'strays.csv')
+        (tmp_path / 'strays.csv').write_text('type,username,domain\n')
+    with pytest.raises(AssertionException):
+        RuleProcessor(dict(options, targeted_lookups='always'))
+
+
+def test_targeted_lookups_only_for_small_selections():
+    rule_processor = RuleProcessor({'targeted_lookups': 'auto'})
+    rule_processor.filtered_directory_user_by_user_key = {
+        'federatedID,user%d,example.com' % i: {'username': 'user%d' % i, 'domain': 'example.com'} for i in range(30)}
+    connector = mock.MagicMock()
+    connector.is_snapshot_current.return_value = False
+    connector.get_user_page_info.return_value = (5000, 25, 200)
+    assert not rule_processor.will_use_targeted_lookups(connector)
+    assert rule_processor.get_directory_user_ids()[0] == ('user0', 'example.com')
+
+
+def test_directory_user_ids_use_username_unless_it_is_the_email():
+    rule_processor = RuleProcessor({})
+    rule_processor.filtered_directory_user_by_user_key = OrderedDict([
+        ('a', {'username': 'User1@example.com', 'domain': None, 'email': 'user1@example.com'}),
+        ('b', {'username': 'user2@example.com', 'domain': None, 'email': 'user2@other.com'}),
+        ('c', {'username': 'user3@example.com', 'domain': 'example.org', 'email': 'user3@other.com'}),
+        ('d', {'username': 'user4', 'domain': 'example.com', 'email': 'user4@example.com'}),
+        ('e', {'username': None, 'domain': None, 'email': 'user5@example.com'}),
+    ])
+    assert rule_processor.get_directory_user_ids() == [
+        'User1@example.com', ('user2@example.com', 'example.com'), ('user3@example.com', 'example.org'),
+        ('user4', 'example.com'), 'user5@example.com']
+
+
+def test_user_keys_are_shared():
+    rule_processor = RuleProcessor({})
+    directory_key = rule_processor.get_directory_user_key({
+        'identity_type': 'federatedID', 'username': 'User1', 'domain': 'Example.com', 'email': 'user1@example.com'})
+    umapi_key = rule_processor.get_umapi_user_key({
+        'type': 'federatedID', 'username': 'user1', 'domain': 'example.com', 'email': 'user1@example.com'})
+    assert directory_key == ('federatedID', 'user1', 'example.com')
+    assert umapi_key is directory_key
+    assert str(directory_key) == 'federatedID,user1,example.com'
+    assert rule_processor.parse_user_key(directory_key) is directory_key
+    assert rule_processor.get_user_key('federatedID', 'user2@example.com', 'example.com') == \
+        ('federatedID', 'user2@example.com', '')
+    assert len(rule_processor.user_keys) == 2
+    assert rule_processor.parse_user_key('adobeID,user3@example.com,') == ('adobeID', 'user3@example.com', '')
+
+
+def test_adobe_group_registry():
+    AdobeGroup.clear()
+    group = AdobeGroup.create('Group 1')
+    secondary_group = AdobeGroup.create('org1::Group 1')
+    assert AdobeGroup.create('Group 1') is group
+    assert AdobeGroup.lookup('org1::Group 1') is secondary_group
+    assert AdobeGroup.lookup('::Group 1') is group
+    assert AdobeGroup.lookup('Group 2') is None
+    assert AdobeGroup.lookup_id(secondary_group.get_group_id()) is secondary_group
+    assert secondary_group.get_qualified_name() == 'org1::Group 1'
+
+    unindexed = AdobeGroup('Group 1', 'org1', index=False)
+    assert unindexed == secondary_group and hash(unindexed) == hash(secondary_group)
+    assert unindexed != group and hash(unindexed) != hash(group)
+    assert unindexed in set(AdobeGroup.iter_groups())
+    assert len({AdobeGroup.create('Group %d' % i) for i in range(100)}) == 100
+    AdobeGroup.clear()
+
+
+def test_desired_groups_are_resolved_once_per_group_combination():
+    AdobeGroup.clear()
+    mappings = {'Sales': [AdobeGroup.create('Sales Group'), AdobeGroup.create('org1::Sales Group')],
+                'Staff': [AdobeGroup.create('Staff Group')]}
+    rule_processor = RuleProcessor({'after_mapping_hook': compile(
+        "if source_attributes['email'] == 'user3@example.com': target_groups.add('Extra')", '<hook>', 'exec')})
+    AdobeGroup.create('Extra')
+    rule_processor.prepare_umapi_infos()
+    combinations = [['Sales', 'Staff'], ['Staff', 'Sales'], ['Staff'], ['Staff'], []]
+    directory_users = []
+    for i, groups in enumerate(combinations):
+        email = 'user%d@example.com' % i
+        directory_users.append({'identity_type': 'federatedID', 'username': email, 'domain': 'example.com',
+                                'email': email, 'firstname': None, 'lastname': None, 'country': 'US',
+                                'groups': groups, 'source_attributes': {'email': email}})
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = directory_users
+    with mock.patch.object(rule_processor, 'resolve_target_groups',
+                           wraps=rule_processor.resolve_target_groups) as resolve_target_groups:
+        rule_processor.read_desired_user_groups(mappings, directory_connector)
+    # user3 has another combination of target groups because of the hook
+    assert resolve_target_groups.call_count == 4
+
+    primary_groups = rule_processor.get_umapi_info(None).get_desired_groups_by_user_key()
+    secondary_groups = rule_processor.get_umapi_info('org1').get_desired_groups_by_user_key()
+    keys = [('federatedID', 'user%d@example.com' % i, '') for i in range(5)]
+    assert primary_groups[keys[0]] == {'sales group', 'staff group'}
+    assert primary_groups[keys[0]] is primary_groups[keys[1]]
+    assert primary_groups[keys[2]] == {'staff group'}
+    assert primary_groups[keys[3]] == {'staff group', 'extra'}
+    assert primary_groups[keys[4]] == set()
+    assert secondary_groups == {keys[0]: {'sales group'}, keys[1]: {'sales group'}}
+    AdobeGroup.clear()
+
+
+def make_additional_group_rules(*rules):
+    return [{'source': re.compile(source), 'target': AdobeGroup.create(target, index=False)}
+            for source, target in rules]
+
+
+def test_additional_group_matcher():
+    AdobeGroup.clear()
+    matcher = AdditionalGroupMatcher(make_additional_group_rules(
+        (r'ACL-(.+)', r'ACL-Grp-(\1)'), (r'(.+)-ACL', r'ACL-Grp-(\1)'), (r'ACL-Admin', 'org1::Admins')))
+    assert matcher.combined_source is not None
+    assert matcher.match('Other') == []
+    assert [(t.get_qualified_name(), g) for t, g in matcher.match('ACL-Admin')] == [
+        (r'ACL-Grp-(\1)', 'ACL-Grp-(Admin)'), ('org1::Admins', 'Admins')]
+    assert [g for _, g in matcher.match('Sales-ACL')] == ['ACL-Grp-(Sales)']
+
+    # rules with back-references are only matched one by one
+    matcher = AdditionalGroupMatcher(make_additional_group_rules((r'(a)\1-(.+)', r'\2'), (r'(b)\1-(.+)', r'\2')))
+    assert matcher.combined_source is None
+    assert [g for _, g in matcher.match('bb-Group')] == ['Group']
+    AdobeGroup.clear()
+
+
+def test_additional_groups_are_resolved_once_per_member_group():
+    AdobeGroup.clear()
+    rule_processor = RuleProcessor({'additional_groups': make_additional_group_rules(
+        (r'ACL-(.+)', r'ACL-Grp-(\1)'), (r'(.+)-ACL', r'ACL-Grp-(\1)'))})
+    directory_users = []
+    for i, member_groups in enumerate([['ACL-Sales', 'Other'], ['ACL-Sales'], ['Sales-ACL'], ['Other']]):
+        email = 'user%d@example.com' % i
+        directory_users.append({'identity_type': 'federatedID', 'username': email, 'domain': 'example.com',
+                                'email': email, 'groups': [], 'member_groups': member_groups,
+                                'source_attributes': {'email': email}})
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = directory_users
+    with mock.patch.object(rule_processor, 'resolve_member_group',
+                           wraps=rule_processor.resolve_member_group) as resolve_member_group:
+        rule_processor.read_desired_user_groups({}, directory_connector)
+    assert resolve_member_group.call_count == 3
+
+    umapi_info = rule_processor.get_umapi_info(None)
+    desired_groups = umapi_info.get_desired_groups_by_user_key()
+    assert [desired_groups[('federatedID', 'user%d@example.com' % i, '')] for i in range(4)] == [
+        {'acl-grp-(sales)'}, {'acl-grp-(sales)'}, {'acl-grp-(sales)'}, set()]
+    assert umapi_info.get_mapped_groups() == {'acl-grp-(sales)'}
+    with pytest.raises(AssertionException):
+        rule_processor.validate_and_log_additional_groups(umapi_info)
+    AdobeGroup.clear()
+
+
+def test_exclusions_are_counted_per_rule():
+    patterns = ['svc-.*', r'admin\d+@example\.com', 'unused-.*']
+    rule_processor = RuleProcessor({
+        'exclude_identity_types': ['adobeID'],
+        'exclude_groups': ['Excluded Group'],
+        'exclude_users': [re.compile(r'\A' + p + r'\Z', re.UNICODE | re.IGNORECASE) for p in patterns],
+    })
+    assert rule_processor.exclude_users_pattern is not None
+    users = [
+        ('adobeID,svc-1@example.com,', set()),
+        ('federatedID,user1@example.com,', {'excluded group', 'other'}),
+        ('federatedID,svc-2@example.com,', set()),
+        ('federatedID,SVC-3@example.com,', set()),
+        ('federatedID,admin12@example.com,', set()),
+        ('federatedID,user2@example.com,', {'other'}),
+        ('federatedID,admin@example.com,', set()),
+    ]
+    excluded = [rule_processor.is_umapi_user_excluded(True, user_key, groups) for user_key, groups in users]
+    assert excluded == [True, True, True, True, True, False, False]
+    assert rule_processor.excluded_user_count == 5
+    assert list(rule_processor.exclusion_counts.values()) == [1, 1, 2, 1, 0]
+    assert not rule_processor.is_umapi_user_excluded(False, 'federatedID,user2@example.com,', set())
+    assert rule_processor.is_umapi_user_excluded(False, 'federatedID,svc-2@example.com,', set())
+
+    rule_processor.exclude_users_pattern = None
+    assert [rule_processor.match_exclude_users(name) for name in ('svc-x', 'admin1@example.com', 'user')] == \
+        rule_processor.exclude_users[:2] + [None]
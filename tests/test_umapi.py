@@ -0,0 +1,615 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+import umapi_client
+
+from user_sync.connector.umapi import ActionManager, Commands, UmapiConnector
+from user_sync.connector.umapi_snapshot import UserSnapshot
+from user_sync.error import AssertionException
+
+
+@pytest.fixture
+def connection():
+    conn = mock.MagicMock()
+    conn.execute_multiple.side_effect = lambda actions, immediate=True: (0, len(actions), len(actions))
+    return conn
+
+
+@pytest.fixture
+def action_manager(connection):
+    return ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=3)
+
+
+def make_commands(username, groups=None):
+    commands = Commands(identity_type='federatedID', email=username, username=username, domain='example.com')
+    commands.add_groups(groups or {'group1'})
+    return commands
+
+
+def add_users(action_manager, count, callback=None):
+    for i in range(count):
+        action = action_manager.create_action(make_commands('user%d@example.com' % i))
+        action_manager.add_action(action, callback)
+
+
+def test_actions_queued_until_batch_full(action_manager, connection):
+    add_users(action_manager, 2)
+    assert not connection.execute_multiple.called
+    assert action_manager.has_work()
+    add_users(action_manager, 1)
+    assert connection.execute_multiple.call_count == 1
+    assert len(connection.execute_multiple.call_args[0][0]) == 3
+    assert not action_manager.has_work()
+
+
+def test_flush_sends_partial_batch(action_manager, connection):
+    add_users(action_manager, 5)
+    assert connection.execute_multiple.call_count == 1
+    action_manager.flush()
+    assert connection.execute_multiple.call_count == 2
+    assert len(connection.execute_multiple.call_args[0][0]) == 2
+    assert not action_manager.has_work()
+    assert action_manager.get_statistics() == (5, 0)
+
+
+def test_callbacks_and_errors_per_action(action_manager, connection):
+    results = []
+
+    def execute(actions, immediate=True):
+        actions[1].report_command_error({'index': 1, 'step': 0, 'errorCode': 'error.group.not_found',
+                                         'message': 'no such group'})
+        return 0, len(actions), len(actions) - 1
+
+    connection.execute_multiple.side_effect = execute
+    add_users(action_manager, 3, lambda result: results.append(result['is_success']))
+    assert results == [True, False, True]
+    assert action_manager.get_statistics() == (3, 1)
+
+
+def test_batch_error_counts_whole_batch(action_manager, connection):
+    results = []
+    connection.execute_multiple.side_effect = umapi_client.BatchError([Exception('bad response')], 0, 3, 0)
+    add_users(action_manager, 3, lambda result: results.append(result['is_success']))
+    assert results == [False, False, False]
+    assert action_manager.get_statistics() == (3, 3)
+
+
+def test_unavailable_error(action_manager, connection):
+    connection.execute_multiple.side_effect = umapi_client.UnavailableError(3, 30, None)
+    add_users(action_manager, 2)
+    with pytest.raises(AssertionException):
+        action_manager.flush()
+
+
+def test_workers_keep_order_per_user(connection):
+    sent = []
+    lock = threading.Lock()
+
+    def execute(actions, immediate=True):
+        with lock:
+            sent.extend((a.frame['user'], a.frame['requestID']) for a in actions)
+        return 0, len(actions), len(actions)
+
+    connection.execute_multiple.side_effect = execute
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=2, workers=4)
+    results = []
+    for round_number in range(3):
+        for i in range(10):
+            action = action_manager.create_action(make_commands('user%d@example.com' % i, {'group%d' % round_number}))
+            action_manager.add_action(action, lambda result: results.append(result['is_success']))
+    action_manager.flush()
+    assert not action_manager.has_work()
+    assert len(sent) == 30
+    assert len(results) == 30 and all(results)
+    assert action_manager.get_statistics() == (30, 0)
+    for i in range(10):
+        request_ids = [int(r.split('_')[1]) for u, r in sent if u == 'user%d@example.com' % i]
+        assert request_ids == sorted(request_ids)
+
+
+def test_workers_report_errors(connection):
+    connection.execute_multiple.side_effect = umapi_client.BatchError([Exception('bad response')], 0, 1, 0)
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=2, workers=3)
+    add_users(action_manager, 7)
+    action_manager.flush()
+    assert action_manager.get_statistics() == (7, 7)
+
+
+def test_workers_raise_unavailable_on_flush(connection):
+    connection.execute_multiple.side_effect = umapi_client.UnavailableError(3, 30, None)
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=2, workers=3)
+    add_users(action_manager, 3)
+    with pytest.raises(AssertionException):
+        action_manager.flush()
+
+
+def make_checked_connection(in_use):
+    """
+    A connection that fails the test if it is used by two threads at once.
+    """
+    connection = mock.MagicMock()
+    lock = threading.Lock()
+
+    def execute(actions, immediate=True):
+        assert lock.acquire(blocking=False), 'connection used concurrently'
+        in_use.append(connection)
+        time.sleep(0.002)
+        lock.release()
+        return 0, len(actions), len(actions)
+
+    connection.execute_multiple.side_effect = execute
+    return connection
+
+
+def test_workers_use_their_own_connections():
+    used = []
+    connections = [make_checked_connection(used) for _ in range(3)]
+    action_manager = ActionManager(connections[0], 'org_id', mock.MagicMock(), batch_size=1, workers=3,
+                                   lane_connections=connections)
+    assert action_manager.connection_lock is None
+    add_users(action_manager, 30)
+    action_manager.flush()
+    assert action_manager.get_statistics() == (30, 0)
+    assert {id(c) for c in used} == {id(c) for c in connections}
+
+
+def test_workers_take_turns_on_a_shared_connection():
+    used = []
+    connection = make_checked_connection(used)
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=1, workers=3)
+    add_users(action_manager, 30)
+    action_manager.flush()
+    assert action_manager.get_statistics() == (30, 0)
+    assert len(used) == 30
+
+
+def test_lanes_keyed_by_email(connection):
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), workers=8)
+    by_username = action_manager.create_action(
+        Commands(identity_type='federatedID', email='User.One@example.com', username='uone', domain='example.com'))
+    by_email = action_manager.create_action(
+        Commands(identity_type='federatedID', email='user.one@example.com', username='user.one@example.com',
+                 domain='example.com'))
+    assert by_username.frame['user'] != by_email.frame['user']
+    assert action_manager.get_lane_index(by_username) == action_manager.get_lane_index(by_email)
+
+
+def test_connector_workers_get_their_own_connections():
+    options = {
+        'server': {'workers': 3},
+        'enterprise': {
+            'org_id': 'org_id',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'tech_acct_id': 'tech_acct_id',
+            'priv_key_data': 'private_key_data',
+        },
+    }
+    with mock.patch('user_sync.connector.umapi.umapi_client.Connection'), \
+            mock.patch('user_sync.connector.umapi_util.umapi_client.Connection',
+                       side_effect=lambda **kwargs: mock.MagicMock()) as connection_class:
+        connector = UmapiConnector('', options)
+    lane_connections = connector.get_action_manager().lane_connections
+    assert len({id(c) for c in lane_connections}) == 3
+    assert lane_connections[0] is connector.connection
+    # the copies use the first connection's access token
+    assert connection_class.call_args_list[1][1]['auth'] is connector.connection.auth
+
+
+@pytest.fixture
+def umapi_connector():
+    def _umapi_connector(**server_options):
+        options = {
+            'server': server_options,
+            'enterprise': {
+                'org_id': 'org_id',
+                'client_id': 'client_id',
+                'client_secret': 'client_secret',
+                'tech_acct_id': 'tech_acct_id',
+                'priv_key_data': 'private_key_data',
+            },
+        }
+        with mock.patch('user_sync.connector.umapi.umapi_client.Connection'):
+            connector = UmapiConnector('', options)
+        connector.logger = mock.MagicMock()
+        # the copies made for other threads record their queries on the connection
+        connector.query_copies = []
+        connector.connection_factory = mock.MagicMock()
+        connector.connection_factory.copy_connection.side_effect = \
+            lambda connection, pool_size, **connection_args: make_query_copy(connector, connection)
+        return connector
+    return _umapi_connector
+
+
+def make_query_copy(connector, connection):
+    copy = mock.MagicMock()
+    thread = threading.current_thread()
+
+    def forward(method):
+        def query(*args, **kwargs):
+            assert threading.current_thread() is thread
+            return method(*args, **kwargs)
+        return query
+
+    copy.query_single.side_effect = forward(connection.query_single)
+    copy.query_multiple.side_effect = forward(connection.query_multiple)
+    connector.query_copies.append(copy)
+    return copy
+
+
+def make_user_pages(page_count, page_size=3):
+    pages = []
+    for page_number in range(page_count):
+        users = [{'email': 'user%d@example.com' % (page_number * page_size + i)} for i in range(page_size)]
+        pages.append(users)
+    # the last user on each page shows up again at the start of the next page
+    for page_number in range(1, page_count):
+        pages[page_number].insert(0, pages[page_number - 1][-1])
+    return pages
+
+
+@pytest.mark.parametrize('prefetch_pages', [0, 1, 3, 10])
+def test_iter_users_pages(umapi_connector, prefetch_pages):
+    pages = make_user_pages(5)
+    connector = umapi_connector(prefetch_pages=prefetch_pages)
+
+    def query_multiple(object_type, page, url_params, query_params):
+        if page >= len(pages):
+            return [], True, 0, 0, 0, 0
+        return pages[page], page == len(pages) - 1, 15, len(pages), page + 1, 3
+
+    connector.connection.query_multiple.side_effect = query_multiple
+    users = [u['email'] for u in connector.iter_users()]
+    assert users == ['user%d@example.com' % i for i in range(15)]
+    assert connector.logger.progress.call_args_list[-1] == mock.call(15, 15)
+    assert connector.logger.progress.call_count == len(pages)
+
+
+@pytest.mark.parametrize('prefetch_pages', [0, 3])
+def test_iter_users_reuses_first_page(umapi_connector, prefetch_pages):
+    pages = make_user_pages(4)
+    connector = umapi_connector(prefetch_pages=prefetch_pages)
+    connector.connection.query_multiple.side_effect = \
+        lambda object_type, page, url_params, query_params: (pages[page], page == 3, 12, 4, page + 1, 3)
+    assert connector.get_user_page_info() == (12, 4, 3)
+    assert [u['email'] for u in connector.iter_users()] == ['user%d@example.com' % i for i in range(12)]
+    pages_read = [c[0][1] for c in connector.connection.query_multiple.call_args_list]
+    assert sorted(pages_read) == [0, 1, 2, 3]
+
+
+def test_iter_users_prefetch_unavailable(umapi_connector):
+    pages = make_user_pages(3)
+    connector = umapi_connector(prefetch_pages=2)
+
+    def query_multiple(object_type, page, url_params, query_params):
+        if page == 2:
+            raise umapi_client.UnavailableError(3, 30, None)
+        return pages[page], False, 9, 3, page + 1, 3
+
+    connector.connection.query_multiple.side_effect = query_multiple
+    with pytest.raises(AssertionException):
+        list(connector.iter_users())
+
+
+def test_iter_users_snapshot(umapi_connector, tmpdir):
+    pages = make_user_pages(2)
+    connector = umapi_connector()
+    connector.options['test_mode'] = False
+    connector.snapshot = UserSnapshot(str(tmpdir), 'org_id', 0, 24, mock.MagicMock())
+    connector.connection.query_multiple.side_effect = \
+        lambda object_type, page, url_params, query_params: (pages[page], page == 1, 6, 2, page + 1, 3)
+    assert len(list(connector.iter_users())) == 6
+
+    commands = Commands(identity_type='federatedID', email='user0@example.com', username='user0@example.com')
+    commands.remove_from_org(False)
+    connector.send_commands(commands)
+    connector.flush()
+    connector.save_snapshot()
+
+    connector.connection.query_multiple.reset_mock()
+    connector.snapshot = UserSnapshot(str(tmpdir), 'org_id', 0, 24, mock.MagicMock())
+    assert connector.snapshot.load()
+    assert sorted(u['email'] for u in connector.iter_users()) == ['user%d@example.com' % i for i in range(1, 6)]
+    assert not connector.connection.query_multiple.called
+
+
+def test_failed_action_marks_snapshot_stale(umapi_connector):
+    connector = umapi_connector()
+    connector.snapshot = mock.MagicMock()
+    callback = mock.MagicMock()
+    snapshot_callback = connector.make_snapshot_callback(callback)
+    action = mock.MagicMock()
+    snapshot_callback({'action': action, 'is_success': True, 'errors': None})
+    connector.snapshot.apply_action.assert_called_once_with(action)
+    assert not connector.snapshot.mark_stale.called
+    # a command error: the commands before the failed step were executed
+    snapshot_callback({'action': action, 'is_success': False,
+                       'errors': [{'errorCode': 'error.user.not_found', 'command': {'add': {}}}]})
+    connector.snapshot.mark_stale.assert_called_once_with()
+    assert callback.call_count == 2
+
+
+def test_no_snapshot_changes_in_test_mode(umapi_connector, tmpdir):
+    pages = make_user_pages(2)
+    connector = umapi_connector()
+    connector.options['test_mode'] = True
+    connector.snapshot = UserSnapshot(str(tmpdir), 'org_id', 0, 24, mock.MagicMock())
+    connector.connection.query_multiple.side_effect = \
+        lambda object_type, page, url_params, query_params: (pages[page], page == 1, 6, 2, page + 1, 3)
+    assert len(list(connector.iter_users())) == 6
+
+    commands = Commands(identity_type='federatedID', email='user0@example.com', username='user0@example.com')
+    commands.remove_from_org(False)
+    connector.send_commands(commands)
+    connector.flush()
+    assert connector.snapshot.get_user_count() == 6
+    connector.save_snapshot()
+    assert not UserSnapshot(str(tmpdir), 'org_id', 0, 24, mock.MagicMock()).load()
+
+
+def test_group_actions_for_shared_memberships(connection):
+    sent = []
+    results = {}
+
+    def execute(actions, immediate=True):
+        sent.extend(a.wire_dict() for a in actions)
+        return 0, len(actions), len(actions)
+
+    connection.execute_multiple.side_effect = execute
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=10, group_action_threshold=3)
+    for i in range(150):
+        groups = {'shared', 'own%d' % i} if i < 2 else {'shared'}
+        action = action_manager.create_action(make_commands('user%d@example.com' % i, groups))
+        action_manager.add_action(action, lambda result: results.update({result['action'].email: result}))
+    assert not connection.execute_multiple.called
+    action_manager.flush()
+    assert not action_manager.has_work()
+
+    group_actions = [a for a in sent if 'usergroup' in a]
+    assert len(group_actions) == 2
+    assert sum(len(c['add']['user']) for a in group_actions for c in a['do']) == 150
+    assert all(len(a['do']) <= 10 and all(len(c['add']['user']) <= 10 for c in a['do']) for a in group_actions)
+    user_actions = [a for a in sent if 'user' in a]
+    assert sorted(a['do'][0]['add']['group'] for a in user_actions) == [['own0'], ['own1']]
+    assert len(results) == 150 and all(r['is_success'] for r in results.values())
+    assert action_manager.get_statistics() == (150, 0)
+
+
+@pytest.mark.parametrize('user_count,failed_step,first_failed', [(15, 1, 10), (15, 0, 0), (25, 1, 10), (25, 2, 20)])
+def test_group_action_errors_fail_the_rest_of_the_action(connection, user_count, failed_step, first_failed):
+    # UMAPI stops at the first failed command, so the users in later commands are never added
+    def execute(actions, immediate=True):
+        for action in actions:
+            if 'usergroup' in action.frame:
+                action.report_command_error({'index': 0, 'step': failed_step, 'errorCode': 'error.user.not_found',
+                                             'message': 'no such user'})
+        return 0, len(actions), len(actions)
+
+    connection.execute_multiple.side_effect = execute
+    results = {}
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), group_action_threshold=2)
+    add_users(action_manager, user_count,
+              lambda result: results.update({result['action'].email: result['is_success']}))
+    action_manager.flush()
+    failed = sorted(email for email, success in results.items() if not success)
+    assert len(results) == user_count
+    assert failed == sorted('user%d@example.com' % i for i in range(first_failed, user_count))
+    assert action_manager.get_statistics() == (user_count, user_count - first_failed)
+
+
+def test_held_membership_released_by_later_action(connection):
+    sent = []
+    connection.execute_multiple.side_effect = \
+        lambda actions, immediate=True: sent.extend(a.wire_dict() for a in actions) or (0, len(actions), len(actions))
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=1, group_action_threshold=1)
+    add_users(action_manager, 1)
+    commands = make_commands('user0@example.com')
+    commands.remove_from_org(False)
+    action_manager.add_action(action_manager.create_action(commands))
+    action_manager.flush()
+    assert [a.get('user') for a in sent] == ['user0@example.com', 'user0@example.com']
+    assert 'removeFromOrg' in sent[1]['do'][1]
+
+
+def test_send_commands_merges_commands_per_user(umapi_connector):
+    connector = umapi_connector()
+    sent = []
+    connector.connection.execute_multiple.side_effect = \
+        lambda actions, immediate=True: sent.extend(a.wire_dict() for a in actions) or (0, len(actions), len(actions))
+    results = []
+    for i in range(3):
+        commands = Commands(identity_type='federatedID', email='user%d@example.com' % i,
+                            username='user%d@example.com' % i)
+        commands.update_user({'firstname': 'User %d' % i})
+        connector.send_commands(commands, lambda result: results.append(result['action'].email))
+    commands = Commands(identity_type='federatedID', username='USER0@example.com')
+    commands.add_groups(['group1'])
+    connector.send_commands(commands, lambda result: results.append(result['action'].email))
+    assert connector.has_work()
+    connector.flush()
+    assert not connector.has_work()
+    assert len(sent) == 3
+    assert [list(c) for c in sent[0]['do']] == [['update'], ['add']]
+    assert sorted(results) == ['user0@example.com', 'user0@example.com', 'user1@example.com', 'user2@example.com']
+    assert connector.get_action_manager().get_statistics() == (3, 0)
+
+
+def test_send_commands_bounded(umapi_connector):
+    connector = umapi_connector()
+    with mock.patch('user_sync.connector.umapi.MAX_PENDING_COMMANDS', 2):
+        for i in range(13):
+            commands = Commands(identity_type='federatedID', username='user%d@example.com' % i)
+            commands.remove_from_org(False)
+            connector.send_commands(commands)
+    assert len(connector.pending_commands) == 2
+    assert connector.connection.execute_multiple.call_count == 1
+
+
+def test_outstanding_actions_by_request_id(action_manager):
+    action = action_manager.create_action(make_commands('user0@example.com'))
+    action_manager.add_action(action)
+    assert action_manager.get_outstanding_item(action.frame['requestID'])['action'] is action
+    action_manager.flush()
+    assert action_manager.get_outstanding_item(action.frame['requestID']) is None
+    assert not action_manager.outstanding_items
+
+
+def test_max_queued_actions_applies_backpressure(connection):
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=10, group_action_threshold=5,
+                                   max_queued_actions=4)
+    queued, held = [], []
+    for i in range(25):
+        action_manager.add_action(action_manager.create_action(make_commands('user%d@example.com' % i)))
+        queued.append(action_manager.get_queued_action_count())
+        held.append(len(action_manager.held_items))
+    assert max(queued) < 4
+    assert max(held) < 4
+    action_manager.flush()
+    assert action_manager.get_statistics() == (25, 0)
+    assert not action_manager.has_work()
+
+
+def test_backpressure_keeps_memberships_held(connection):
+    sent = []
+    connection.execute_multiple.side_effect = \
+        lambda actions, immediate=True: sent.extend(a.wire_dict() for a in actions) or (0, len(actions), len(actions))
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=10, group_action_threshold=3,
+                                   max_queued_actions=4)
+    add_users(action_manager, 3)
+    for i in range(10):
+        commands = make_commands('other%d@example.com' % i)
+        commands.remove_from_org(False)
+        action_manager.add_action(action_manager.create_action(commands))
+    assert len(action_manager.held_items) == 3
+    assert len(sent) == 8 and not [a for a in sent if 'usergroup' in a]
+    action_manager.flush()
+    group_actions = [a for a in sent if 'usergroup' in a]
+    assert len(group_actions) == 1 and len(group_actions[0]['do'][0]['add']['user']) == 3
+    assert action_manager.get_statistics() == (13, 0)
+
+
+def test_max_queued_actions_must_be_positive(umapi_connector):
+    with pytest.raises(AssertionException):
+        umapi_connector(max_queued_actions=0)
+
+
+def test_create_groups_in_batches(umapi_connector):
+    connector = umapi_connector(batch_size=3)
+    calls = []
+
+    def execute(actions, immediate=True):
+        calls.append([a.frame['usergroup'] for a in actions])
+        if len(calls) == 2:
+            raise umapi_client.BatchError([Exception('bad response')], 0, len(actions), 0)
+        actions[0].report_command_error({'index': 0, 'step': 0, 'errorCode': 'error.group.exists',
+                                         'message': 'group exists'})
+        return 0, len(actions), len(actions) - 1
+
+    connector.connection.execute_multiple.side_effect = execute
+    failures = connector.create_groups(['group%d' % i for i in range(7)])
+    assert calls == [['group0', 'group1', 'group2'], ['group3', 'group4', 'group5'], ['group6']]
+    assert [name for name, _ in failures] == ['group0', 'group3', 'group4', 'group5', 'group6']
+    assert failures[0][1] == 'group exists'
+
+
+def make_group_query(group_members, group_page_size=2):
+    calls = []
+    all_users = sorted({u for members in group_members.values() for u in members})
+
+    def query_multiple(object_type, page, url_params, query_params):
+        calls.append((object_type, tuple(url_params)))
+        if object_type == 'group':
+            groups = [{'groupName': name, 'memberCount': len(members)} for name, members in group_members.items()]
+            return groups, True, len(groups), 1, 1, len(groups)
+        members = group_members[url_params[0]] if url_params else all_users
+        users = [{'email': u, 'groups': [g for g, m in group_members.items() if u in m]}
+                 for u in members[page * group_page_size:(page + 1) * group_page_size]]
+        page_count = (len(members) + group_page_size - 1) // group_page_size
+        return users, page >= page_count - 1, len(members), page_count, page + 1, group_page_size
+
+    return query_multiple, calls
+
+
+def test_iter_users_in_groups_concurrently(umapi_connector):
+    connector = umapi_connector()
+    group_members = {
+        'A': ['user%d@example.com' % i for i in range(6)],
+        'B': ['user%d@example.com' % i for i in range(3, 9)],
+        'C': ['user0@example.com'],
+        'Others': ['other%d@example.com' % i for i in range(40)],
+    }
+    connector.connection.query_multiple.side_effect, calls = make_group_query(group_members)
+    users = [u['email'] for u in connector.iter_users_in_groups(['A', 'B', 'C', 'c'], choose_plan=True)]
+    assert sorted(users) == sorted('user%d@example.com' % i for i in range(9))
+    group_reads = [url_params for object_type, url_params in calls if object_type == 'user' and url_params]
+    assert sorted(set(group_reads)) == [('A',), ('B',), ('C',)]
+    assert len(group_reads) == 7
+    # each group was read on its reader thread's own connection
+    assert sum(copy.query_multiple.call_count for copy in connector.query_copies) == 7
+
+
+def test_group_reads_keep_users_that_share_an_email(umapi_connector):
+    connector = umapi_connector()
+    group_members = {
+        'A': [{'type': 'adobeID', 'email': 'user@example.com'},
+              {'type': 'federatedID', 'email': 'other@example.com', 'username': 'other', 'domain': 'example.com'}],
+        'B': [{'type': 'federatedID', 'email': 'user@example.com', 'username': 'User@example.com'},
+              {'type': 'federatedID', 'email': 'other@example.com', 'username': 'OTHER', 'domain': 'Example.com'}],
+    }
+    connector.connection.query_multiple.side_effect = \
+        lambda object_type, page, url_params, query_params: (group_members[url_params[0]], True, 2, 1, 1, 2)
+    users = [(u['type'], u['email']) for u in connector.iter_users_in_groups_concurrently(['A', 'B'])]
+    assert sorted(users) == [('adobeID', 'user@example.com'), ('federatedID', 'other@example.com'),
+                             ('federatedID', 'user@example.com')]
+
+
+def test_group_reads_stop_early(umapi_connector):
+    connector = umapi_connector()
+    group_members = {'G%d' % i: ['user%d@example.com' % i] for i in range(20)}
+    query_multiple, calls = make_group_query(group_members)
+    connector.connection.query_multiple.side_effect = query_multiple
+    with mock.patch('user_sync.connector.umapi.MAX_CONCURRENT_QUERIES', 1):
+        users = connector.iter_users_in_groups_concurrently(sorted(group_members))
+        next(users)
+        users.close()
+        time.sleep(0.2)
+    # the groups still waiting to be read when the caller stopped were never read
+    assert len(calls) < 10
+
+
+def test_iter_users_in_groups_full_read(umapi_connector):
+    connector = umapi_connector()
+    group_members = {
+        'A': ['user%d@example.com' % i for i in range(6)],
+        'B': ['user%d@example.com' % i for i in range(3, 9)],
+        'Others': ['user9@example.com'],
+    }
+    connector.connection.query_multiple.side_effect, calls = make_group_query(group_members)
+    users = [u['email'] for u in connector.iter_users_in_groups(['A', 'B'], choose_plan=True)]
+    assert users == ['user%d@example.com' % i for i in range(9)]
+    assert not [url_params for object_type, url_params in calls if url_params]
+    # without choosing a plan, the groups are always read
+    calls[:] = []
+    users = [u['email'] for u in connector.iter_users_in_groups(['A', 'B'])]
+    assert sorted(users) == ['user%d@example.com' % i for i in range(9)]
+    assert [object_type for object_type, _ in calls] == ['user'] * 6
+
+
+def test_lookup_users(umapi_connector):
+    connector = umapi_connector()
+    found = {'user%d@example.com' % i for i in range(0, 40, 2)}
+
+    def query_single(object_type, url_params, query_params=None):
+        email = url_params[0]
+        return {'email': email, 'groups': ['A']} if email in found else {}
+
+    connector.connection.query_single.side_effect = query_single
+    emails = ['user%d@example.com' % i for i in range(40)] + ['user0@example.com']
+    users = [u['email'] for u in connector.lookup_users(emails)]
+    assert users == sorted(found, key=emails.index)
+    assert connector.connection.query_single.call_count == 41
+    # the lookups were made on the lookup threads' own connections
+    assert connector.query_copies
+    assert sum(copy.query_single.call_count for copy in connector.query_copies) == 41
@@ -0,0 +1,89 @@
+from unittest import mock
+
+import pytest
+import umapi_client
+
+pytest.importorskip('aiohttp')
+
+from fake_umapi import FakeUmapi
+from user_sync.connector.umapi import Commands, UmapiConnector
+from user_sync.error import AssertionException
+
+Connection = umapi_client.Connection
+
+
+@pytest.fixture
+def fake_umapi():
+    users = [{'email': 'user%d@example.com' % i, 'username': 'user%d@example.com' % i, 'domain': 'example.com',
+              'type': 'federatedID', 'groups': ['group1'] if i % 2 else []} for i in range(10)]
+    server = FakeUmapi('org_id@AdobeOrg', users, ['group1', 'group2'])
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def async_connector(fake_umapi):
+    def make_connection(**kwargs):
+        return Connection(org_id=kwargs['org_id'], auth=umapi_client.auth.Auth('api_key', 'token'),
+                          user_management_endpoint=fake_umapi.url, user_agent=kwargs['user_agent'],
+                          retry_max_attempts=3, retry_first_delay=0, retry_random_delay=0,
+                          throttle_actions=kwargs['throttle_actions'])
+
+    def _async_connector(**server_options):
+        options = {
+            'server': dict(backend='asyncio', **server_options),
+            'enterprise': {
+                'org_id': fake_umapi.org_id,
+                'client_id': 'client_id',
+                'client_secret': 'client_secret',
+                'tech_acct_id': 'tech_acct_id',
+                'priv_key_data': 'private_key_data',
+            },
+        }
+        with mock.patch('user_sync.connector.umapi.umapi_client.Connection', side_effect=make_connection):
+            connector = UmapiConnector('', options)
+        connector.logger = mock.MagicMock()
+        return connector
+    return _async_connector
+
+
+@pytest.mark.parametrize('prefetch_pages', [0, 2, 10])
+def test_iter_users(async_connector, prefetch_pages):
+    connector = async_connector(prefetch_pages=prefetch_pages)
+    assert sorted(u['email'] for u in connector.iter_users()) == sorted('user%d@example.com' % i for i in range(10))
+    assert sorted(u['email'] for u in connector.iter_users(in_group='group1')) == \
+        sorted('user%d@example.com' % i for i in range(1, 10, 2))
+
+
+def test_groups(async_connector, fake_umapi):
+    connector = async_connector()
+    connector.create_group('group3')
+    assert [g['groupName'] for g in connector.iter_groups()] == ['group1', 'group2', 'group3']
+
+
+def test_actions(async_connector, fake_umapi):
+    connector = async_connector(workers=4, batch_size=2)
+    results = []
+    for i in range(10):
+        commands = Commands(identity_type='federatedID', email='user%d@example.com' % i,
+                            username='user%d@example.com' % i)
+        commands.add_groups(['group2'])
+        commands.remove_groups(['group1'])
+        connector.send_commands(commands, lambda result: results.append(result['is_success']))
+    commands = Commands(identity_type='federatedID', email='nobody@example.com', username='nobody@example.com')
+    commands.add_groups(['group2'])
+    connector.send_commands(commands, lambda result: results.append(result['is_success']))
+    connector.flush()
+    assert sorted(results) == [False] + [True] * 10
+    assert connector.get_action_manager().get_statistics() == (11, 1)
+    assert all(u['groups'] == ['group2'] for u in fake_umapi.users.values())
+
+
+def test_retry_after_throttling(async_connector, fake_umapi):
+    connector = async_connector()
+    fake_umapi.throttled_responses = [(429, {'Retry-After': '0'})]
+    assert len(list(connector.iter_users())) == 10
+    fake_umapi.throttled_responses = [(503, {})] * 3
+    with pytest.raises(AssertionException):
+        list(connector.iter_users())
@@ -0,0 +1,124 @@
+from unittest import mock
+
+import pytest
+import umapi_client
+
+from user_sync.connector.umapi import ActionManager, Commands, UmapiConnector
+from user_sync.connector.umapi_journal import ActionJournal
+from user_sync.error import AssertionException
+
+
+def make_action(action_manager, username):
+    commands = Commands(identity_type='federatedID', email=username, username=username)
+    commands.add_groups({'group1'})
+    return action_manager.create_action(commands)
+
+
+@pytest.fixture
+def journal(tmpdir):
+    return ActionJournal(str(tmpdir), 'org_id', mock.MagicMock())
+
+
+def test_pending_actions(journal, tmpdir):
+    connection = mock.MagicMock()
+    sent_batches = []
+
+    def execute(actions, immediate=True):
+        sent_batches.append(actions)
+        if len(sent_batches) == 2:
+            raise umapi_client.BatchError([Exception('bad response')], 0, len(actions), 0)
+        actions[0].report_command_error({'index': 0, 'step': 0, 'errorCode': 'error', 'message': 'error'})
+        return 0, len(actions), len(actions) - 1
+
+    connection.execute_multiple.side_effect = execute
+    action_manager = ActionManager(connection, 'org_id', mock.MagicMock(), batch_size=2, journal=journal)
+    for i in range(5):
+        action_manager.add_action(make_action(action_manager, 'user%d@example.com' % i))
+    action_manager.flush()
+    # the actions in the batch with a batch error can't be acknowledged
+    pending = ActionJournal(str(tmpdir), 'org_id', mock.MagicMock()).read_pending()
+    assert [a['user'] for a in pending] == ['user2@example.com', 'user3@example.com']
+
+    # a torn last record is ignored
+    with open(journal.path, 'a') as f:
+        f.write('{"type": "ack", "id": ')
+    assert len(ActionJournal(str(tmpdir), 'org_id', mock.MagicMock()).read_pending()) == 2
+
+
+def test_new_journal_replaces_old(journal, tmpdir):
+    action_manager = ActionManager(mock.MagicMock(), 'org_id', mock.MagicMock(), journal=journal)
+    action_manager.add_action(make_action(action_manager, 'user0@example.com'))
+    journal.sync()
+    new_journal = ActionJournal(str(tmpdir), 'org_id', mock.MagicMock())
+    new_journal.write_action(make_action(action_manager, 'user1@example.com'))
+    new_journal.sync()
+    assert [a['user'] for a in new_journal.read_pending()] == ['user1@example.com']
+
+
+def test_new_run_starts_a_new_journal(journal, tmpdir):
+    action_manager = ActionManager(mock.MagicMock(), 'org_id', mock.MagicMock(), journal=journal)
+    journal.write_action(make_action(action_manager, 'user0@example.com'))
+    journal.close()
+    # a run that sends nothing still leaves nothing to resume
+    new_journal = ActionJournal(str(tmpdir), 'org_id', mock.MagicMock())
+    new_journal.start()
+    new_journal.close()
+    assert new_journal.read_pending() == []
+
+
+def test_no_journal_in_test_mode(tmpdir):
+    options = {
+        'test_mode': True,
+        'journal': {'directory': str(tmpdir)},
+        'enterprise': {
+            'org_id': 'org_id',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'tech_acct_id': 'tech_acct_id',
+            'priv_key_data': 'private_key_data',
+        },
+    }
+    with mock.patch('user_sync.connector.umapi.umapi_client.Connection'):
+        connector = UmapiConnector('', options)
+    connector.connection.execute_multiple.side_effect = lambda actions, immediate=True: (0, len(actions), len(actions))
+    connector.start_journal()
+    commands = Commands(identity_type='federatedID', email='user0@example.com', username='user0@example.com')
+    commands.remove_groups({'group1'})
+    connector.send_commands(commands)
+    connector.flush()
+    assert tmpdir.listdir() == []
+
+
+def test_connector_replays_journal(tmpdir):
+    options = {
+        'journal': {'directory': str(tmpdir)},
+        'enterprise': {
+            'org_id': 'org_id',
+            'client_id': 'client_id',
+            'client_secret': 'client_secret',
+            'tech_acct_id': 'tech_acct_id',
+            'priv_key_data': 'private_key_data',
+        },
+    }
+    with mock.patch('user_sync.connector.umapi.umapi_client.Connection'):
+        connector = UmapiConnector('', options)
+    connection = connector.connection
+    connection.execute_multiple.side_effect = umapi_client.UnavailableError(3, 30, None)
+    for i in range(3):
+        commands = Commands(identity_type='federatedID', email='user%d@example.com' % i,
+                            username='user%d@example.com' % i)
+        commands.remove_groups({'group1'})
+        connector.send_commands(commands)
+    with pytest.raises(AssertionException):
+        connector.flush()
+
+    with mock.patch('user_sync.connector.umapi.umapi_client.Connection'):
+        connector = UmapiConnector('', options)
+    sent = []
+    connector.connection.execute_multiple.side_effect = \
+        lambda actions, immediate=True: sent.extend(a.wire_dict() for a in actions) or (0, len(actions), len(actions))
+    assert connector.replay_journal() == 3
+    connector.flush()
+    assert [a['user'] for a in sent] == ['user%d@example.com' % i for i in range(3)]
+    assert sent[0]['do'] == [{'remove': {'group': ['group1']}}]
+    assert ActionJournal(str(tmpdir), 'org_id', mock.MagicMock()).read_pending() == []
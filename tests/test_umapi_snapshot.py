@@ -0,0 +1,109 @@
+import json
+import time
+from unittest import mock
+
+import pytest
+import umapi_client
+
+from user_sync.connector.umapi_snapshot import UserSnapshot
+
+
+@pytest.fixture
+def example_users():
+    return [
+        {'email': 'user1@example.com', 'username': 'user1@example.com', 'domain': 'example.com',
+         'type': 'federatedID', 'firstname': 'One', 'groups': ['Group A']},
+        {'email': 'user2@example.com', 'username': 'user2', 'domain': 'example.com',
+         'type': 'federatedID', 'firstname': 'Two', 'groups': ['Group A', 'Group B']},
+    ]
+
+
+@pytest.fixture
+def snapshot(tmpdir):
+    def _snapshot(refresh_runs=0, max_age_hours=24):
+        return UserSnapshot(str(tmpdir), 'org_id@AdobeOrg', refresh_runs, max_age_hours, mock.MagicMock())
+    return _snapshot
+
+
+def refresh(snapshot, users):
+    snapshot.begin_refresh()
+    for user in users:
+        snapshot.set_user(dict(user))
+    snapshot.end_refresh()
+    snapshot.save()
+
+
+def test_refresh_and_load(snapshot, example_users):
+    refresh(snapshot(), example_users)
+    loaded = snapshot()
+    assert loaded.load()
+    assert loaded.is_current()
+    assert sorted(u['email'] for u in loaded.iter_users()) == ['user1@example.com', 'user2@example.com']
+    assert [u['email'] for u in loaded.iter_users(in_group='group b')] == ['user2@example.com']
+
+
+def test_refresh_schedule(snapshot, example_users):
+    refresh(snapshot(), example_users)
+    for _ in range(2):
+        loaded = snapshot(refresh_runs=3)
+        assert loaded.load()
+        loaded.save()
+    assert not snapshot(refresh_runs=3).load()
+
+    with open(loaded.path) as f:
+        content = json.load(f)
+    content['refreshed'] = time.time() - 25 * 3600
+    with open(loaded.path, 'w') as f:
+        json.dump(content, f)
+    assert not snapshot().load()
+    assert snapshot(max_age_hours=0).load()
+
+
+def test_unsaved_partial_refresh(snapshot, example_users):
+    partial = snapshot()
+    partial.begin_refresh()
+    partial.set_user(example_users[0])
+    partial.save()
+    assert not snapshot().load()
+
+
+def test_apply_actions(snapshot, example_users):
+    refresh(snapshot(), example_users)
+    loaded = snapshot()
+    loaded.load()
+
+    create = umapi_client.UserAction('federatedID', 'user3@example.com')
+    create.create(first_name='Three', country='US')
+    create.add_to_groups(groups=['Group B'])
+    loaded.apply_action(create)
+
+    update = umapi_client.UserAction('federatedID', None, 'user2', 'example.com')
+    update.update(first_name='Second')
+    update.remove_from_groups(groups=['group a'])
+    loaded.apply_action(update)
+
+    remove = umapi_client.UserAction('federatedID', 'user1@example.com')
+    remove.remove_from_organization()
+    loaded.apply_action(remove)
+    loaded.save()
+
+    reloaded = snapshot()
+    assert reloaded.load()
+    users = {u['email']: u for u in reloaded.iter_users()}
+    assert sorted(users) == ['user2@example.com', 'user3@example.com']
+    assert users['user2@example.com']['firstname'] == 'Second'
+    assert users['user2@example.com']['groups'] == ['Group B']
+    assert users['user3@example.com']['groups'] == ['Group B']
+    assert users['user3@example.com']['type'] == 'federatedID'
+
+
+def test_unknown_user_marks_stale(snapshot, example_users):
+    refresh(snapshot(), example_users)
+    loaded = snapshot()
+    loaded.load()
+    action = umapi_client.UserAction('federatedID', 'nobody@example.com')
+    action.add_to_groups(groups=['Group A'])
+    loaded.apply_action(action)
+    assert not loaded.is_current()
+    loaded.save()
+    assert not snapshot().load()
@@ -0,0 +1,112 @@
+import datetime as dt
+import os
+from unittest import mock
+
+import pytest
+
+from user_sync.connector.umapi_util import ConnectionFactory, RateLimiter, TokenCache
+
+
+@pytest.fixture
+def auth_dict():
+    return {
+        'org_id': 'org_id@AdobeOrg',
+        'tech_acct_id': 'tech_acct_id@techacct.adobe.com',
+        'api_key': 'api_key',
+        'client_secret': 'client_secret',
+        'private_key_data': 'private_key_data',
+    }
+
+
+@pytest.fixture
+def access_requests():
+    tokens = iter('token%d' % i for i in range(10))
+    requests = []
+
+    def make_access_request(endpoint, api_key, client_secret, jwt_token, ssl_verify):
+        request = mock.MagicMock()
+        request.side_effect = lambda: next(tokens)
+        request.expiry = dt.datetime.now() + dt.timedelta(hours=24)
+        requests.append(request)
+        return request
+
+    with mock.patch('umapi_client.auth.JWT'), \
+            mock.patch('umapi_client.auth.AccessRequest', side_effect=make_access_request):
+        yield requests
+
+
+def test_token_cache_reuses_token(tmpdir, auth_dict, access_requests):
+    cache = TokenCache(str(tmpdir), 4, mock.MagicMock())
+    auth = cache.get_auth(auth_dict, 'ims-host', '/ims/exchange/jwt', True)
+    assert auth.access_token == 'token0'
+    assert len(os.listdir(str(tmpdir))) == 1
+    with open(cache.get_path(auth_dict, 'ims-host')) as f:
+        assert 'token0' not in f.read()
+
+    auth = TokenCache(str(tmpdir), 4, mock.MagicMock()).get_auth(auth_dict, 'ims-host', '/ims/exchange/jwt', True)
+    assert auth.access_token == 'token0'
+    assert len(access_requests) == 1
+
+
+def test_token_cache_refreshes_token(tmpdir, auth_dict, access_requests):
+    TokenCache(str(tmpdir), 4, mock.MagicMock()).get_auth(auth_dict, 'ims-host', '/ims/exchange/jwt', True)
+    # the cached token expires too soon
+    auth = TokenCache(str(tmpdir), 25, mock.MagicMock()).get_auth(auth_dict, 'ims-host', '/ims/exchange/jwt', True)
+    assert auth.access_token == 'token1'
+    # the cached token was encrypted with another secret
+    auth_dict['client_secret'] = 'new_secret'
+    auth = TokenCache(str(tmpdir), 4, mock.MagicMock()).get_auth(auth_dict, 'ims-host', '/ims/exchange/jwt', True)
+    assert auth.access_token == 'token2'
+
+
+def test_connection_factory_shares_session(auth_dict):
+    factory = ConnectionFactory()
+    with mock.patch('umapi_client.Connection') as connection_class:
+        connection_class.side_effect = lambda **kwargs: mock.MagicMock(session=mock.MagicMock(headers={}))
+        connections = [factory.make_connection(auth_dict, 'ims-host', '/ims/exchange/jwt', None, pool_size,
+                                               org_id=auth_dict['org_id'])
+                       for pool_size in (1, 4, 2)]
+    assert connections[0].session is connections[1].session is connections[2].session
+    assert factory.pool_size == 4
+
+
+@pytest.fixture
+def clock():
+    now = [1000.0]
+    with mock.patch('user_sync.connector.umapi_util.time.time', side_effect=lambda: now[0]):
+        yield now
+
+
+def test_rate_limiter_paces_calls(clock):
+    limiter = RateLimiter(2, 3, mock.MagicMock())
+    assert [limiter.reserve() for _ in range(5)] == [0, 0, 0, 0.5, 1.0]
+    clock[0] += 10
+    assert limiter.reserve() == 0
+    assert limiter.get_statistics() == (2, 2, 6, 0, 1.5)
+
+
+def test_rate_limiter_adapts(clock):
+    limiter = RateLimiter(8, 2, mock.MagicMock())
+    limiter.report(429, 5)
+    assert limiter.rate == 4
+    assert limiter.reserve() == 5
+    for _ in range(50):
+        limiter.report(200)
+    assert limiter.rate == 8
+    for _ in range(10):
+        limiter.report(429)
+    assert limiter.rate == 0.5
+    assert limiter.get_statistics()[3] == 11
+
+
+def test_rate_limited_session(clock):
+    limiter = RateLimiter(1, 1, mock.MagicMock())
+    session = ConnectionFactory(limiter).get_session(2)
+    response = mock.MagicMock(status_code=429, headers={'Retry-After': '30'})
+    with mock.patch('requests.adapters.HTTPAdapter.send', return_value=response), \
+            mock.patch('user_sync.connector.umapi_util.time.sleep') as sleep:
+        adapter = session.get_adapter('https://usermanagement.adobe.io')
+        for page in range(2):
+            adapter.send(mock.MagicMock())
+    assert sleep.call_args_list == [mock.call(30)]
+    assert limiter.get_statistics()[2:4] == (2, 2)
@@ -39,7 +39,7 @@ import user_sync.connector.directory_okta
 import user_sync.connector.directory_csv
 import user_sync.connector.directory_adobe_console
 import user_sync.connector.umapi
-import user_sync.connector.umapi
+import user_sync.connector.umapi_util
 import user_sync.encryption
 import user_sync.helper
 import user_sync.lockfile
@@ -128,10 +128,11 @@ def main():
 @click.option('--adobe-users',
               help="specify the adobe users to pull from UMAPI. Legal values are 'all' (the default), "
                    "'group names' (one or more specified groups), 'mapped' (all groups listed in "
-                   "the configuration file)",
+                   "the configuration file), 'auto' (the same users as 'mapped', read either group by group "
+                   "or with a single read of all users, whichever is estimated to take fewer pages)",
               cls=user_sync.cli.OptionMulti,
               type=list,
-              metavar='all|mapped|group [group list]')
+              metavar='all|mapped|auto|group [group list]')
 @click.option('--connector',
               help='specify a connector to use; default is LDAP (or CSV if --users file is specified)',
               cls=user_sync.cli.OptionMulti,
@@ -143,6 +144,9 @@ def main():
               help='if membership in mapped groups differs between the enterprise directory and Adobe sides, '
                    'the group membership is updated on the Adobe side so that the memberships in mapped '
                    'groups match those on the enterprise directory side.')
+@click.option('--resume-journal/--no-resume-journal', default=None,
+              help='instead of syncing, send the UMAPI actions that an earlier run journaled but never completed '
+                   '(this needs a journal directory in the UMAPI connector configuration).')
 @click.option('--strategy',
               help="whether to fetch and sync the Adobe directory against the customer directory "
                    "or just to push each customer user to the Adobe side.  Default is to fetch and sync.",
@@ -422,7 +426,9 @@ def begin_work(config_loader):
 
     config_loader.check_unused_config_keys()
 
-    if directory_connector is not None and directory_connector_options is not None:
+    # a resumed run doesn't read the directory
+    if directory_connector is not None and directory_connector_options is not None \
+            and not rule_config['resume_journal']:
         # specify the default user_identity_type if it's not already specified in the options
         if 'user_identity_type' not in directory_connector_options:
             directory_connector_options['user_identity_type'] = rule_config['new_account_type']
@@ -439,15 +445,24 @@ def begin_work(config_loader):
             raise AssertionException(
                 "Failed to enable dynamic group mappings. 'dynamic_group_member_attribute' is not defined in config")
     primary_name = '.primary' if secondary_umapi_configs else ''
-    umapi_primary_connector = user_sync.connector.umapi.UmapiConnector(primary_name, primary_umapi_config)
+    rate_limiter = None
+    if rule_config['umapi_requests_per_second']:
+        rate_limiter = user_sync.connector.umapi_util.RateLimiter(rule_config['umapi_requests_per_second'],
+                                                                  rule_config['umapi_burst'], logger)
+    connection_factory = user_sync.connector.umapi_util.ConnectionFactory(rate_limiter)
+    umapi_primary_connector = user_sync.connector.umapi.UmapiConnector(primary_name, primary_umapi_config,
+                                                                       connection_factory)
     umapi_other_connectors = {}
     for secondary_umapi_name, secondary_config in six.iteritems(secondary_umapi_configs):
         umapi_secondary_conector = user_sync.connector.umapi.UmapiConnector(".secondary.%s" % secondary_umapi_name,
-                                                                            secondary_config)
+                                                                            secondary_config, connection_factory)
         umapi_other_connectors[secondary_umapi_name] = umapi_secondary_conector
     umapi_connectors = user_sync.rules.UmapiConnectors(umapi_primary_connector, umapi_other_connectors)
 
     rule_processor = user_sync.rules.RuleProcessor(rule_config)
+    if rule_config['resume_journal']:
+        rule_processor.resume_journal(umapi_connectors)
+        return
     if len(directory_groups) == 0 and rule_processor.will_process_groups():
         logger.warning('No group mapping specified in configuration but --process-groups requested on command line')
     rule_processor.run(directory_groups, directory_connector, umapi_connectors)
@@ -55,6 +55,7 @@ class ConfigLoader(object):
         'encoding_name': 'utf8',
         'exclude_unmapped_users': False,
         'process_groups': False,
+        'resume_journal': False,
         'strategy': 'sync',
         'test_mode': False,
         'update_user_info': False,
@@ -240,6 +241,10 @@ class ConfigLoader(object):
                 options['adobe_group_mapped'] = False
             elif adobe_users_action == 'mapped':
                 options['adobe_group_mapped'] = True
+            elif adobe_users_action == 'auto':
+                # the users in mapped groups, read whichever way is estimated to be cheaper
+                options['adobe_group_mapped'] = True
+                options['adobe_users_auto'] = True
             elif adobe_users_action == 'group':
                 if len(adobe_users_spec) != 2:
                     raise AssertionException(
@@ -551,6 +556,17 @@ class ConfigLoader(object):
                     raise AssertionException(validation_message)
                 exclude_groups.append(group.get_group_name())
             options['exclude_groups'] = exclude_groups
+        secondary_fetch = adobe_config.get_string('secondary_fetch', True)
+        if secondary_fetch is not None:
+            if secondary_fetch not in ('full', 'restricted'):
+                raise AssertionException("secondary_fetch must be 'full' or 'restricted' (got '%s')" % secondary_fetch)
+            options['secondary_fetch'] = secondary_fetch
+        targeted_lookups = adobe_config.get_string('targeted_lookups', True)
+        if targeted_lookups is not None:
+            if targeted_lookups not in ('auto', 'always', 'never'):
+                raise AssertionException("targeted_lookups must be 'auto', 'always' or 'never' (got '%s')" %
+                                         targeted_lookups)
+            options['targeted_lookups'] = targeted_lookups
 
         # get the limits
         limits_config = self.main_config.get_dict_config('limits')
@@ -567,6 +583,21 @@ class ConfigLoader(object):
                 options['max_adobe_only_users'] = int(max_missing)
             except ValueError:
                 raise AssertionException("Unable to parse max_adobe_only_users value. Value must be a percentage or an integer.")
+        requests_per_second = limits_config.get_value('umapi_requests_per_second', (int, float), True)
+        if requests_per_second is not None:
+            if requests_per_second < 0:
+                raise AssertionException("umapi_requests_per_second must not be negative")
+            options['umapi_requests_per_second'] = requests_per_second
+        burst = limits_config.get_int('umapi_burst', True)
+        if burst is not None:
+            if burst < 1:
+                raise AssertionException("umapi_burst must be at least 1")
+            options['umapi_burst'] = burst
+        secondary_parallelism = limits_config.get_int('secondary_parallelism', True)
+        if secondary_parallelism is not None:
+            if secondary_parallelism < 1:
+                raise AssertionException("secondary_parallelism must be at least 1")
+            options['secondary_parallelism'] = secondary_parallelism
 
         # now get the directory extension, if any
         extension_config = self.get_directory_extension_options()
@@ -902,7 +933,10 @@ class ConfigFileLoader:
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
     SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
-                            '/integration/priv_key_path': (True, False, None)}
+                            '/integration/priv_key_path': (True, False, None),
+                            '/snapshot/directory': (False, False, None),
+                            '/token_cache/directory': (False, False, None),
+                            '/journal/directory': (False, False, None)}
 
     @classmethod
     def load_root_config(cls, filename):
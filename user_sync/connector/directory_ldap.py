@@ -420,7 +420,7 @@ class LDAPDirectoryConnector(object):
                     extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
                     source_attributes[extended_attribute] = extended_attribute_value
 
-            user['source_attributes'] = source_attributes.copy()
+            user['source_attributes'] = source_attributes
             if 'groups' not in user:
                 user['groups'] = []
             self.user_by_dn[dn] = user
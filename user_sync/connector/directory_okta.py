@@ -286,7 +286,7 @@ class OktaDirectoryConnector(object):
                 extended_attribute_value = OKTAValueFormatter.get_profile_value(record, extended_attribute)
                 source_attributes[extended_attribute] = extended_attribute_value
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
     def iter_search_result(self, filter_string, attributes):
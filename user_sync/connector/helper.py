@@ -19,6 +19,7 @@
 # SOFTWARE.
 
 import logging
+from collections.abc import Mapping, MutableMapping
 
 
 def create_logger(options):
@@ -29,21 +30,200 @@ def create_logger(options):
     if logger_name is None:
         logger_name = 'connector'
     return logging.getLogger(logger_name)
-     
+
 
 def create_blank_user():
     """
-    :rtype dict
-    """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
-    return user
+    :rtype DirectoryUser
+    """
+    return DirectoryUser()
+
+
+# the index (attribute name -> position) for each distinct list of source attribute names, shared by
+# all the users whose source attributes have those names
+_source_index_by_names = {}
+
+# the value of a DirectoryUser field that isn't set
+_MISSING = object()
+
+# the number of strings in each generation of the share_string cache
+SHARED_STRING_CACHE_SIZE = 1 << 16
+
+# one copy of each recently seen string value.  When the current generation is full, it becomes the
+# previous one, whose strings are moved back to the current one as they are seen again, so values that
+# many users have stay shared and values unique to one user age out.
+_shared_strings = {}
+_previous_shared_strings = {}
+
+
+def share_string(value):
+    """
+    Give back one shared copy of a string value that many directory users may have (a country, a
+    department, a first name), so each user doesn't keep its own copy.
+    :param value: a string, or any other value (returned as it is)
+    """
+    global _shared_strings, _previous_shared_strings
+    if type(value) is not str:
+        return value
+    shared = _shared_strings.get(value)
+    if shared is None:
+        shared = _previous_shared_strings.get(value, value)
+        if len(_shared_strings) >= SHARED_STRING_CACHE_SIZE:
+            _previous_shared_strings, _shared_strings = _shared_strings, {}
+        _shared_strings[shared] = shared
+    return shared
+
+
+class SourceAttributes(Mapping):
+    """
+    The source attributes of a directory user, as a read-only mapping.  The attribute names are shared
+    by all the users read with the same settings, so each user only keeps a tuple of values, and string
+    values are shared between users (see share_string).  copy() gives an ordinary dict, for callers that
+    need one.
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, attributes):
+        """
+        :type attributes: dict
+        """
+        if type(attributes) is SourceAttributes:
+            self._index = attributes._index
+            self._values = attributes._values
+            return
+        names = tuple(attributes)
+        index = _source_index_by_names.get(names)
+        if index is None:
+            index = _source_index_by_names.setdefault(names, {name: i for i, name in enumerate(names)})
+        self._index = index
+        if type(attributes) is dict:
+            self._values = tuple(map(share_string, attributes.values()))
+        else:
+            self._values = tuple(share_string(attributes[name]) for name in names)
+
+    def __getitem__(self, name):
+        return self._values[self._index[name]]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
 
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        return dict(zip(self._index, self._values))
+
+
+class DirectoryUser(MutableMapping):
+    """
+    A user read from a directory.  It has the keys (and dict interface) of the user dicts that connectors
+    used to build, so rules, extensions and the after-mapping hook can use it the same way, but it keeps
+    the standard attributes in slots, shares the values that repeat across many users, and keeps the
+    source attributes as a SourceAttributes.  Fields that aren't set hold _MISSING, so reading a field
+    never raises and catches AttributeError.  Other keys set by connectors (e.g. uid) go in a dict that
+    is only created when needed.
+    """
+    FIELDS = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+              'member_groups', 'source_attributes')
+    SHARED_FIELDS = frozenset(('identity_type', 'domain', 'country', 'firstname', 'lastname'))
+    __slots__ = FIELDS + ('_extras',)
+
+    _field_names = frozenset(FIELDS)
+
+    def __init__(self):
+        self.identity_type = None
+        self.username = None
+        self.domain = None
+        self.firstname = None
+        self.lastname = None
+        self.email = None
+        self.groups = []
+        self.country = None
+        self.member_groups = _MISSING
+        self.source_attributes = _MISSING
+        self._extras = None
+
+    def __getitem__(self, key):
+        if key in self._field_names:
+            value = getattr(self, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        if self._extras is None:
+            raise KeyError(key)
+        return self._extras[key]
+
+    def get(self, key, default=None):
+        if key in self._field_names:
+            value = getattr(self, key)
+            return default if value is _MISSING else value
+        if self._extras is None:
+            return default
+        return self._extras.get(key, default)
+
+    def __setitem__(self, key, value):
+        if key in self._field_names:
+            if key in self.SHARED_FIELDS:
+                value = share_string(value)
+            elif key == 'source_attributes' and value is not None:
+                value = SourceAttributes(value)
+            setattr(self, key, value)
+        else:
+            if self._extras is None:
+                self._extras = {}
+            self._extras[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_names:
+            if getattr(self, key) is _MISSING:
+                raise KeyError(key)
+            setattr(self, key, _MISSING)
+            return
+        if self._extras is None:
+            raise KeyError(key)
+        del self._extras[key]
+
+    def __contains__(self, key):
+        if key in self._field_names:
+            return getattr(self, key) is not _MISSING
+        return self._extras is not None and key in self._extras
+
+    def __iter__(self):
+        for name in self.FIELDS:
+            if getattr(self, name) is not _MISSING:
+                yield name
+        if self._extras is not None:
+            for key in list(self._extras):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        # _MISSING can't be pickled or copied, so rebuild the user from its items
+        return _rebuild_directory_user, (list(self.items()),)
+
+    def copy(self):
+        """
+        :return: a shallow copy, like dict.copy()
+        """
+        return _rebuild_directory_user(self.items())
+
+
+def _rebuild_directory_user(items):
+    user = DirectoryUser.__new__(DirectoryUser)
+    for name in DirectoryUser.FIELDS:
+        setattr(user, name, _MISSING)
+    user._extras = None
+    for key, value in items:
+        user[key] = value
+    return user
@@ -18,14 +18,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import collections
 import json
 import logging
 # import helper
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import jwt
 import six
 import umapi_client
+from six.moves import queue
 
 import user_sync.connector.helper
 import user_sync.config
@@ -33,7 +38,10 @@ import user_sync.helper
 import user_sync.identity_type
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
-from user_sync.connector.umapi_util import make_auth_dict
+from user_sync.connector.umapi_util import ConnectionFactory, TokenCache, make_auth_dict
+from user_sync.connector.umapi_snapshot import UserSnapshot
+from user_sync.connector.umapi_async import AsyncUmapiBackend
+from user_sync.connector.umapi_journal import ActionJournal
 
 try:
     from jwt.contrib.algorithms.pycrypto import RSAAlgorithm
@@ -41,12 +49,28 @@ try:
 except:
     pass
 
+# UMAPI accepts at most this many actions in the body of a single call
+UMAPI_MAX_ACTIONS_PER_CALL = 10
+# the connection splits actions with more commands than this, and commands that list more users than this
+UMAPI_MAX_COMMANDS_PER_ACTION = 10
+UMAPI_MAX_USERS_PER_COMMAND = 10
+# the default number of actions that can be queued (but not yet completed) in an action manager at once
+DEFAULT_MAX_QUEUED_ACTIONS = 10000
+# the ways UMAPI calls can be made: by umapi_client itself, or from an asyncio event loop
+UMAPI_BACKENDS = ('sync', 'asyncio')
+# the number of users whose commands are held in a connector (to be merged with later commands) before sending
+MAX_PENDING_COMMANDS = 1000
+# the number of group-scoped user reads (or single-user lookups) that are run at once
+MAX_CONCURRENT_QUERIES = 8
+
 
 class UmapiConnector(object):
-    def __init__(self, name, caller_options):
+    def __init__(self, name, caller_options, connection_factory=None):
         """
         :type name: str
         :type caller_options: dict
+        :param connection_factory: shared by the connectors in a run, so they share HTTP connections
+        :type connection_factory: ConnectionFactory
         """
         self.name = 'umapi' + name
         caller_config = user_sync.config.DictConfig(self.name + ' configuration', caller_options)
@@ -67,7 +91,51 @@ class UmapiConnector(object):
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
         server_builder.set_bool_value('ssl_verify', True)
+        server_builder.set_int_value('batch_size', UMAPI_MAX_ACTIONS_PER_CALL)
+        server_builder.set_int_value('workers', 1)
+        server_builder.set_int_value('prefetch_pages', 0)
+        server_builder.set_int_value('group_action_threshold', 0)
+        server_builder.set_string_value('backend', 'sync')
+        server_builder.set_int_value('max_queued_actions', DEFAULT_MAX_QUEUED_ACTIONS)
         options['server'] = server_options = server_builder.get_options()
+        batch_size = server_options['batch_size']
+        if not 1 <= batch_size <= UMAPI_MAX_ACTIONS_PER_CALL:
+            raise AssertionException("%s: server batch_size must be between 1 and %d (got %d)" %
+                                     (self.name, UMAPI_MAX_ACTIONS_PER_CALL, batch_size))
+        workers = server_options['workers']
+        if workers < 1:
+            raise AssertionException("%s: server workers must be at least 1 (got %d)" % (self.name, workers))
+        if server_options['prefetch_pages'] < 0:
+            raise AssertionException("%s: server prefetch_pages must not be negative (got %d)" %
+                                     (self.name, server_options['prefetch_pages']))
+        if server_options['group_action_threshold'] < 0:
+            raise AssertionException("%s: server group_action_threshold must not be negative (got %d)" %
+                                     (self.name, server_options['group_action_threshold']))
+
+        if server_options['max_queued_actions'] < 1:
+            raise AssertionException("%s: server max_queued_actions must be at least 1 (got %d)" %
+                                     (self.name, server_options['max_queued_actions']))
+        if server_options['backend'] not in UMAPI_BACKENDS:
+            raise AssertionException("%s: server backend must be one of %s (got '%s')" %
+                                     (self.name, ', '.join(UMAPI_BACKENDS), server_options['backend']))
+
+        snapshot_config = caller_config.get_dict_config('snapshot', True)
+        snapshot_builder = user_sync.config.OptionsBuilder(snapshot_config)
+        snapshot_builder.set_string_value('directory', None)
+        snapshot_builder.set_int_value('refresh_runs', 0)
+        snapshot_builder.set_int_value('max_age_hours', 24)
+        options['snapshot'] = snapshot_options = snapshot_builder.get_options()
+
+        journal_config = caller_config.get_dict_config('journal', True)
+        journal_builder = user_sync.config.OptionsBuilder(journal_config)
+        journal_builder.set_string_value('directory', None)
+        options['journal'] = journal_options = journal_builder.get_options()
+
+        token_cache_config = caller_config.get_dict_config('token_cache', True)
+        token_cache_builder = user_sync.config.OptionsBuilder(token_cache_config)
+        token_cache_builder.set_string_value('directory', None)
+        token_cache_builder.set_int_value('min_remaining_hours', 4)
+        options['token_cache'] = token_cache_options = token_cache_builder.get_options()
 
         enterprise_config = caller_config.get_dict_config('enterprise')
         enterprise_builder = user_sync.config.OptionsBuilder(enterprise_config)
@@ -79,6 +147,12 @@ class UmapiConnector(object):
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         if server_config:
             server_config.report_unused_values(logger)
+        if snapshot_config:
+            snapshot_config.report_unused_values(logger)
+        if journal_config:
+            journal_config.report_unused_values(logger)
+        if token_cache_config:
+            token_cache_config.report_unused_values(logger)
         logger.debug('UMAPI initialized with options: %s', options)
 
         ims_host = server_options['ims_host']
@@ -89,56 +163,442 @@ class UmapiConnector(object):
         # open the connection
         um_endpoint = "https://" + server_options['host'] + server_options['endpoint']
         logger.debug('%s: creating connection for org %s at endpoint %s', self.name, org_id, um_endpoint)
+        token_cache = None
+        if token_cache_options['directory']:
+            token_cache = TokenCache(token_cache_options['directory'], token_cache_options['min_remaining_hours'],
+                                     logger)
+        if connection_factory is None:
+            connection_factory = ConnectionFactory()
+        self.rate_limiter = connection_factory.rate_limiter
+        connection_args = dict(
+            org_id=org_id,
+            user_management_endpoint=um_endpoint,
+            test_mode=options['test_mode'],
+            user_agent="user-sync/" + app_version,
+            logger=self.logger,
+            timeout_seconds=float(server_options['timeout']),
+            retry_max_attempts=server_options['retries'] + 1,
+            ssl_verify=server_options['ssl_verify'],
+            throttle_actions=batch_size
+        )
         try:
-            self.connection = connection = umapi_client.Connection(
-                org_id=org_id,
+            self.connection = connection = connection_factory.make_connection(
                 auth_dict=auth_dict,
                 ims_host=ims_host,
                 ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
-                user_management_endpoint=um_endpoint,
-                test_mode=options['test_mode'],
-                user_agent="user-sync/" + app_version,
-                logger=self.logger,
-                timeout_seconds=float(server_options['timeout']),
-                retry_max_attempts=server_options['retries'] + 1,
-                ssl_verify=server_options['ssl_verify']
+                token_cache=token_cache,
+                # make sure the connection pool can keep a connection open for each worker
+                pool_size=workers,
+                **connection_args
             )
+        except AssertionException:
+            raise
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
+        # concurrent queries make their own copies of the connection (see get_query_connection)
+        self.connection_factory = connection_factory
+        self.connection_args = connection_args
+        self.query_pool_size = max(workers, MAX_CONCURRENT_QUERIES, server_options['prefetch_pages'])
+        self.owner_thread = threading.current_thread()
+        self.query_connections = threading.local()
         # wrap the connection in an action manager
-        self.action_manager = ActionManager(connection, org_id, logger)
+        journal = None
+        if journal_options['directory']:
+            journal = ActionJournal(journal_options['directory'], org_id, logger, read_only=options['test_mode'])
+        self.backend = None
+        if server_options['backend'] == 'asyncio':
+            self.backend = AsyncUmapiBackend(connection, max(workers, server_options['prefetch_pages'], 1), logger,
+                                             connection_factory.rate_limiter)
+            self.action_manager = AsyncActionManager(self.backend, connection, org_id, logger, batch_size, workers,
+                                                     server_options['group_action_threshold'], journal,
+                                                     server_options['max_queued_actions'])
+        else:
+            lane_connections = None
+            if workers > 1:
+                # each worker sends on its own connection (with the same access token)
+                lane_connections = [connection] + [connection_factory.copy_connection(connection, workers,
+                                                                                      **connection_args)
+                                                   for _ in range(workers - 1)]
+            self.action_manager = ActionManager(connection, org_id, logger, batch_size, workers,
+                                                server_options['group_action_threshold'], journal,
+                                                server_options['max_queued_actions'], lane_connections)
+        # commands not yet handed to the action manager, and their callbacks, by user
+        self.pending_commands = collections.OrderedDict()
+        self.user_page_info = None
+        # the first page of users, once read to get the page info, until the full read of users takes it
+        self.first_user_page = None
+
+        self.snapshot = None
+        if snapshot_options['directory']:
+            self.snapshot = UserSnapshot(snapshot_options['directory'], org_id, snapshot_options['refresh_runs'],
+                                         snapshot_options['max_age_hours'], logger)
+            self.snapshot.load()
+
+    def get_query_connection(self):
+        """
+        A umapi_client connection isn't thread-safe, so each thread that queries UMAPI for this connector uses
+        its own copy of the connection (with the same access token).  The thread that made the connector
+        uses the connection itself.
+        :rtype umapi_client.Connection
+        """
+        if threading.current_thread() is self.owner_thread:
+            return self.connection
+        connection = getattr(self.query_connections, 'connection', None)
+        if connection is None:
+            connection = self.connection_factory.copy_connection(self.connection, self.query_pool_size,
+                                                                 **self.connection_args)
+            self.query_connections.connection = connection
+        return connection
 
     def get_users(self):
         return list(self.iter_users())
 
     def iter_users(self, in_group=None):
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.is_current():
+            self.logger.info('Reading users%s from snapshot', " in group '%s'" % in_group if in_group else '')
+            for u in snapshot.iter_users(in_group):
+                yield dict(u, groups=list(u.get('groups') or []))
+            return
+        # only a full read of the organization can refresh the snapshot
+        refresh_snapshot = snapshot is not None and not in_group
+        if refresh_snapshot:
+            snapshot.begin_refresh()
         users = {}
         total_count = 0
-        page_count = 0
-        page_size = 0
-        page_number = 0
         try:
             u_query = umapi_client.UsersQuery(self.connection, in_group=in_group)
-            for i, u in enumerate(u_query):
-                total_count, page_count, page_size, page_number = u_query.stats()
-                email = u['email']
-                if not (email in users):
-                    users[email] = u
-                    yield u
-
-                if (i + 1) % page_size == 0:
+            first_page = None
+            if not in_group:
+                first_page, self.first_user_page = self.first_user_page, None
+            for page, last_page, total_count in self.iter_query_pages(u_query, first_page):
+                for u in page:
+                    email = u['email']
+                    if not (email in users):
+                        users[email] = u
+                        if refresh_snapshot:
+                            snapshot.set_user(dict(u, groups=list(u.get('groups') or [])))
+                        yield u
+                if not last_page:
                     self.logger.progress(len(users), total_count)
             self.logger.progress(total_count, total_count)
+            if refresh_snapshot:
+                snapshot.end_refresh()
 
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def is_snapshot_current(self):
+        """
+        :return: whether users are read from the snapshot rather than from UMAPI
+        """
+        return self.snapshot is not None and self.snapshot.is_current()
+
+    def get_user_count(self):
+        """
+        :return: the number of users in the organization (from the snapshot, or from the first page of users)
+        """
+        if self.snapshot is not None and self.snapshot.is_current():
+            return self.snapshot.get_user_count()
+        return self.get_user_page_info()[0]
+
+    def get_user_page_info(self):
+        """
+        The first page of users is only read once per run; later calls return the same numbers, and a
+        full read of the users starts from the page that was read.
+        :return: tuple (number of users in the organization, number of pages of users, users per page)
+        """
+        if self.user_page_info is None:
+            try:
+                result = self.fetch_query_page(umapi_client.UsersQuery(self.connection), 0)
+            except umapi_client.UnavailableError as e:
+                raise AssertionException("Error contacting UMAPI server: %s" % e)
+            self.user_page_info = result[2], result[3], result[5]
+            self.first_user_page = result
+        return self.user_page_info
+
+    def iter_users_in_groups(self, group_names, choose_plan=False):
+        """
+        Read the users who are in any of the given groups, each of them once.  The groups are read
+        concurrently.  If choose_plan is set, the number of pages each way is estimated first, and
+        if reading the whole organization takes no more pages than reading the groups, the users
+        in the groups are picked out of a full read instead.
+        :type group_names: list(str)
+        :type choose_plan: bool
+        :return: iterator of user dicts
+        """
+        normalized_groups = {user_sync.helper.normalize_string(g) for g in group_names}
+        if not normalized_groups:
+            return
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.is_current():
+            self.logger.info('Reading users in %d groups from snapshot', len(normalized_groups))
+            for u in snapshot.iter_users():
+                if snapshot.normalize_groups(u) & normalized_groups:
+                    yield dict(u, groups=list(u.get('groups') or []))
+            return
+        if choose_plan and self.is_full_read_cheaper(normalized_groups):
+            for u in self.iter_users():
+                if {user_sync.helper.normalize_string(g) for g in u.get('groups') or []} & normalized_groups:
+                    yield u
+            return
+        unique_group_names = collections.OrderedDict()
+        for group_name in group_names:
+            unique_group_names.setdefault(user_sync.helper.normalize_string(group_name), group_name)
+        for u in self.iter_users_in_groups_concurrently(list(unique_group_names.values())):
+            yield u
+
+    def is_full_read_cheaper(self, normalized_groups):
+        """
+        Estimate the pages of users to read for the whole organization and for the given groups (from the
+        groups' member counts), and log the estimate and the choice.
+        :return: whether reading the whole organization takes no more pages than reading the groups
+        """
+        user_count, full_pages, page_size = self.get_user_page_info()
+        group_pages = self.estimate_group_read_pages(normalized_groups, page_size)
+        if group_pages is None:
+            return False
+        full_read = full_pages <= group_pages
+        self.logger.info('Estimated pages of users to read: %d for all %d users, %d for %d groups; reading %s',
+                         full_pages, user_count, group_pages, len(normalized_groups),
+                         'all users' if full_read else 'the groups')
+        return full_read
+
+    def estimate_group_read_pages(self, normalized_groups, page_size=None):
+        """
+        Estimate the pages of users to read for the given groups, from their member counts.
+        :type normalized_groups: set(str)
+        :param page_size: the number of users in a page (read from the first page of users if not given)
+        :return: the number of pages, or None if a group has no member count
+        """
+        if page_size is None:
+            page_size = self.get_user_page_info()[2]
+        page_size = page_size or 1
+        group_pages = 0
+        found_groups = set()
+        for g in self.iter_groups():
+            group_name = user_sync.helper.normalize_string(g.get('groupName'))
+            if group_name in normalized_groups:
+                if g.get('memberCount') is None:
+                    self.logger.info('No member count for group %s; it cannot be estimated', g.get('groupName'))
+                    return None
+                found_groups.add(group_name)
+                group_pages += max(1, (g['memberCount'] + page_size - 1) // page_size)
+        # groups that aren't listed (such as admin roles) still take a page to read
+        return group_pages + len(normalized_groups - found_groups)
+
+    def lookup_users(self, user_ids):
+        """
+        Look up users one at a time with UMAPI's single-user query, with several lookups in flight at once.
+        The users that aren't in the organization are skipped.
+        :param user_ids: each an email, or a tuple (username, domain) for a username that isn't an email
+        :type user_ids: iterable(str or tuple)
+        :return: iterator of user dicts
+        """
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.is_current():
+            for user_id in user_ids:
+                if isinstance(user_id, tuple):
+                    u = snapshot.find_user({'user': user_id[0], 'domain': user_id[1]})
+                else:
+                    u = snapshot.find_user({'user': user_id})
+                if u is not None:
+                    yield dict(u, groups=list(u.get('groups') or []))
+            return
+
+        def lookup(user_id):
+            connection = self.get_query_connection()
+            if isinstance(user_id, tuple):
+                return connection.query_single('user', [user_id[0]], {'domain': user_id[1]})
+            return umapi_client.UserQuery(connection, user_id).result()
+
+        executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_QUERIES)
+        lookups = collections.deque()
+
+        def iter_results():
+            for user_id in user_ids:
+                lookups.append(executor.submit(lookup, user_id))
+                if len(lookups) >= 2 * MAX_CONCURRENT_QUERIES:
+                    yield lookups.popleft().result()
+            while lookups:
+                yield lookups.popleft().result()
+
+        users = set()
+        try:
+            for u in iter_results():
+                if not u:
+                    continue
+                identity = self.get_user_identity(u)
+                if identity not in users:
+                    users.add(identity)
+                    yield u
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+        finally:
+            for future in lookups:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def iter_users_in_groups_concurrently(self, group_names):
+        """
+        Read the users in each group on its own thread, yielding each user once as the pages arrive.
+        :type group_names: list(str)
+        :return: iterator of user dicts
+        """
+        pages = queue.Queue(maxsize=2 * MAX_CONCURRENT_QUERIES)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_group(group_name):
+            try:
+                query = umapi_client.UsersQuery(self.connection, in_group=group_name)
+                for page, _, _ in self.iter_query_pages(query):
+                    if not put((page, None)):
+                        return
+            except Exception as e:
+                put((None, e))
+            else:
+                put((None, None))
+
+        executor = ThreadPoolExecutor(max_workers=min(len(group_names), MAX_CONCURRENT_QUERIES))
+        group_reads = []
+        users = set()
+        try:
+            for group_name in group_names:
+                group_reads.append(executor.submit(read_group, group_name))
+            groups_left = len(group_names)
+            while groups_left:
+                page, error = pages.get()
+                if page is None:
+                    if isinstance(error, umapi_client.UnavailableError):
+                        raise AssertionException("Error contacting UMAPI server: %s" % error)
+                    elif error is not None:
+                        raise error
+                    groups_left -= 1
+                    self.logger.progress(len(group_names) - groups_left, len(group_names), 'groups read')
+                    continue
+                for u in page:
+                    identity = self.get_user_identity(u)
+                    if identity not in users:
+                        users.add(identity)
+                        yield u
+        finally:
+            # the groups not yet being read are never read, and the readers stop at their next page
+            stopped.set()
+            for future in group_reads:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def get_user_identity(u):
+        """
+        Users can share an email (an Adobe ID and a Federated ID, for instance), so a user read more than once
+        is recognized by identity type and username (and domain, for a username that isn't an email), as
+        user keys are built.
+        :type u: dict
+        :rtype tuple
+        """
+        id_type = u.get('type')
+        username = u.get('username')
+        if id_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE or not username:
+            return id_type, user_sync.helper.normalize_string(u['email']), ''
+        username = user_sync.helper.normalize_string(username)
+        if '@' in username:
+            return id_type, username, ''
+        return id_type, username, user_sync.helper.normalize_string(u.get('domain'))
+
+    def iter_query_pages(self, query, first_page=None):
+        """
+        Fetch the pages of a multi-object query in order.  If prefetch_pages is set in the server options,
+        up to that many of the following pages are fetched in the background while each page is processed
+        (on worker threads, or on the event loop of the asyncio backend).
+        :type query: umapi_client.QueryMultiple
+        :param first_page: the result of fetch_query_page for page 0 of the query, if it was already fetched
+        :return: iterator of tuples (list of objects, whether it's the last page, total object count)
+        """
+        prefetch_pages = self.options['server']['prefetch_pages']
+        backend = self.backend
+        executor = None
+
+        def fetch_page(page_number):
+            if page_number == 0 and first_page is not None:
+                return first_page
+            return self.fetch_query_page(query, page_number)
+
+        def submit_page(page_number):
+            if backend is not None:
+                return backend.submit(backend.query_page(query.object_type, page_number, query.url_params,
+                                                         query.query_params))
+            return executor.submit(fetch_page, page_number)
+
+        if not prefetch_pages:
+            page_number = 0
+            while True:
+                values, last_page, total_count = fetch_page(page_number)[:3]
+                last_page = last_page or not values
+                yield values, last_page, total_count
+                if last_page:
+                    return
+                page_number += 1
+
+        # the first page tells us how many pages there are, so we don't fetch past the end
+        values, last_page, total_count, page_count = fetch_page(0)[:4]
+        last_page = last_page or not values
+        yield values, last_page, total_count
+        if last_page:
+            return
+        if backend is None:
+            executor = ThreadPoolExecutor(max_workers=prefetch_pages)
+        prefetched = collections.deque()
+        next_page_number = 1
+        try:
+            while True:
+                while len(prefetched) < prefetch_pages and (not page_count or next_page_number < page_count):
+                    prefetched.append(submit_page(next_page_number))
+                    next_page_number += 1
+                if not prefetched:
+                    return
+                values, last_page = prefetched.popleft().result()[:2]
+                last_page = last_page or not values
+                yield values, last_page, total_count
+                if last_page:
+                    return
+        finally:
+            for future in prefetched:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def fetch_query_page(self, query, page_number):
+        """
+        :type query: umapi_client.QueryMultiple
+        :return: tuple (values, last page?, total count, page count, page number, page size)
+        """
+        if self.backend is not None:
+            return self.backend.run(self.backend.query_page(query.object_type, page_number, query.url_params,
+                                                            query.query_params))
+        return self.get_query_connection().query_multiple(query.object_type, page_number, query.url_params,
+                                                          query.query_params)
+
     def get_groups(self):
         return list(self.iter_groups())
 
     def iter_groups(self):
         try:
+            if self.backend is not None:
+                for page, _, _ in self.iter_query_pages(umapi_client.GroupsQuery(self.connection)):
+                    for g in page:
+                        yield g
+                return
             for g in umapi_client.GroupsQuery(self.connection):
                 yield g
         except umapi_client.UnavailableError as e:
@@ -158,21 +618,155 @@ class UmapiConnector(object):
         if name:
             group = umapi_client.UserGroupAction(group_name=name)
             group.create(description="Automatically created by User Sync Tool")
+            if self.backend is not None:
+                return self.backend.run(self.backend.execute_multiple([group]))
             return self.connection.execute_single(group)
 
+    def create_groups(self, names):
+        """
+        Create user groups, sending up to batch_size creations in each call.  With the asyncio
+        backend, the calls are all made at once.
+        :type names: list(str)
+        :return: list of (group name, error message) for the groups that could not be created
+        """
+        actions = []
+        for name in names:
+            group = umapi_client.UserGroupAction(group_name=name)
+            group.create(description="Automatically created by User Sync Tool")
+            actions.append(group)
+        batch_size = self.action_manager.batch_size
+        batches = [actions[start:start + batch_size] for start in range(0, len(actions), batch_size)]
+        if self.backend is not None:
+            futures = [self.backend.submit(self.backend.execute_multiple(batch)) for batch in batches]
+            calls = [future.result for future in futures]
+        else:
+            calls = [lambda batch=batch: self.connection.execute_multiple(batch, immediate=True) for batch in batches]
+        failures = []
+        for batch, call in zip(batches, calls):
+            try:
+                call()
+            except Exception as e:
+                failures.extend((action.frame['usergroup'], str(e)) for action in batch)
+                continue
+            for action in batch:
+                errors = action.execution_errors()
+                if errors:
+                    failures.append((action.frame['usergroup'], '; '.join(e.get('message', '') for e in errors)))
+        return failures
+
     def get_action_manager(self):
         return self.action_manager
 
     def send_commands(self, commands, callback=None):
         """
+        Commands are held until they are flushed (or too many users have commands held), and
+        later commands for the same user are merged into the held ones, so that all the commands
+        for a user are sent (in order) in a single action.
         :type commands: Commands
         :type callback: callable(dict)
         """
         if len(commands) > 0:
-            action_manager = self.get_action_manager()
-            action = action_manager.create_action(commands)
-            if action is not None:
-                action_manager.add_action(action, callback)
+            key = (commands.identity_type,
+                   user_sync.helper.normalize_string(commands.username),
+                   user_sync.helper.normalize_string(commands.domain))
+            pending = self.pending_commands.get(key)
+            if pending is None:
+                merged_commands = Commands(commands.identity_type, commands.email, commands.username, commands.domain)
+                self.pending_commands[key] = pending = (merged_commands, [])
+            pending[0].merge(commands)
+            if callback is not None:
+                pending[1].append(callback)
+            if len(self.pending_commands) > MAX_PENDING_COMMANDS:
+                self._send_pending_commands(*self.pending_commands.popitem(last=False)[1])
+
+    def _send_pending_commands(self, commands, callbacks):
+        """
+        Hand the merged commands for a user to the action manager.
+        :type commands: Commands
+        :type callbacks: list(callable(dict))
+        """
+        action_manager = self.get_action_manager()
+        action = action_manager.create_action(commands)
+        if action is not None:
+            callback = None
+            if len(callbacks) == 1:
+                callback = callbacks[0]
+            elif callbacks:
+                def callback(result):
+                    for c in callbacks:
+                        c(result)
+            if self.snapshot is not None and not self.options['test_mode']:
+                callback = self.make_snapshot_callback(callback)
+            action_manager.add_action(action, callback)
+
+    def has_work(self):
+        return len(self.pending_commands) > 0 or self.action_manager.has_work()
+
+    def start_journal(self):
+        """
+        Start a new journal for this run (if there is a journal), when the run isn't resuming an earlier one.
+        """
+        if self.action_manager.journal is not None:
+            self.action_manager.journal.start()
+
+    def replay_journal(self):
+        """
+        Queue the actions in the journal that were never acknowledged, to be sent again.
+        :return: the number of actions queued
+        """
+        journal = self.action_manager.journal
+        if journal is None:
+            raise AssertionException("%s: resuming from a journal requires a journal directory in the configuration" %
+                                     self.name)
+        wire_forms = journal.read_pending()
+        journal.resume()
+        callback = None
+        if self.snapshot is not None and not self.options['test_mode']:
+            callback = self.make_snapshot_callback(None)
+        for wire_form in wire_forms:
+            action = umapi_client.Action(**{k: v for k, v in six.iteritems(wire_form) if k != 'do'})
+            for command in wire_form['do']:
+                action.append(**command)
+            self.action_manager.add_action(action, callback, replayed=True)
+        return len(wire_forms)
+
+    def flush(self):
+        """
+        Send all the held commands and queued actions, and wait until they have all been sent.
+        """
+        while self.pending_commands:
+            self._send_pending_commands(*self.pending_commands.popitem(last=False)[1])
+        self.action_manager.flush()
+
+    def make_snapshot_callback(self, callback):
+        """
+        Wrap an action callback so that successful actions are also applied to the user snapshot.  A failed
+        action marks the snapshot stale: UMAPI has already executed the commands before the failed one (and
+        after a batch error we can't tell which actions were executed), so the snapshot no longer matches
+        the organization.
+        :type callback: callable(dict)
+        :rtype callable(dict)
+        """
+        def snapshot_callback(result):
+            if result['is_success']:
+                self.snapshot.apply_action(result['action'])
+            else:
+                self.snapshot.mark_stale()
+            if callable(callback):
+                callback(result)
+        return snapshot_callback
+
+    def save_snapshot(self):
+        """
+        Save the user snapshot, unless in test mode: a test run's actions were never made, so a snapshot
+        saved by it (and counted as a run of it) can't be trusted by the next run.
+        """
+        if self.snapshot is None:
+            return
+        if self.options['test_mode']:
+            self.logger.debug('Test mode: not saving the user snapshot')
+            return
+        self.snapshot.save()
 
 
 class Commands(object):
@@ -248,6 +842,15 @@ class Commands(object):
         }
         self.do_list.append(('remove_from_organization', params))
 
+    def merge(self, commands):
+        """
+        Append the commands for the same user from another Commands.
+        :type commands: Commands
+        """
+        if self.email is None:
+            self.email = commands.email
+        self.do_list.extend(commands.do_list)
+
     def __len__(self):
         return len(self.do_list)
 
@@ -265,18 +868,58 @@ class Commands(object):
 class ActionManager(object):
     next_request_id = 1
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, batch_size=UMAPI_MAX_ACTIONS_PER_CALL, workers=1,
+                 group_action_threshold=0, journal=None, max_queued_actions=DEFAULT_MAX_QUEUED_ACTIONS,
+                 lane_connections=None):
         """
+        Queued actions are kept in one lane per worker, and each user's actions always go to the same
+        lane.  With more than one worker, each lane sends its batches in order on its own thread, so
+        the lanes run in parallel but the actions for any one user are still sent in order.
+        A umapi_client.Connection can't be used by more than one thread at a time, so each lane should
+        have its own connection (lane_connections); if it doesn't, the lanes take turns using the one connection.
+        If group_action_threshold is set, actions that only change a user's group memberships are held
+        until the flush, and the memberships shared by at least that many users are sent as group actions.
+        Once max_queued_actions actions are queued or being sent, adding another waits until some of them
+        have completed.  Held membership actions are capped separately, at max_queued_actions of them.
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type batch_size: int
+        :type workers: int
+        :type group_action_threshold: int
+        :param journal: if given, every action is journaled before it's sent, and acknowledged once it has been
+        :type journal: ActionJournal
+        :type max_queued_actions: int
+        :type lane_connections: list(umapi_client.Connection)
         """
         self.action_count = 0
         self.error_count = 0
-        self.items = []
+        self.lanes = [collections.deque() for _ in range(workers)]
+        # the outstanding actions, by request ID
+        self.outstanding_items = {}
+        self.max_queued_actions = max_queued_actions
+        self.batch_size = batch_size
+        self.group_action_threshold = group_action_threshold
+        self.held_items = collections.OrderedDict()
+        self.journal = journal
         self.connection = connection
+        self.lane_connections = lane_connections or [connection] * workers
+        self.connection_lock = threading.Lock() if lane_connections is None and workers > 1 else None
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        # sent items are processed on the worker threads, so their accounting is serialized
+        self.lock = threading.Lock()
+        self.executors = self.create_executors(workers)
+        self.pending_batches = []
+
+    @staticmethod
+    def create_executors(workers):
+        """
+        :return: a single-threaded executor for each lane, if there is more than one
+        """
+        if workers > 1:
+            return [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+        return []
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
@@ -315,78 +958,410 @@ class ActionManager(object):
             command_function(**command_param)
         return action
 
-    def add_action(self, action, callback=None):
+    def add_action(self, action, callback=None, replayed=False):
         """
+        Queue an action, and send its lane as a single batch once the lane holds a full batch of actions.
         :type action: umapi_client.UserAction
         :type callback: callable(umapi_client.UserAction, bool, dict)
+        :param replayed: whether the action is being resent from the journal (where it already is)
         """
         item = {
             'action': action,
             'callback': callback
         }
-        self.items.append(item)
         self.action_count += 1
-        self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
+        self.outstanding_items[action.frame['requestID']] = item
+        if self.journal is not None and not replayed:
+            self.journal.write_action(action)
+        target_key = self.get_target_key(action)
+        held_item = self.held_items.pop(target_key, None)
+        if held_item is not None:
+            # the held action must be sent before this later one on the same user
+            self._queue_item(held_item)
+        if self.group_action_threshold and self.is_membership_action(action):
+            self.held_items[target_key] = item
+        else:
+            self._queue_item(item)
+        if len(self.held_items) >= self.max_queued_actions:
+            self._release_held_items()
+        if self.get_queued_action_count() >= self.max_queued_actions:
+            self._wait_for_outstanding_items()
+
+    def get_queued_action_count(self):
+        """
+        :return: the number of outstanding actions that are queued or being sent (rather than held)
+        """
+        return len(self.outstanding_items) - len(self.held_items)
+
+    def _wait_for_outstanding_items(self):
+        """
+        Apply backpressure to the caller: wait for the batches being sent to complete until fewer than
+        max_queued_actions actions are queued or being sent, and if that's not enough, send everything queued.
+        The held membership actions stay held, so that they can still be combined into group actions.
+        """
+        while self.get_queued_action_count() >= self.max_queued_actions and self.pending_batches:
+            self.pending_batches.pop(0).result()
+        if self.get_queued_action_count() >= self.max_queued_actions:
+            self.logger.debug('%d actions queued; sending them all', self.get_queued_action_count())
+            self._send_lanes()
+
+    def _release_held_items(self):
+        """
+        Send the held membership actions once there are max_queued_actions of them, after everything
+        queued before them (as in a flush).
+        """
+        self.logger.debug('%d membership actions held; sending them', len(self.held_items))
+        self._send_lanes()
+        self._queue_held_items()
+
+    def get_outstanding_item(self, request_id):
+        """
+        :return: the outstanding (queued, held or being sent) item for a request ID, or None
+        """
+        return self.outstanding_items.get(request_id)
+
+    def _queue_item(self, item):
+        lane_index = self.get_lane_index(item['action'])
+        lane = self.lanes[lane_index]
+        lane.append(item)
+        if len(lane) >= self.batch_size:
+            self._execute_batch(lane_index)
+
+    @staticmethod
+    def get_target_key(action):
+        """
+        The same user may be identified by email in one action and by username in another, so users
+        are keyed by email whenever the action has it.
+        :type action: umapi_client.Action
+        :return: the normalized identity of the user (or group) the action is on
+        """
+        email = getattr(action, 'email', None)
+        if email:
+            return user_sync.helper.normalize_string(email), ''
+        frame = action.frame
+        target = frame.get('user') or frame.get('usergroup') or ''
+        return user_sync.helper.normalize_string(target), user_sync.helper.normalize_string(frame.get('domain', ''))
+
+    def get_lane_index(self, action):
+        """
+        All actions on the same user must land in the same lane, so that they are sent in order.
+        :type action: umapi_client.Action
+        :rtype int
+        """
+        if len(self.lanes) == 1:
+            return 0
+        return hash(self.get_target_key(action)) % len(self.lanes)
+
+    @staticmethod
+    def is_membership_action(action):
+        """
+        Whether an action only adds its user to or removes its user from named user groups, so that its
+        commands could be sent as part of group actions instead.  Group actions identify users by email,
+        so the user must be identified by email (and must not be an Adobe ID, which need not be unique).
+        :type action: umapi_client.Action
+        :rtype bool
+        """
+        frame = action.frame
+        if not isinstance(action, umapi_client.UserAction) or set(frame) - {'user', 'requestID'}:
+            return False
+        if user_sync.helper.normalize_string(frame['user']) != user_sync.helper.normalize_string(action.email):
+            return False
+        for command in action.commands:
+            for name, params in six.iteritems(command):
+                if name not in ('add', 'remove') or not isinstance(params, dict) or set(params) != {'group'}:
+                    return False
+        return bool(action.commands)
 
     def has_work(self):
-        return len(self.items) > 0
+        return len(self.outstanding_items) > 0 or len(self.pending_batches) > 0
 
-    def _execute_action(self, action):
+    def _execute_batch(self, lane_index):
         """
-        :type action: umapi_client.UserAction
+        Take (up to) one batch of actions off the front of a lane and send it, either directly
+        or on the lane's worker thread.
+        :type lane_index: int
         """
-        try:
-            _, sent, _ = self.connection.execute_single(action)
-        except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
-        except umapi_client.UnavailableError as e:
-            raise AssertionException("Error contacting UMAPI server: %s" % e)
+        sent_items = self._take_batch(lane_index)
+        if self.executors:
+            self._check_pending_batches()
+            self.pending_batches.append(self.executors[lane_index].submit(self._send_items, lane_index, sent_items))
         else:
-            self.process_sent_items(sent)
+            self._send_items(lane_index, sent_items)
 
-    def flush(self):
+    def _take_batch(self, lane_index):
+        """
+        Take (up to) one batch of actions off the front of a lane, to be sent.
+        :type lane_index: int
+        :rtype list(dict)
+        """
+        lane = self.lanes[lane_index]
+        sent_items = [lane.popleft() for _ in range(min(self.batch_size, len(lane)))]
+        if self.journal is not None:
+            # the journaled actions must be on disk before they are sent
+            self.journal.sync()
+        return sent_items
+
+    def _send_items(self, lane_index, sent_items):
+        """
+        Send a batch of queued items from a lane to the server, on the lane's connection.
+        We send with immediate=True, so everything we pass is sent by the time the call returns,
+        and we account for the items ourselves: the connection counts the pieces of any action it had
+        to split because of command or group throttling, which would misalign the items.
+        :type lane_index: int
+        :type sent_items: list(dict)
+        """
+        actions = [item['action'] for item in sent_items]
+        connection = self.lane_connections[lane_index]
         try:
-            _, sent, _ = self.connection.execute_queued()
+            if self.connection_lock is None:
+                connection.execute_multiple(actions, immediate=True)
+            else:
+                with self.connection_lock:
+                    connection.execute_multiple(actions, immediate=True)
         except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
+            self.process_sent_items(sent_items, e)
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
         else:
-            self.process_sent_items(sent)
+            self.process_sent_items(sent_items)
 
-    def process_sent_items(self, total_sent, batch_error=None):
+    def _check_pending_batches(self, wait=False):
+        """
+        Forget about batches that have been sent, raising any error that occurred while sending them.
+        :param wait: if True, wait for all the pending batches to be sent
+        """
+        pending_batches = []
+        for future in self.pending_batches:
+            if wait or future.done():
+                future.result()
+            else:
+                pending_batches.append(future)
+        self.pending_batches = pending_batches
+
+    def flush(self):
+        """
+        Send all queued actions, including a final partial batch in each lane,
+        and wait until they have all been sent.  Held membership actions are sent last,
+        so that they can't overtake earlier actions on their users.
+        """
+        self._send_lanes()
+        if self.held_items:
+            self._queue_held_items()
+            self._send_lanes()
+        if self.journal is not None:
+            self.journal.sync()
+
+    def _send_lanes(self):
+        for lane_index in range(len(self.lanes)):
+            while self.lanes[lane_index]:
+                self._execute_batch(lane_index)
+        self._check_pending_batches(wait=True)
+
+    def _queue_held_items(self):
+        """
+        Queue the held membership actions.  Each membership that is shared by enough users is sent as part of
+        group actions that add (or remove) many users at once, and the rest of each user's memberships are sent
+        in a user action.  The callback for a held action is invoked once all of its parts have been sent.
+        """
+        held_items = list(six.itervalues(self.held_items))
+        self.held_items.clear()
+        # the held items to be added to (or removed from) each group, by command name and normalized group name
+        members = collections.OrderedDict()
+        for item in held_items:
+            for command in item['action'].commands:
+                for name, params in six.iteritems(command):
+                    for group in params['group']:
+                        key = (name, user_sync.helper.normalize_string(group))
+                        members.setdefault(key, (group, []))[1].append(item)
+        group_keys = {key for key, (_, items) in six.iteritems(members)
+                      if len(items) >= self.group_action_threshold}
+
+        queued_items = []
+        for item in held_items:
+            action = item['action']
+            residual_action = umapi_client.Action(**action.frame)
+            for command in action.commands:
+                for name, params in six.iteritems(command):
+                    groups = [g for g in params['group']
+                              if (name, user_sync.helper.normalize_string(g)) not in group_keys]
+                    if groups:
+                        residual_action.append(**{name: {'group': groups}})
+            item['parts'] = 0
+            item['errors'] = []
+            if residual_action.commands:
+                item['parts'] += 1
+                queued_items.append({'action': residual_action, 'callback': None, 'members': [item]})
+
+        group_action_size = UMAPI_MAX_COMMANDS_PER_ACTION * UMAPI_MAX_USERS_PER_COMMAND
+        group_action_count = 0
+        for key, (group, items) in six.iteritems(members):
+            if key not in group_keys:
+                continue
+            name = key[0]
+            for start in range(0, len(items), group_action_size):
+                action_items = items[start:start + group_action_size]
+                group_action = umapi_client.UserGroupAction(group_name=group, requestID=self.get_next_request_id())
+                member_steps = []
+                for command_start in range(0, len(action_items), UMAPI_MAX_USERS_PER_COMMAND):
+                    command_items = action_items[command_start:command_start + UMAPI_MAX_USERS_PER_COMMAND]
+                    users = [i['action'].frame['user'] for i in command_items]
+                    member_steps.extend([len(group_action.commands)] * len(command_items))
+                    if name == 'add':
+                        group_action.add_users(users=users)
+                    else:
+                        group_action.remove_users(users=users)
+                for member in action_items:
+                    member['parts'] += 1
+                queued_items.append({'action': group_action, 'callback': None, 'members': action_items,
+                                     'member_steps': member_steps})
+                group_action_count += 1
+        if group_action_count:
+            self.logger.info('Sending group memberships of %d users in %d group actions',
+                             len(held_items), group_action_count)
+        # the parts of every held item are counted before any of them is sent
+        for item in queued_items:
+            self.logger.debug('Added action: %s', json.dumps(item['action'].wire_dict()))
+            self._queue_item(item)
+
+    def process_sent_items(self, sent_items, batch_error=None):
         """
         Note items as sent, log any processing errors, and invoke any callbacks
-        :param total_sent: number of sent items from queue, must be >= 0
+        :param sent_items: the items taken off a lane and sent
         :param batch_error: exception for a batch-level error that affected all items, if there was one
         :return: 
         """
-        # update queue
-        sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
+        with self.lock:
+            self._process_sent_items(sent_items, batch_error)
 
-        # collect sent actions, their errors, their callbacks
-        details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
-
-        # log errors
+    def _process_sent_items(self, sent_items, batch_error):
         if batch_error:
-            request_ids = str([action.frame.get("requestID") for action, _, _ in details])
+            request_ids = str([item['action'].frame.get("requestID") for item in sent_items])
             self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
-        else:
-            for action, errors, _ in details:
-                if errors:
-                    self.error_count += 1
-                    for error in errors:
-                        self.logger.error('Error in requestID: %s (User: %s, Command: %s): code: "%s" message: "%s"',
-                                          action.frame.get("requestID"),
-                                          error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
-                                          error.get('errorCode', "<None>"), error.get('message', "<None>"))
-        # invoke callbacks
-        for action, errors, callback in details:
+
+        # collect the finished items with their errors: the parts of a held item report to it,
+        # and it is finished once all its parts have been sent
+        finished_items = []
+        for item in sent_items:
+            errors = [batch_error] if batch_error else item['action'].execution_errors()
+            if 'members' not in item:
+                finished_items.append((item, errors))
+                continue
+            for member_index, member in enumerate(item['members']):
+                member['errors'].extend(self.select_member_errors(item, member_index, errors))
+                member['parts'] -= 1
+                if member['parts'] == 0:
+                    finished_items.append((member, member['errors']))
+
+        # log errors (a batch error has already been logged), and invoke callbacks
+        for item, errors in finished_items:
+            action = item['action']
+            self.outstanding_items.pop(action.frame.get('requestID'), None)
+            if errors:
+                self.error_count += 1
+            for error in errors:
+                if isinstance(error, dict):
+                    self.logger.error('Error in requestID: %s (User: %s, Command: %s): code: "%s" message: "%s"',
+                                      action.frame.get("requestID"),
+                                      error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
+                                      error.get('errorCode', "<None>"), error.get('message', "<None>"))
+            if self.journal is not None and not any(isinstance(e, Exception) for e in errors):
+                # an action with a batch error may or may not have been executed, so it stays unacknowledged
+                self.journal.write_ack(action, not errors)
+            callback = item['callback']
             if callable(callback):
                 callback({
                     "action": action,
-                    "is_success": not batch_error and not errors,
-                    "errors": [batch_error] if batch_error else errors
+                    "is_success": not errors,
+                    "errors": errors
                 })
+
+    @staticmethod
+    def select_member_errors(item, member_index, errors):
+        """
+        Pick out the errors in a part of a held item that apply to one of its members.  UMAPI stops executing
+        an action at its first failed command, so an error in a command of a group action applies to the users
+        in that command and in all the commands after it (which were never executed).  Any other error
+        applies to every member.
+        :param item: the sent part (a residual user action or a group action)
+        :type member_index: int
+        :type errors: list
+        :rtype list
+        """
+        member_steps = item.get('member_steps')
+        if member_steps is None:
+            return list(errors)
+        commands = item['action'].commands
+        selected = []
+        for error in errors:
+            step = ActionManager.get_error_step(commands, error)
+            if step is None or member_steps[member_index] >= step:
+                selected.append(error)
+        return selected
+
+    @staticmethod
+    def get_error_step(commands, error):
+        """
+        :param commands: the commands of an action
+        :param error: an error reported for the action
+        :return: the index of the command the error is for, or None if that can't be told
+        """
+        if not isinstance(error, dict) or not isinstance(error.get('command'), dict):
+            return None
+        for step, command in enumerate(commands):
+            if command is error['command']:
+                return step
+        for step, command in enumerate(commands):
+            if command == error['command']:
+                return step
+        return None
+
+
+class AsyncActionManager(ActionManager):
+    """
+    An action manager that sends its batches from the event loop of an asyncio backend.
+    The batches of each lane are sent in order, and the lanes (one per worker) are sent concurrently.
+    """
+
+    def __init__(self, backend, connection, org_id, logger, batch_size=UMAPI_MAX_ACTIONS_PER_CALL, workers=1,
+                 group_action_threshold=0, journal=None, max_queued_actions=DEFAULT_MAX_QUEUED_ACTIONS):
+        """
+        :type backend: AsyncUmapiBackend
+        """
+        ActionManager.__init__(self, connection, org_id, logger, batch_size, workers, group_action_threshold,
+                               journal, max_queued_actions)
+        self.backend = backend
+        # the lane locks must belong to the event loop
+        self.lane_locks = backend.run(self._create_lane_locks())
+        # no more than this many batches wait on the loop at once
+        self.max_pending_batches = 2 * len(self.lanes)
+
+    @staticmethod
+    def create_executors(workers):
+        return []
+
+    async def _create_lane_locks(self):
+        return [asyncio.Lock() for _ in self.lanes]
+
+    def _execute_batch(self, lane_index):
+        sent_items = self._take_batch(lane_index)
+        self._check_pending_batches()
+        while len(self.pending_batches) >= self.max_pending_batches:
+            self.pending_batches.pop(0).result()
+        self.pending_batches.append(self.backend.submit(self._send_items_async(lane_index, sent_items)))
+
+    async def _send_items_async(self, lane_index, sent_items):
+        """
+        The lane's lock is taken in the order the batches were submitted, so each lane is sent in order.
+        """
+        async with self.lane_locks[lane_index]:
+            actions = [item['action'] for item in sent_items]
+            try:
+                await self.backend.execute_multiple(actions)
+            except umapi_client.BatchError as e:
+                self.process_sent_items(sent_items, e)
+            except umapi_client.UnavailableError as e:
+                raise AssertionException("Error contacting UMAPI server: %s" % e)
+            else:
+                self.process_sent_items(sent_items)
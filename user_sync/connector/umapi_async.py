@@ -0,0 +1,252 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import atexit
+import collections
+import json
+import random
+import threading
+import time
+import urllib.parse as urlparse
+import uuid
+
+import umapi_client
+
+from user_sync.connector.umapi_util import parse_retry_after
+from user_sync.error import AssertionException
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# the response statuses after which a call is retried
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# the parts of an HTTP response that the umapi_client errors need
+Response = collections.namedtuple('Response', ['status_code', 'text', 'headers'])
+
+
+class AsyncUmapiBackend(object):
+    """
+    Makes the calls for a UMAPI connection from an asyncio event loop (running on a thread of its own),
+    so that many calls can be in flight at once without a thread for each.  The backend takes
+    the endpoint, credentials and behavioral options from the (otherwise unused) umapi_client connection,
+    and follows the same conventions for paging, throttling, retries and errors.
+    """
+
+    def __init__(self, connection, max_connections, logger, rate_limiter=None):
+        """
+        :type connection: umapi_client.Connection
+        :param max_connections: the number of calls that can be in flight at once
+        :type logger: logging.Logger
+        :param rate_limiter: if given, the calls are paced by it
+        :type rate_limiter: user_sync.connector.umapi_util.RateLimiter
+        """
+        if aiohttp is None:
+            raise AssertionException("The asyncio UMAPI backend requires the aiohttp package, which is not installed")
+        self.connection = connection
+        self.max_connections = max_connections
+        self.logger = logger
+        self.rate_limiter = rate_limiter
+        self.request_uuid = str(uuid.uuid4())
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='umapi-asyncio', daemon=True)
+        self.thread.start()
+        self.session = self.run(self.open_session())
+        atexit.register(self.close)
+
+    async def open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, ssl=None if self.connection.ssl_verify else False)
+        timeout = aiohttp.ClientTimeout(total=self.connection.timeout)
+        headers = {'User-Agent': self.connection.session.headers.get('User-Agent', 'user-sync')}
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+
+    def close(self):
+        if self.loop.is_running():
+            self.run(self.session.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def run(self, coroutine):
+        """
+        Run a coroutine on the event loop, and wait for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def submit(self, coroutine):
+        """
+        Start a coroutine on the event loop.
+        :rtype concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def make_call(self, path, body=None):
+        """
+        Make a single UMAPI call, retrying on temporary failure as the umapi_client connection would.
+        :param path: the endpoint path for the call
+        :param body: (optional) list of dictionaries to be serialized into the request body
+        :rtype (Response, object): the response and its decoded body
+        """
+        connection = self.connection
+        auth = connection.auth
+        headers = {
+            'Content-type': 'application/json',
+            'Accept': 'application/json',
+            'x-api-key': auth.api_key,
+            'Authorization': 'Bearer ' + auth.access_token,
+            'X-Request-Id': '%s_%d' % (self.request_uuid, int(time.time() * 1000)),
+        }
+        url = connection.endpoint + path
+        start_time = time.time()
+        response = None
+        for attempt in range(1, connection.retry_max_attempts + 1):
+            retry_wait = 0
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                if body is not None:
+                    request = self.session.post(url, data=json.dumps(body), headers=headers)
+                else:
+                    request = self.session.get(url, headers=headers)
+                async with request as result:
+                    response = Response(result.status, await result.text(), dict(result.headers))
+                if self.rate_limiter is not None:
+                    self.rate_limiter.report(response.status_code,
+                                             parse_retry_after(response.headers.get('Retry-After')))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.warning('UMAPI connection error (%s on try %d)', e, attempt)
+            else:
+                if response.status_code in (200, 201, 204):
+                    return response, json.loads(response.text) if response.text else None
+                if response.status_code not in RETRY_STATUSES:
+                    if 400 <= response.status_code < 500:
+                        raise umapi_client.RequestError(response)
+                    raise umapi_client.ServerError(response)
+                self.logger.warning('UMAPI request limit reached (code %d on try %d)', response.status_code, attempt)
+                retry_wait = parse_retry_after(response.headers.get('Retry-After'))
+            if attempt < connection.retry_max_attempts:
+                if retry_wait <= 0:
+                    retry_wait = (2 ** (attempt - 1)) * connection.retry_first_delay + \
+                                 random.randint(0, connection.retry_random_delay)
+                self.logger.warning('waiting %d seconds to continue...', retry_wait)
+                await asyncio.sleep(retry_wait)
+        total_time = int(time.time() - start_time)
+        self.logger.error('UMAPI timeout...giving up after %d attempts (%d seconds).',
+                          connection.retry_max_attempts, total_time)
+        raise umapi_client.UnavailableError(connection.retry_max_attempts, total_time, response)
+
+    async def query_page(self, object_type, page, url_params=None, query_params=None):
+        """
+        The asyncio equivalent of umapi_client.Connection.query_multiple.
+        :return: tuple (values, last page?, total count, page count, page number, page size)
+        """
+        org_id = self.connection.org_id
+        if object_type in ('user', 'group'):
+            path = '/%ss/%s/%d' % (object_type, org_id, page)
+            if url_params:
+                path += '/' + '/'.join(urlparse.quote(c) for c in url_params)
+            if query_params:
+                path += '?' + urlparse.urlencode(query_params)
+        elif object_type == 'user-group':
+            path = '/%s/user-groups' % org_id
+            if url_params:
+                path += '/' + '/'.join(urlparse.quote(c) for c in url_params)
+            path += '?page=%d' % (page + 1)
+            if query_params:
+                path += '&' + urlparse.urlencode(query_params)
+        else:
+            raise umapi_client.ArgumentError("Unknown query object type (%s)" % object_type)
+        try:
+            response, body = await self.make_call(path)
+        except umapi_client.RequestError as e:
+            if e.result.status_code == 404:
+                return [], True, 0, 0, 0, 0
+            raise
+        headers = {k.lower(): v for k, v in response.headers.items()}
+        total_count = int(headers.get('x-total-count', '0'))
+        page_count = int(headers.get('x-page-count', '0'))
+        page_number = int(headers.get('x-current-page', '1'))
+        page_size = int(headers.get('x-page-size', '0'))
+        if object_type == 'user-group':
+            return body, page_number >= page_count, total_count, page_count, page_number, page_size
+        if body.get('result') != 'success':
+            raise umapi_client.ClientError("OK status but no 'success' result", response)
+        values = body.get(object_type + 's', [])
+        self.logger.debug('Ran multi-%s query: %s %s (page %d: %d found)',
+                          object_type, url_params, query_params, page, len(values))
+        return values, body.get('lastPage', False), total_count, page_count, page_number, page_size
+
+    async def execute_multiple(self, actions):
+        """
+        The asyncio equivalent of umapi_client.Connection.execute_multiple with immediate=True:
+        the actions are split as the connection's throttling requires, and sent in batches (one at a time).
+        :type actions: list(umapi_client.Action)
+        :return: tuple (number of actions queued, sent, and completed)
+        """
+        connection = self.connection
+        split_actions = []
+        for action in actions:
+            try:
+                action.maybe_split_groups(connection.throttle_groups)
+            except AttributeError:
+                pass
+            if len(action.commands) > connection.throttle_commands:
+                split_actions += action.split(connection.throttle_commands)
+            else:
+                split_actions.append(action)
+        sent = completed = 0
+        exceptions = []
+        batch_size = connection.throttle_actions
+        for start in range(0, len(split_actions), batch_size):
+            batch = split_actions[start:start + batch_size]
+            sent += len(batch)
+            try:
+                completed += await self.execute_batch(batch)
+            except umapi_client.UnavailableError:
+                raise
+            except Exception as e:
+                exceptions.append(e)
+        if exceptions:
+            raise umapi_client.BatchError(exceptions, 0, sent, completed)
+        return 0, sent, completed
+
+    async def execute_batch(self, actions):
+        """
+        Send one batch of actions, noting the errors reported for each.
+        :return: the number of actions that completed
+        """
+        path = '/action/%s' % self.connection.org_id
+        if self.connection.test_mode:
+            path += '?testOnly=true'
+        response, body = await self.make_call(path, [a.wire_dict() for a in actions])
+        if body.get('errors') is None:
+            if body.get('result') != 'success':
+                self.logger.warning('Server action result: no errors, but no success:\n%s', body)
+            return len(actions)
+        try:
+            for error in body['errors']:
+                actions[error['index']].report_command_error(error)
+        except (KeyError, IndexError, TypeError):
+            raise umapi_client.ClientError(str(body), response)
+        return body.get('completed', 0)
@@ -0,0 +1,149 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import json
+import os
+import threading
+
+from user_sync.error import AssertionException
+
+
+class ActionJournal(object):
+    """
+    A write-ahead journal of the actions sent to a UMAPI organization.  Each line is a JSON record: either
+    an action (in its wire form), written before the action is sent, or the acknowledgement of an action,
+    written once its result is known.  If a run dies part way through, the actions without acknowledgements
+    can be sent by a later run (with --resume-journal) without reading the directory or the organization again.
+    Actions whose batch got a response that couldn't be understood are not acknowledged, since they may not
+    have been executed.
+    """
+
+    def __init__(self, directory, org_id, logger, read_only=False):
+        """
+        :type directory: str
+        :type org_id: str
+        :type logger: logging.Logger
+        :param read_only: if True (as in test mode), the journal is read but never written
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, org_id + '.journal.jsonl')
+        self.logger = logger
+        self.read_only = read_only
+        self.resuming = False
+        self.file = None
+        self.unsynced = False
+        self.lock = threading.Lock()
+
+    def read_pending(self):
+        """
+        :return: the wire forms of the journaled actions that were never acknowledged, in the order they were sent
+        """
+        actions = collections.OrderedDict()
+        if not os.path.isfile(self.path):
+            return []
+        try:
+            with open(self.path, 'r') as journal_file:
+                for line_number, line in enumerate(journal_file, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the run died in the middle of writing this record, which was the last
+                        self.logger.warning('Ignoring incomplete record at line %d of journal %s',
+                                            line_number, self.path)
+                        break
+                    if record['type'] == 'action':
+                        actions[record['id']] = record['action']
+                    elif record['type'] == 'ack':
+                        actions.pop(record['id'], None)
+        except IOError as e:
+            raise AssertionException("Unable to read action journal '%s': %s" % (self.path, e))
+        return list(actions.values())
+
+    def resume(self):
+        """
+        The pending actions are about to be sent again, so acknowledgements are added to the existing journal.
+        """
+        self.resuming = True
+
+    def start(self):
+        """
+        Start the journal of a run that isn't resuming, even if the run sends no actions, so that a later
+        --resume-journal can't resend the actions left in the journal of an older run.
+        """
+        if self.read_only:
+            return
+        with self.lock:
+            if self.file is None:
+                self.open()
+
+    def open(self):
+        """
+        Open the journal for writing.  A new run starts a new journal; a resumed run adds to the existing one.
+        """
+        if not self.resuming:
+            pending = self.read_pending()
+            if pending:
+                self.logger.warning('Discarding %d unacknowledged actions from journal %s '
+                                    '(they could have been sent with --resume-journal)', len(pending), self.path)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.file = open(self.path, 'a' if self.resuming else 'w')
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to write action journal '%s': %s" % (self.path, e))
+
+    def write_record(self, record):
+        if self.read_only:
+            return
+        with self.lock:
+            if self.file is None:
+                self.open()
+            self.file.write(json.dumps(record) + '\n')
+            self.unsynced = True
+
+    def write_action(self, action):
+        """
+        :type action: umapi_client.Action
+        """
+        self.write_record({'type': 'action', 'id': action.frame['requestID'], 'action': action.wire_dict()})
+
+    def write_ack(self, action, is_success):
+        """
+        :type action: umapi_client.Action
+        :param is_success: whether the action was executed without errors
+        """
+        self.write_record({'type': 'ack', 'id': action.frame['requestID'], 'success': is_success})
+
+    def sync(self):
+        """
+        Make sure the journal is on disk, before sending the actions written to it.
+        """
+        with self.lock:
+            if self.unsynced:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,292 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import time
+
+import six
+
+from user_sync.error import AssertionException
+from user_sync.helper import normalize_string
+
+SNAPSHOT_VERSION = 1
+
+# the identity type of users added by each of the UMAPI create commands
+CREATE_COMMAND_TYPES = {
+    'addAdobeID': 'adobeID',
+    'createEnterpriseID': 'enterpriseID',
+    'createFederatedID': 'federatedID',
+}
+
+
+class UserSnapshot(object):
+    """
+    An on-disk copy of the users (with their groups) in a UMAPI organization.
+    The snapshot is refreshed by a full read of the organization on a schedule (every refresh_runs runs
+    and/or when it is older than max_age_hours); in between, it is loaded instead of reading the
+    organization, and the successful actions sent by User Sync are applied to it as they complete.
+    Changes made to the organization by other means are only picked up at the next refresh.
+    """
+
+    def __init__(self, directory, org_id, refresh_runs, max_age_hours, logger):
+        """
+        :type directory: str
+        :type org_id: str
+        :type refresh_runs: int
+        :type max_age_hours: int
+        :type logger: logging.Logger
+        """
+        self.path = os.path.join(directory, org_id + '.json')
+        self.org_id = org_id
+        self.refresh_runs = refresh_runs
+        self.max_age_hours = max_age_hours
+        self.logger = logger
+        # users by email, and email by (username, domain) for users whose username is not their email
+        self.users = None
+        self.email_by_username = {}
+        # whether users holds the whole organization, and whether it has missed changes since
+        self.complete = False
+        self.stale = False
+        self.refreshed = None
+        self.run_count = 0
+        self.modified = False
+
+    def load(self):
+        """
+        Load the snapshot from disk, unless it is due to be refreshed in this run.
+        :return: whether the snapshot was loaded
+        """
+        if not os.path.isfile(self.path):
+            self.logger.info('No user snapshot found at %s; it will be created from a full read', self.path)
+            return False
+        try:
+            with open(self.path, 'r') as snapshot_file:
+                content = json.load(snapshot_file)
+        except (IOError, ValueError) as e:
+            self.logger.warning('Ignoring unreadable user snapshot %s: %s', self.path, e)
+            return False
+        if content.get('version') != SNAPSHOT_VERSION or content.get('org_id') != self.org_id:
+            self.logger.warning('Ignoring user snapshot %s: it is not a snapshot of org %s', self.path, self.org_id)
+            return False
+        if content.get('stale'):
+            self.logger.info('User snapshot %s may have missed changes; it will be refreshed', self.path)
+            return False
+        run_count = content['run_count'] + 1
+        age_hours = (time.time() - content['refreshed']) / 3600.0
+        if self.refresh_runs and run_count >= self.refresh_runs:
+            self.logger.info('User snapshot has been used for %d runs; it will be refreshed', run_count)
+            return False
+        if self.max_age_hours and age_hours >= self.max_age_hours:
+            self.logger.info('User snapshot is %.1f hours old; it will be refreshed', age_hours)
+            return False
+        self.users = {}
+        self.email_by_username = {}
+        for user in content['users']:
+            self.set_user(user)
+        self.refreshed = content['refreshed']
+        self.run_count = run_count
+        self.complete = True
+        self.modified = True
+        self.logger.info('Loaded %d users from snapshot %s (%.1f hours old, used for %d runs)',
+                         len(self.users), self.path, age_hours, run_count)
+        return True
+
+    def is_current(self):
+        """
+        :return: whether the snapshot can be used instead of reading the organization
+        """
+        return self.complete and not self.stale
+
+    def get_user_count(self):
+        return len(self.users) if self.users is not None else 0
+
+    def iter_users(self, in_group=None):
+        """
+        :param in_group: if specified, only the users who are in this group are returned
+        :return: iterator of user dicts
+        """
+        group = normalize_string(in_group) if in_group else None
+        for user in list(six.itervalues(self.users)):
+            if group is None or group in self.normalize_groups(user):
+                yield user
+
+    def begin_refresh(self):
+        """
+        Start collecting a full read of the organization.  The actions applied while the read is in progress
+        are applied to the users read so far, but the snapshot can't be saved until end_refresh is called.
+        """
+        self.users = {}
+        self.email_by_username = {}
+        self.complete = False
+        self.stale = False
+
+    def end_refresh(self):
+        """
+        The full read of the organization is complete, so it becomes the snapshot.
+        """
+        self.refreshed = time.time()
+        self.run_count = 0
+        self.complete = True
+        self.modified = True
+
+    def mark_stale(self):
+        """
+        Note that the organization may have changed in ways we can't track, so the next run must refresh.
+        """
+        self.stale = True
+        self.modified = True
+
+    def save(self):
+        """
+        Write the snapshot to disk (via a temporary file, so a crash can't leave a partial snapshot behind).
+        """
+        if not self.modified or not self.complete:
+            return
+        content = {
+            'version': SNAPSHOT_VERSION,
+            'org_id': self.org_id,
+            'refreshed': self.refreshed,
+            'run_count': self.run_count,
+            'stale': self.stale,
+            'users': list(six.itervalues(self.users)),
+        }
+        directory = os.path.dirname(self.path)
+        temp_path = self.path + '.tmp'
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_path, 'w') as snapshot_file:
+                json.dump(content, snapshot_file)
+            os.replace(temp_path, self.path)
+        except (IOError, OSError) as e:
+            raise AssertionException("Unable to write user snapshot '%s': %s" % (self.path, e))
+        self.modified = False
+        self.logger.debug('Saved %d users to snapshot %s', len(self.users), self.path)
+
+    @staticmethod
+    def normalize_groups(user):
+        return {normalize_string(g) for g in user.get('groups') or []}
+
+    def set_user(self, user):
+        """
+        Add or replace a user.
+        :type user: dict
+        """
+        email = normalize_string(user['email'])
+        self.users[email] = user
+        username = normalize_string(user.get('username'))
+        if username and username != email:
+            self.email_by_username[(username, normalize_string(user.get('domain')))] = email
+
+    def remove_user(self, user):
+        """
+        :type user: dict
+        """
+        email = normalize_string(user['email'])
+        self.users.pop(email, None)
+        username = normalize_string(user.get('username'))
+        if username and username != email:
+            self.email_by_username.pop((username, normalize_string(user.get('domain'))), None)
+
+    def find_user(self, frame):
+        """
+        Find the snapshot user targeted by an action.
+        :param frame: the action's frame, which identifies the user by email or by username and domain
+        :rtype dict or None
+        """
+        user_id = normalize_string(frame.get('user'))
+        domain = normalize_string(frame.get('domain'))
+        if domain:
+            return self.users.get(self.email_by_username.get((user_id, domain)))
+        user = self.users.get(user_id)
+        if user is None and '@' in user_id:
+            # an email-type username that differs from the user's email
+            user = self.users.get(self.email_by_username.get((user_id, user_id[user_id.index('@') + 1:])))
+        return user
+
+    def apply_action(self, action):
+        """
+        Apply the commands of a successfully executed user action to the snapshot.
+        :type action: umapi_client.UserAction
+        """
+        if self.users is None or self.stale or 'user' not in action.frame:
+            return
+        self.modified = True
+        user = self.find_user(action.frame)
+        for command in action.commands:
+            for name, params in six.iteritems(command):
+                if name in CREATE_COMMAND_TYPES:
+                    user = self.apply_create(action, user, CREATE_COMMAND_TYPES[name], params)
+                elif user is None:
+                    # the user isn't known, so our snapshot is out of date
+                    self.logger.debug('User snapshot has no user for action %s; marking it stale', action.frame)
+                    self.mark_stale()
+                    return
+                elif name == 'update':
+                    self.remove_user(user)
+                    user.update(params)
+                    self.set_user(user)
+                elif name == 'add':
+                    groups = user.setdefault('groups', [])
+                    current_groups = self.normalize_groups(user)
+                    for group in self.iter_group_names(params):
+                        if normalize_string(group) not in current_groups:
+                            groups.append(group)
+                elif name == 'remove':
+                    if params == 'all':
+                        user['groups'] = []
+                    else:
+                        removed = {normalize_string(g) for g in self.iter_group_names(params)}
+                        user['groups'] = [g for g in user.get('groups') or [] if normalize_string(g) not in removed]
+                elif name == 'removeFromOrg':
+                    self.remove_user(user)
+                    user = None
+
+    def apply_create(self, action, user, identity_type, params):
+        option = params.get('option')
+        if user is not None and option != 'updateIfAlreadyExists':
+            return user
+        if user is None:
+            frame_user = action.frame['user']
+            email = params.get('email') or frame_user
+            user = {
+                'email': email,
+                'username': frame_user,
+                'domain': action.frame.get('domain') or email[email.index('@') + 1:],
+                'type': identity_type,
+                'status': 'active',
+                'groups': [],
+            }
+        for key in ('email', 'firstname', 'lastname', 'country'):
+            if params.get(key):
+                user[key] = params[key]
+        self.set_user(user)
+        return user
+
+    @staticmethod
+    def iter_group_names(params):
+        """
+        :param params: the parameters of an add or remove command (either 'all' or a dict of group lists by type)
+        """
+        if isinstance(params, dict):
+            for groups in six.itervalues(params):
+                for group in groups:
+                    yield group
@@ -1,6 +1,22 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+import requests
+import umapi_client
+from Crypto.Cipher import AES
+
 from user_sync.error import AssertionException
 from user_sync.encryption import decrypt
 
+# the number of PBKDF2 rounds used to derive the key that encrypts a cached access token
+TOKEN_KEY_ROUNDS = 100000
+
 
 def make_auth_dict(name, config, org_id, tech_acct, logger):
     api_field = 'client_id' if 'client_id' in config or 'secure_client_id_key' in config else "api_key"
@@ -41,3 +57,271 @@ def make_auth_dict(name, config, org_id, tech_acct, logger):
                                      (config.get_full_scope(), e))
     auth_dict['private_key_data'] = key_data
     return auth_dict
+
+
+class ConnectionFactory(object):
+    """
+    Makes the UMAPI connections for all the connectors in a run.  The connections share one HTTP session,
+    so that keep-alive connections to the UMAPI host are reused across organizations, and (if a connector
+    has a token cache) they use cached IMS access tokens instead of doing a JWT exchange on every run.
+    """
+
+    def __init__(self, rate_limiter=None):
+        """
+        :param rate_limiter: if given, all the calls made through the shared session are rate limited by it
+        :type rate_limiter: RateLimiter
+        """
+        self.session = None
+        self.pool_size = 0
+        self.rate_limiter = rate_limiter
+
+    def get_session(self, pool_size):
+        """
+        :param pool_size: the number of connections the caller may have open at once
+        :rtype requests.Session
+        """
+        if self.session is None:
+            self.session = requests.Session()
+        if pool_size > self.pool_size:
+            if self.rate_limiter is not None:
+                adapter = RateLimitedAdapter(self.rate_limiter, pool_connections=pool_size, pool_maxsize=pool_size)
+            else:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('https://', adapter)
+            self.pool_size = pool_size
+        return self.session
+
+    def make_connection(self, auth_dict, ims_host, ims_endpoint_jwt, token_cache, pool_size, **connection_args):
+        """
+        :type auth_dict: dict
+        :type ims_host: str
+        :type ims_endpoint_jwt: str
+        :type token_cache: TokenCache
+        :param pool_size: the number of connections the connection may have open at once
+        :param connection_args: the other arguments for the umapi_client.Connection
+        :rtype umapi_client.Connection
+        """
+        if token_cache is not None:
+            auth = token_cache.get_auth(auth_dict, ims_host, ims_endpoint_jwt, connection_args.get('ssl_verify', True))
+            connection = umapi_client.Connection(auth=auth, **connection_args)
+        else:
+            connection = umapi_client.Connection(auth_dict=auth_dict, ims_host=ims_host,
+                                                 ims_endpoint_jwt=ims_endpoint_jwt, **connection_args)
+        return self.share_session(connection, pool_size)
+
+    def copy_connection(self, connection, pool_size, **connection_args):
+        """
+        Make another connection that uses the access token of an existing one, for use on another thread.
+        :type connection: umapi_client.Connection
+        :param pool_size: the number of connections the connection may have open at once
+        :param connection_args: the other arguments for the umapi_client.Connection
+        :rtype umapi_client.Connection
+        """
+        return self.share_session(umapi_client.Connection(auth=connection.auth, **connection_args), pool_size)
+
+    def share_session(self, connection, pool_size):
+        # the connection's own session is replaced before it has been used
+        session = self.get_session(pool_size)
+        session.headers.update(connection.session.headers)
+        connection.session = session
+        return connection
+
+
+class TokenCache(object):
+    """
+    Keeps the IMS access tokens obtained for an integration on disk until they are about to expire.
+    Each token is encrypted with a key derived from the integration's client secret, so the cache
+    gives away nothing that couldn't be had from the configuration anyway.
+    """
+
+    def __init__(self, directory, min_remaining_hours, logger):
+        """
+        :type directory: str
+        :param min_remaining_hours: a cached token is only used if it's valid for at least this long
+        :type logger: logging.Logger
+        """
+        self.directory = directory
+        self.min_remaining_seconds = min_remaining_hours * 3600
+        self.logger = logger
+
+    def get_path(self, auth_dict, ims_host):
+        identity = '|'.join([auth_dict['org_id'], auth_dict['tech_acct_id'], auth_dict['api_key'], ims_host])
+        return os.path.join(self.directory, hashlib.sha256(identity.encode('utf-8')).hexdigest() + '.token')
+
+    def get_auth(self, auth_dict, ims_host, ims_endpoint_jwt, ssl_verify):
+        """
+        Get a cached access token for the integration, or exchange a JWT for a new one and cache it.
+        :type auth_dict: dict
+        :rtype umapi_client.auth.Auth
+        """
+        path = self.get_path(auth_dict, ims_host)
+        token = self.read_token(path, auth_dict['client_secret'])
+        if token is not None and token['expires'] - time.time() >= self.min_remaining_seconds:
+            self.logger.debug('Using cached access token from %s', path)
+            return umapi_client.auth.Auth(auth_dict['api_key'], token['access_token'])
+        jwt = umapi_client.auth.JWT(auth_dict['org_id'], auth_dict['tech_acct_id'], ims_host, auth_dict['api_key'],
+                                    io.StringIO(auth_dict['private_key_data']))
+        access_request = umapi_client.auth.AccessRequest('https://' + ims_host + ims_endpoint_jwt,
+                                                         auth_dict['api_key'], auth_dict['client_secret'], jwt(),
+                                                         ssl_verify)
+        try:
+            access_token = access_request()
+        except RuntimeError as e:
+            raise AssertionException('Unable to get an access token for org %s: %s' % (auth_dict['org_id'], e))
+        token = {'access_token': access_token, 'expires': time.mktime(access_request.expiry.timetuple())}
+        self.write_token(path, auth_dict['client_secret'], token)
+        return umapi_client.auth.Auth(auth_dict['api_key'], access_token)
+
+    @staticmethod
+    def derive_key(secret, salt):
+        return hashlib.pbkdf2_hmac('sha256', secret.encode('utf-8'), salt, TOKEN_KEY_ROUNDS, 32)
+
+    def read_token(self, path, secret):
+        """
+        :return: the cached token dict, or None if there is no usable cached token
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'r') as token_file:
+                content = {k: base64.b64decode(v) for k, v in json.load(token_file).items()}
+            cipher = AES.new(self.derive_key(secret, content['salt']), AES.MODE_GCM, nonce=content['nonce'])
+            data = cipher.decrypt_and_verify(content['data'], content['tag'])
+            return json.loads(data.decode('utf-8'))
+        except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+            # an unreadable cache file, or one written with a different client secret
+            self.logger.debug('Ignoring cached access token %s: %s', path, e)
+            return None
+
+    def write_token(self, path, secret, token):
+        salt = os.urandom(16)
+        cipher = AES.new(self.derive_key(secret, salt), AES.MODE_GCM)
+        data, tag = cipher.encrypt_and_digest(json.dumps(token).encode('utf-8'))
+        content = {'salt': salt, 'nonce': cipher.nonce, 'tag': tag, 'data': data}
+        temp_path = path + '.tmp'
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(temp_path, 'w') as token_file:
+                json.dump({k: base64.b64encode(v).decode('ascii') for k, v in content.items()}, token_file)
+            os.replace(temp_path, path)
+        except (IOError, OSError) as e:
+            # the cache only saves time, so a run can do without it
+            self.logger.warning('Unable to cache access token in %s: %s', path, e)
+
+
+def parse_retry_after(advice):
+    """
+    :param advice: the value of a Retry-After header: either a number of seconds or an HTTP date
+    :return: the number of seconds to wait (0 if there is no usable advice)
+    """
+    if not advice:
+        return 0
+    if advice.strip().isdigit():
+        return int(advice)
+    advised_time = parsedate_tz(advice)
+    if advised_time is None:
+        return 0
+    return max(0, int(mktime_tz(advised_time) - time.time()))
+
+
+class RateLimiter(object):
+    """
+    A token bucket that paces the UMAPI calls of all the connectors in a run to a configured rate, allowing bursts
+    of up to burst calls.  It adapts to the server: each throttled (429) response halves the rate and a Retry-After
+    pauses all calls for the advised time, while every burst's worth of healthy responses in a row brings the
+    rate back up by a tenth of the configured rate.
+    """
+
+    def __init__(self, rate, burst, logger):
+        """
+        :param rate: the number of calls per second
+        :type rate: float
+        :type burst: int
+        :type logger: logging.Logger
+        """
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = self.max_rate / 16
+        self.burst = max(burst, 1)
+        self.logger = logger
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.paused_until = 0
+        self.healthy_count = 0
+        self.lock = threading.Lock()
+        # statistics for the action summary
+        self.call_count = 0
+        self.throttled_count = 0
+        self.wait_seconds = 0.0
+
+    def reserve(self):
+        """
+        Take a token for a call.
+        :return: the number of seconds the caller must wait before making the call
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.paused_until - now, 0)
+            self.call_count += 1
+            self.wait_seconds += wait
+            return wait
+
+    def acquire(self):
+        """
+        Wait until a call can be made.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def report(self, status_code, retry_after=0):
+        """
+        Note the response to a call, and adapt the rate to it.
+        :type status_code: int
+        :param retry_after: the seconds to wait advised by the response's Retry-After header
+        """
+        with self.lock:
+            if status_code == 429 or retry_after:
+                self.throttled_count += 1
+                self.healthy_count = 0
+                self.rate = max(self.min_rate, self.rate / 2)
+                # the calls already reserved must wait too
+                self.tokens = min(self.tokens, 0)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.time() + retry_after)
+                self.logger.info('UMAPI is throttling calls; slowing down to %.2f calls per second', self.rate)
+            elif status_code < 400:
+                self.healthy_count += 1
+                if self.rate < self.max_rate and self.healthy_count >= self.burst:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+                    self.healthy_count = 0
+                    self.logger.debug('Speeding up to %.2f UMAPI calls per second', self.rate)
+
+    def get_statistics(self):
+        """
+        :return: tuple (current rate, configured rate, calls made, calls throttled, total seconds waited)
+        """
+        with self.lock:
+            return self.rate, self.max_rate, self.call_count, self.throttled_count, self.wait_seconds
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    An HTTP adapter that makes its calls at the pace set by a rate limiter, and reports the responses back to it.
+    """
+
+    def __init__(self, rate_limiter, **kwargs):
+        """
+        :type rate_limiter: RateLimiter
+        """
+        self.rate_limiter = rate_limiter
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.acquire()
+        response = requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+        self.rate_limiter.report(response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+        return response
@@ -41,6 +41,39 @@ def normalize_string(string_value):
     return string_value.strip().lower() if string_value is not None else None
 
 
+# the number of strings in each generation of the normalize_shared_string cache
+NORMALIZE_CACHE_SIZE = 1 << 16
+
+# normalized strings by the strings they were made from.  Each normalized string is also its own key,
+# so strings that normalize the same share one normalized string.  When the current generation is full,
+# it becomes the previous one, whose strings are moved back to the current one as they are used again.
+_normalized_strings = {}
+_previous_normalized_strings = {}
+
+
+def normalize_shared_string(string_value):
+    """
+    Normalize a string that many users share, such as a group name or a domain.  The normalized form of
+    recently used strings is remembered, so each is only normalized (and stored) once.  Strings that are
+    unique to a user, like emails, are cheaper to normalize with normalize_string.
+    :param string_value: either a unicode or regular string or None
+    :return: the same type that came in
+    """
+    global _normalized_strings, _previous_normalized_strings
+    if string_value is None:
+        return None
+    normalized = _normalized_strings.get(string_value)
+    if normalized is None:
+        normalized = _previous_normalized_strings.get(string_value)
+        if normalized is None:
+            normalized = string_value.strip().lower()
+        if len(_normalized_strings) >= NORMALIZE_CACHE_SIZE:
+            _previous_normalized_strings, _normalized_strings = _normalized_strings, {}
+        normalized = _normalized_strings.setdefault(normalized, normalized)
+        _normalized_strings[string_value] = normalized
+    return normalized
+
+
 class CSVAdapter:
     """
     Read and write CSV files to and from lists of dictionaries
@@ -1,4 +1,5 @@
 import logging
+import threading
 import six
 from copy import deepcopy
 from .connectors import get_connector
@@ -40,6 +41,8 @@ class PostSyncData:
     def __init__(self):
         self.umapi_data = {}
         self.source_attributes = {}
+        # umapi data may be updated by secondary umapis processed in parallel
+        self.lock = threading.Lock()
 
     def update_umapi_data(self, org_id, user_key, add_groups=[], remove_groups=[], **kwargs):
         """
@@ -50,42 +53,45 @@ class PostSyncData:
         :param list remove_groups:
         :return:
         """
-        if org_id not in self.umapi_data:
-            self.umapi_data[org_id] = {}
+        with self.lock:
+            if org_id not in self.umapi_data:
+                self.umapi_data[org_id] = {}
 
-        umapi_data = self.umapi_data[org_id]
-        user_store_data = umapi_data.get(user_key)
+            umapi_data = self.umapi_data[org_id]
+            user_store_data = umapi_data.get(user_key)
 
-        if user_store_data is None:
-            user_store_data = self._umapi_data_template()
+            if user_store_data is None:
+                user_store_data = self._umapi_data_template()
 
-        updated_store_data = deepcopy(user_store_data)
-        groups_to_add = set(self._normalize_groups(add_groups))
-        for k in updated_store_data:
-            if k not in kwargs:
-                continue
-            if k == 'groups':
-                groups_to_add |= set(self._normalize_groups(kwargs[k]))
-            else:
-                updated_store_data[k] = kwargs[k]
+            updated_store_data = deepcopy(user_store_data)
+            groups_to_add = set(self._normalize_groups(add_groups))
+            for k in updated_store_data:
+                if k not in kwargs:
+                    continue
+                if k == 'groups':
+                    groups_to_add |= set(self._normalize_groups(kwargs[k]))
+                else:
+                    updated_store_data[k] = kwargs[k]
 
-        updated_store_data['groups'] |= groups_to_add
-        updated_store_data['groups'] -= set(self._normalize_groups(remove_groups))
+            updated_store_data['groups'] |= groups_to_add
+            updated_store_data['groups'] -= set(self._normalize_groups(remove_groups))
 
-        self.umapi_data[org_id][user_key] = updated_store_data
+            self.umapi_data[org_id][user_key] = updated_store_data
 
     def remove_umapi_user_groups(self, org_id, user_key):
-        umapi_data = self.umapi_data.get(org_id)
-        user_store_data = umapi_data.get(user_key)
-        if user_store_data is None:
-            return
-        user_store_data['groups'] = []
+        with self.lock:
+            umapi_data = self.umapi_data.get(org_id)
+            user_store_data = umapi_data.get(user_key)
+            if user_store_data is None:
+                return
+            user_store_data['groups'] = []
 
     def remove_umapi_user(self, org_id, user_key):
-        umapi_data = self.umapi_data.get(org_id)
-        if not umapi_data or user_key not in umapi_data:
-            return
-        del umapi_data[user_key]
+        with self.lock:
+            umapi_data = self.umapi_data.get(org_id)
+            if not umapi_data or user_key not in umapi_data:
+                return
+            del umapi_data[user_key]
 
     def update_source_attributes(self, user_key, source_attributes):
         self.source_attributes[user_key] = source_attributes
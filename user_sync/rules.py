@@ -20,25 +20,50 @@
 # SOFTWARE.
 
 import logging
+import re
+import threading
 import six
-from itertools import chain
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
 
 import user_sync.connector.umapi
 import user_sync.error
 import user_sync.identity_type
 from user_sync.post_sync.manager import PostSyncData
-from user_sync.helper import normalize_string, CSVAdapter, JobStats
+from user_sync.helper import normalize_string, normalize_shared_string, CSVAdapter, JobStats
 
 GROUP_NAME_DELIMITER = '::'
 PRIMARY_UMAPI_NAME = None
 
+# numbered or named back-references, which would refer to the wrong group in a combined pattern
+BACK_REFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+def combine_patterns(patterns):
+    """
+    Combine compiled patterns into one that matches (at the start of a string) if any of them do.
+    Each pattern is wrapped in a group named pattern0, pattern1, ... so the lastgroup of a match
+    names the first pattern that matched.
+    :type patterns: list(re.Pattern)
+    :return: the combined pattern, or None if the patterns can't be combined
+    """
+    if len(patterns) < 2 or len({pattern.flags for pattern in patterns}) > 1:
+        return None
+    if any(BACK_REFERENCE.search(pattern.pattern) for pattern in patterns):
+        return None
+    try:
+        return re.compile('|'.join('(?P<pattern%d>%s)' % (i, pattern.pattern) for i, pattern in enumerate(patterns)),
+                          patterns[0].flags)
+    except re.error:
+        return None
+
 
 class RuleProcessor(object):
     # rule processing option defaults
     # these are in alphabetical order!  Always add new ones that way!
     default_options = {
         'adobe_group_filter': None,
+        'adobe_users_auto': False,
         'after_mapping_hook': None,
         'default_country_code': None,
         'delete_strays': False,
@@ -54,10 +79,16 @@ class RuleProcessor(object):
         'max_adobe_only_users': 200,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
         'remove_strays': False,
+        'resume_journal': False,
+        'secondary_fetch': 'full',
+        'secondary_parallelism': 1,
         'strategy': 'sync',
         'stray_list_input_path': None,
         'stray_list_output_path': None,
+        'targeted_lookups': 'never',
         'test_mode': False,
+        'umapi_burst': 10,
+        'umapi_requests_per_second': 0,
         'update_user_info': False,
         'username_filter_regex': None,
     }
@@ -69,10 +100,10 @@ class RuleProcessor(object):
         options = dict(self.default_options)
         options.update(caller_options)
         self.options = options
+        self.user_keys = UserKeyRegistry()
         self.directory_user_by_user_key = {}
         self.filtered_directory_user_by_user_key = {}
         self.umapi_info_by_name = {}
-        self.adobeid_user_by_email = {}
         # counters for action summary log
         self.action_summary = {
             # these are in alphabetical order!  Always add new ones that way!
@@ -91,8 +122,17 @@ class RuleProcessor(object):
 
         # save away the exclude options for use in filtering
         self.exclude_groups = self.normalize_groups(options['exclude_groups'])
-        self.exclude_identity_types = options['exclude_identity_types']
+        self.exclude_identity_types = frozenset(options['exclude_identity_types'])
         self.exclude_users = options['exclude_users']
+        self.exclude_users_pattern = combine_patterns(self.exclude_users)
+        # the number of Adobe users excluded by each exclusion rule, so that rules that never match can be found
+        self.exclusion_counts = OrderedDict()
+        for identity_type in options['exclude_identity_types']:
+            self.exclusion_counts[('exclude_identity_types', identity_type)] = 0
+        for group in sorted(self.exclude_groups):
+            self.exclusion_counts[('exclude_adobe_groups', group)] = 0
+        for re_ in self.exclude_users:
+            self.exclusion_counts[('exclude_users', re_.pattern)] = 0
 
         # There's a big difference between how we handle the primary umapi,
         # and how we handle secondary umapis.  We care about all the (non-excluded)
@@ -113,6 +153,8 @@ class RuleProcessor(object):
         self.primary_users_created = set()
         self.secondary_users_created = set()
         self.updated_user_keys = set()
+        # guards the counters that secondary umapis processed in parallel update
+        self.lock = threading.Lock()
 
         # stray key input path comes in, stray_list_output_path goes out
         self.stray_key_map = {}
@@ -134,6 +176,12 @@ class RuleProcessor(object):
             self.will_manage_strays = False
             self.will_process_strays = False
 
+        # looking up the selected users can't find Adobe-only users
+        if options['targeted_lookups'] == 'always' and (self.will_process_strays or options['stray_list_input_path']):
+            raise user_sync.error.AssertionException(
+                "targeted_lookups 'always' can't be used when Adobe-only users are processed; use "
+                "--adobe-only-user-action exclude, or targeted_lookups 'auto'")
+
         # in/out variables for per-user after-mapping-hook code
         self.after_mapping_hook_scope = {
             # in: attributes retrieved from customer directory system (eg 'c', 'givenName')
@@ -154,10 +202,6 @@ class RuleProcessor(object):
             'hook_storage': None,
         }
 
-        # map of username to email address for users that have an email-type username that
-        # differs from the user's email address
-        self.email_override = {}  # type: dict[str, str]
-
         # Data to provide to post-sync connectors
         self.post_sync_data = PostSyncData()
 
@@ -177,6 +221,7 @@ class RuleProcessor(object):
         """
         logger = self.logger
 
+        umapi_connectors.start_journals()
         self.prepare_umapi_infos()
 
         if directory_connector is not None:
@@ -202,6 +247,22 @@ class RuleProcessor(object):
         umapi_stats.log_end(logger)
         self.log_action_summary(umapi_connectors)
 
+    def resume_journal(self, umapi_connectors):
+        """
+        Send the actions that an earlier run journaled but never completed,
+        without reading either the directory or the Adobe organizations.
+        :type umapi_connectors: UmapiConnectors
+        """
+        logger = self.logger
+        umapi_stats = JobStats('Resume UMAPI actions from journal', divider="-")
+        umapi_stats.log_start(logger)
+        for connector in umapi_connectors.connectors:
+            action_count = connector.replay_journal()
+            logger.info('%s: resending %d unacknowledged actions', connector.name, action_count)
+        umapi_connectors.execute_actions()
+        umapi_stats.log_end(logger)
+        self.log_action_summary(umapi_connectors)
+
     def validate_and_log_additional_groups(self, umapi_info):
         """
         :param umapi_info: UmapiTargetInfo
@@ -294,12 +355,17 @@ class RuleProcessor(object):
             spacer = ''
             connectors = [('', umapi_connectors.get_primary_connector())]
 
+        rate_limiter = umapi_connectors.get_primary_connector().rate_limiter
+        rate_limit_description = 'UMAPI calls per second (current/limit, calls, throttled, seconds waited)'
+
         # to line up the stats, we pad them out to the longest stat description length,
         # so first we compute that pad length
         pad = 0
         for action_description in action_summary_description:
             if len(action_description[1]) > pad:
                 pad = len(action_description[1])
+        if rate_limiter is not None:
+            pad = max(pad, len(rate_limit_description))
         for name, _ in connectors:
             umapi_summary_description = umapi_summary_format % (spacer, name)
             if len(umapi_summary_description) > pad:
@@ -319,7 +385,13 @@ class RuleProcessor(object):
             sent, errors = umapi_connector.get_action_manager().get_statistics()
             description = (umapi_summary_format % (spacer, name)).rjust(pad, ' ')
             logger.info('  %s: (%s, %s, %s)', description, sent, sent - errors, errors)
+        if rate_limiter is not None:
+            rate, max_rate, calls, throttled, waited = rate_limiter.get_statistics()
+            logger.info('  %s: (%.2f/%.2f, %d, %d, %.1f)', rate_limit_description.rjust(pad, ' '),
+                        rate, max_rate, calls, throttled, waited)
         logger.info('------------------------------------------------------------------------------------')
+        if not self.push_umapi:
+            self.log_exclusion_counts()
 
     def is_primary_org(self, umapi_info):
         return umapi_info.get_name() == PRIMARY_UMAPI_NAME
@@ -361,6 +433,11 @@ class RuleProcessor(object):
         extended_attributes = options.get('extended_attributes')
 
         directory_user_by_user_key = self.directory_user_by_user_key
+        target_groups_by_signature = {}
+        desired_groups_by_target_groups = {}
+        # the additional groups of each member group, in each umapi; many users share each member group
+        additional_group_matcher = AdditionalGroupMatcher(options.get('additional_groups', []))
+        desired_groups_by_member_group = {}
 
         directory_groups = set(six.iterkeys(mappings)) if self.will_process_groups() else set()
         if directory_group_filter is not None:
@@ -376,7 +453,8 @@ class RuleProcessor(object):
                 continue
             directory_user_by_user_key[user_key] = directory_user
 
-            if not self.is_directory_user_in_groups(directory_user, directory_group_filter):
+            if directory_group_filter is not None and \
+                    not self.is_directory_user_in_groups(directory_user, directory_group_filter):
                 continue
             if not self.is_selected_user_key(user_key):
                 continue
@@ -385,18 +463,20 @@ class RuleProcessor(object):
             self.post_sync_data.update_source_attributes(user_key, directory_user['source_attributes'])
             self.get_umapi_info(PRIMARY_UMAPI_NAME).add_desired_group_for(user_key, None)
 
-            # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
-            self.after_mapping_hook_scope['source_groups'] = set()
-            self.after_mapping_hook_scope['target_groups'] = set()
-            for group in directory_user['groups']:
-                self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
-                adobe_groups = mappings.get(group)
-                if adobe_groups is not None:
-                    for adobe_group in adobe_groups:
-                        self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
-
-            # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
+            # most users share one of a few combinations of directory groups, so the target groups of each
+            # combination, and the desired groups in each umapi for each combination of target groups, are
+            # worked out once
+            directory_user_groups = directory_user['groups']
+            directory_groups_signature = frozenset(directory_user_groups)
+            target_groups = target_groups_by_signature.get(directory_groups_signature)
+            if target_groups is None:
+                target_groups = self.map_directory_groups(directory_groups_signature, mappings)
+                target_groups_by_signature[directory_groups_signature] = target_groups
+
+            # only if there actually is hook code: set up hook scope, invoke hook, update user attributes
             if options['after_mapping_hook'] is not None:
+                self.after_mapping_hook_scope['source_groups'] = set(directory_user_groups)
+                self.after_mapping_hook_scope['target_groups'] = set(target_groups)
                 self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
 
                 target_attributes = dict()
@@ -415,32 +495,22 @@ class RuleProcessor(object):
 
                 # copy modified attributes back to the user object
                 directory_user.update(self.after_mapping_hook_scope['target_attributes'])
-
-            for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
-                target_group = AdobeGroup.lookup(target_group_qualified_name)
-                if target_group is not None:
-                    umapi_info = self.get_umapi_info(target_group.get_umapi_name())
-                    umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
-                else:
-                    self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
-
-            additional_groups = self.options.get('additional_groups', [])
-            member_groups = directory_user.get('member_groups', [])
-            for member_group in member_groups:
-                for group_rule in additional_groups:
-                    source = group_rule['source']
-                    target = group_rule['target']
-                    target_name = target.get_group_name()
-                    umapi_info = self.get_umapi_info(target.get_umapi_name())
-                    if not group_rule['source'].match(member_group):
-                        continue
-                    try:
-                        rename_group = source.sub(target_name, member_group)
-                    except Exception as e:
-                        raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
-                    umapi_info.add_mapped_group(rename_group)
-                    umapi_info.add_additional_group(rename_group, member_group)
-                    umapi_info.add_desired_group_for(user_key, rename_group)
+                target_groups = frozenset(self.after_mapping_hook_scope['target_groups'])
+
+            desired_groups_by_umapi = desired_groups_by_target_groups.get(target_groups)
+            if desired_groups_by_umapi is None:
+                desired_groups_by_umapi = self.resolve_target_groups(target_groups)
+                desired_groups_by_target_groups[target_groups] = desired_groups_by_umapi
+            for umapi_info, desired_groups in desired_groups_by_umapi:
+                umapi_info.add_desired_groups_for(user_key, desired_groups)
+
+            for member_group in directory_user.get('member_groups', []):
+                desired_groups = desired_groups_by_member_group.get(member_group)
+                if desired_groups is None:
+                    desired_groups = self.resolve_member_group(additional_group_matcher, member_group)
+                    desired_groups_by_member_group[member_group] = desired_groups
+                for umapi_info, normalized_groups in desired_groups:
+                    umapi_info.add_desired_groups_for(user_key, normalized_groups)
 
         self.logger.debug('Total directory users after filtering: %d', len(self.filtered_directory_user_by_user_key))
         if self.logger.isEnabledFor(logging.DEBUG):
@@ -448,6 +518,58 @@ class RuleProcessor(object):
                                                            for umapi_name, umapi_info
                                                            in six.iteritems(self.umapi_info_by_name)]))
 
+    @staticmethod
+    def map_directory_groups(directory_groups, mappings):
+        """
+        :type directory_groups: frozenset(str)
+        :type mappings: dict(str, list(AdobeGroup))
+        :return: the qualified names of the adobe groups mapped from the directory groups
+        :rtype: frozenset(str)
+        """
+        target_groups = set()
+        for group in directory_groups:
+            adobe_groups = mappings.get(group)
+            if adobe_groups is not None:
+                for adobe_group in adobe_groups:
+                    target_groups.add(adobe_group.get_qualified_name())
+        return frozenset(target_groups)
+
+    def resolve_target_groups(self, target_groups):
+        """
+        :type target_groups: frozenset(str)
+        :return: the desired (normalized) groups in each umapi that has any of the target groups
+        :rtype: list(tuple(UmapiTargetInfo, frozenset(str)))
+        """
+        groups_by_umapi_name = defaultdict(set)
+        for target_group_qualified_name in target_groups:
+            target_group = AdobeGroup.lookup(target_group_qualified_name)
+            if target_group is not None:
+                groups_by_umapi_name[target_group.get_umapi_name()].add(
+                    normalize_shared_string(target_group.get_group_name()))
+            else:
+                self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+        return [(self.get_umapi_info(umapi_name), frozenset(groups))
+                for umapi_name, groups in six.iteritems(groups_by_umapi_name)]
+
+    def resolve_member_group(self, additional_group_matcher, member_group):
+        """
+        Find the additional groups of a member group, and note them as mapped groups of their umapis.
+        :type additional_group_matcher: AdditionalGroupMatcher
+        :type member_group: str
+        :return: the desired (normalized) groups in each umapi that the member group maps to
+        :rtype: list(tuple(UmapiTargetInfo, tuple(str)))
+        """
+        for target in additional_group_matcher.iter_targets():
+            self.get_umapi_info(target.get_umapi_name())
+        groups_by_umapi_name = defaultdict(list)
+        for target, rename_group in additional_group_matcher.match(member_group):
+            umapi_info = self.get_umapi_info(target.get_umapi_name())
+            umapi_info.add_mapped_group(rename_group)
+            umapi_info.add_additional_group(rename_group, member_group)
+            groups_by_umapi_name[target.get_umapi_name()].append(normalize_shared_string(rename_group))
+        return [(self.get_umapi_info(umapi_name), tuple(groups))
+                for umapi_name, groups in six.iteritems(groups_by_umapi_name)]
+
     def is_directory_user_in_groups(self, directory_user, groups):
         """
         :type directory_user: dict
@@ -500,35 +622,70 @@ class RuleProcessor(object):
             self.primary_users_created.add(user_key)
             self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
 
-        # then sync the secondary connectors
-        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
-            umapi_info = self.get_umapi_info(umapi_name)
-            if len(umapi_info.get_mapped_groups()) == 0:
-                continue
-            self.logger.debug('%sing users to secondary umapi %s...', verb, umapi_name)
-            if self.push_umapi:
-                secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
-            else:
-                secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
-            total_users = len(secondary_adds_by_user_key)
-            for user_key, groups_to_add in six.iteritems(secondary_adds_by_user_key):
-                # We only create users who have group mappings in the secondary umapi
-                if groups_to_add:
-                    self.logger.progress(user_count, total_users,
-                                         'Adding user to umapi {0} with user key: {1}'.format(umapi_name, user_key))
-                    self.secondary_users_created.add(user_key)
-                    if user_key not in self.primary_users_created:
-                        # We pushed an existing user to a secondary in order to update his groups
-                        self.updated_user_keys.add(user_key)
-                    self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
+        # then sync the secondary connectors, which only depend on the users included from the primary
+        results = self.for_each_secondary(umapi_connectors, self.sync_secondary_umapi_users, verb)
+        for umapi_name, (users_read, users_added) in results:
+            if users_read is not None:
+                self.logger.info('%sed secondary umapi %s: %d users read, %d users added',
+                                 verb, umapi_name, users_read, users_added)
+
+    def for_each_secondary(self, umapi_connectors, function, *args):
+        """
+        Call function(umapi_name, umapi_connector, *args) for each secondary umapi connector, running up to
+        secondary_parallelism of them at once.  Each connector is only used by the call made for it.
+        :type umapi_connectors: UmapiConnectors
+        :return: list of (umapi_name, result), in connector order whatever order the calls finished in
+        """
+        secondaries = list(six.iteritems(umapi_connectors.get_secondary_connectors()))
+        parallelism = min(self.options['secondary_parallelism'], len(secondaries))
+        if parallelism <= 1:
+            return [(name, function(name, connector, *args)) for name, connector in secondaries]
+        self.logger.debug('Processing %d secondary umapis, %d at a time', len(secondaries), parallelism)
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = [(name, executor.submit(function, name, connector, *args)) for name, connector in secondaries]
+            return [(name, future.result()) for name, future in futures]
+
+    def sync_secondary_umapi_users(self, umapi_name, umapi_connector, verb):
+        """
+        Read, diff and update the users of one secondary umapi, once the primary has been synced.
+        :type umapi_name: str
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :return: (users read, users added), or (None, None) if nothing is mapped to this umapi
+        """
+        umapi_info = self.get_umapi_info(umapi_name)
+        if len(umapi_info.get_mapped_groups()) == 0:
+            return None, None
+        self.logger.debug('%sing users to secondary umapi %s...', verb, umapi_name)
+        if self.push_umapi:
+            secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+        else:
+            secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+        total_users = len(secondary_adds_by_user_key)
+        users_added = 0
+        for user_key, groups_to_add in six.iteritems(secondary_adds_by_user_key):
+            # We only create users who have group mappings in the secondary umapi
+            if groups_to_add:
+                users_added += 1
+                self.logger.progress(users_added, total_users,
+                                     'Adding user to umapi {0} with user key: {1}'.format(umapi_name, user_key))
+                self.secondary_users_created.add(user_key)
+                if user_key not in self.primary_users_created:
+                    # We pushed an existing user to a secondary in order to update his groups
+                    self.updated_user_keys.add(user_key)
+                self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
+        # send this umapi's actions while the other secondaries are still being processed
+        umapi_connector.flush()
+        return len(umapi_info.umapi_user_by_user_key), users_added
 
     def create_umapi_groups(self, umapi_connectors):
         """
         This is where we create user-groups. If auto_create is enabled,
         this will pull user-groups from console and compare with mapped_groups. If mapped group does exist
-        in the console, then it will create. Note: Push Mode is not supported
+        in the console, then it will create. Note: Push Mode is not supported.
+        The groups for each connector are created in batches, and the connectors are handled concurrently.
         :type umapi_connectors: UmapiConnectors
         """
+        work = []
         for umapi_connector in umapi_connectors.connectors:
             umapi_name = None if umapi_connector.name.split('.')[-1] == 'primary' \
                 else umapi_connector.name.split('.')[-1]
@@ -536,25 +693,45 @@ class RuleProcessor(object):
                 umapi_name = None
             if umapi_name not in self.umapi_info_by_name:
                 continue
-            umapi_info = self.umapi_info_by_name[umapi_name]
-            mapped_groups = umapi_info.get_non_normalize_mapped_groups()
+            work.append((umapi_name, umapi_connector))
+        if len(work) <= 1:
+            for umapi_name, umapi_connector in work:
+                self.create_umapi_groups_for_connector(umapi_name, umapi_connector)
+            return
+        with ThreadPoolExecutor(max_workers=len(work)) as executor:
+            futures = [executor.submit(self.create_umapi_groups_for_connector, umapi_name, umapi_connector)
+                       for umapi_name, umapi_connector in work]
+            for future in futures:
+                future.result()
 
-            # pull all user groups from console
-            on_adobe_groups = [normalize_string(g['groupName']) for g in umapi_connector.get_groups()]
+    def create_umapi_groups_for_connector(self, umapi_name, umapi_connector):
+        """
+        Create the mapped groups that don't exist in one umapi.
+        :type umapi_name: str
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        """
+        org_name = umapi_name if umapi_name else 'primary org'
+        mapped_groups = self.umapi_info_by_name[umapi_name].get_non_normalize_mapped_groups()
 
-            # verify if group exist and create
-            for mapped_group in mapped_groups:
-                if normalize_string(mapped_group) in on_adobe_groups:
-                    continue
-                self.logger.info("Auto create user-group enabled: Creating '{}' on '{}'".format(
-                    mapped_group, umapi_name if umapi_name else 'primary org'))
-                try:
-                    # create group
-                    res = umapi_connector.create_group(mapped_group)
-                    self.action_summary['adobe_user_groups_created'] += 1
-                except Exception as e:
-                    self.logger.critical("Unable to create %s user group: '{}' on '{}' (error: {})".format(
-                        mapped_group, umapi_name if umapi_name else 'primary org', e))
+        # index all user groups from console
+        on_adobe_groups = {normalize_shared_string(g['groupName']) for g in umapi_connector.iter_groups()}
+
+        groups_to_create = []
+        for mapped_group in mapped_groups:
+            normalized_group = normalize_shared_string(mapped_group)
+            if normalized_group in on_adobe_groups:
+                continue
+            on_adobe_groups.add(normalized_group)
+            self.logger.info("Auto create user-group enabled: Creating '{}' on '{}'".format(mapped_group, org_name))
+            groups_to_create.append(mapped_group)
+        if not groups_to_create:
+            return
+        failures = umapi_connector.create_groups(groups_to_create)
+        for group_name, error in failures:
+            self.logger.critical("Unable to create user group: '{}' on '{}' (error: {})".format(
+                group_name, org_name, error))
+        with self.lock:
+            self.action_summary['adobe_user_groups_created'] += len(groups_to_create) - len(failures)
 
     def is_selected_user_key(self, user_key):
         """
@@ -631,51 +808,14 @@ class RuleProcessor(object):
         primary_strays = self.get_stray_keys()
         self.action_summary['primary_strays_processed'] = total_strays = len(primary_strays)
 
-        # convenience function to get umapi Commands given a user key
-        def get_commands(key):
-            """Given a user key, returns the umapi commands targeting that user"""
-            id_type, username, domain = self.parse_user_key(key)
-            if '@' in username and username in self.email_override:
-                username = self.email_override[username]
-            return user_sync.connector.umapi.Commands(identity_type=id_type, username=username, domain=domain)
-
         # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end
-        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
-            secondary_strays = self.get_stray_keys(umapi_name)
-            for user_key in primary_strays:
-                if user_key in secondary_strays:
-                    commands = get_commands(user_key)
-                    if disentitle_strays:
-                        self.logger.info('Removing all adobe groups in %s for Adobe-only user: %s',
-                                         umapi_name, user_key)
-                        self.post_sync_data.remove_umapi_user_groups(umapi_name, user_key)
-                        commands.remove_all_groups()
-                    elif remove_strays or delete_strays:
-                        self.logger.info('Removing Adobe-only user from %s: %s',
-                                         umapi_name, user_key)
-                        self.post_sync_data.remove_umapi_user(umapi_name, user_key)
-                        commands.remove_from_org(False)
-                    elif manage_stray_groups:
-                        groups_to_remove = secondary_strays[user_key]
-                        if groups_to_remove:
-                            self.logger.info('Removing mapped groups in %s from Adobe-only user: %s',
-                                             umapi_name, user_key)
-                            self.post_sync_data.update_umapi_data(umapi_name, user_key, [], groups_to_remove)
-                            commands.remove_groups(groups_to_remove)
-                        else:
-                            continue
-                    else:
-                        # haven't done anything, don't send commands
-                        continue
-                    umapi_connector.send_commands(commands)
-            # make sure the commands for each umapi are executed before moving to the next
-            umapi_connector.get_action_manager().flush()
+        self.for_each_secondary(umapi_connectors, self.manage_secondary_strays, primary_strays)
 
         # finish with the primary umapi
         primary_connector = umapi_connectors.get_primary_connector()
         for i, user_key in enumerate(primary_strays):
             per = round(100*(float(i)/float(total_strays)),3)
-            commands = get_commands(user_key)
+            commands = self.get_stray_commands(user_key, self.get_umapi_info(PRIMARY_UMAPI_NAME))
             if disentitle_strays:
                 self.logger.info('Removing all adobe groups for Adobe-only user: %s', user_key)
                 self.post_sync_data.remove_umapi_user_groups(None, user_key)
@@ -698,7 +838,64 @@ class RuleProcessor(object):
                 continue
             primary_connector.send_commands(commands)
         # make sure the actions get sent
-        primary_connector.get_action_manager().flush()
+        primary_connector.flush()
+
+    def get_stray_commands(self, user_key, umapi_info):
+        """
+        Given a user key, returns the umapi commands targeting that user in the given umapi.
+        The commands carry the umapi user's email (when the user was read), so that the actions are queued
+        with the user's other actions, which are keyed by email.
+        :type umapi_info: UmapiTargetInfo
+        """
+        id_type, username, domain = self.parse_user_key(user_key)
+        if '@' in username and username in umapi_info.email_override:
+            username = umapi_info.email_override[username]
+        umapi_user = umapi_info.get_umapi_user(user_key)
+        email = umapi_user.get('email') if umapi_user is not None else None
+        return user_sync.connector.umapi.Commands(identity_type=id_type, email=email, username=username,
+                                                  domain=domain)
+
+    def manage_secondary_strays(self, umapi_name, umapi_connector, primary_strays):
+        """
+        Manage the primary strays that are also strays in one secondary umapi.
+        :type umapi_name: str
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :type primary_strays: dict
+        """
+        manage_stray_groups = self.will_process_groups()
+        disentitle_strays = self.options['disentitle_strays']
+        remove_strays = self.options['remove_strays']
+        delete_strays = self.options['delete_strays']
+        secondary_strays = self.get_stray_keys(umapi_name)
+        umapi_info = self.get_umapi_info(umapi_name)
+        for user_key in primary_strays:
+            if user_key in secondary_strays:
+                commands = self.get_stray_commands(user_key, umapi_info)
+                if disentitle_strays:
+                    self.logger.info('Removing all adobe groups in %s for Adobe-only user: %s',
+                                     umapi_name, user_key)
+                    self.post_sync_data.remove_umapi_user_groups(umapi_name, user_key)
+                    commands.remove_all_groups()
+                elif remove_strays or delete_strays:
+                    self.logger.info('Removing Adobe-only user from %s: %s',
+                                     umapi_name, user_key)
+                    self.post_sync_data.remove_umapi_user(umapi_name, user_key)
+                    commands.remove_from_org(False)
+                elif manage_stray_groups:
+                    groups_to_remove = secondary_strays[user_key]
+                    if groups_to_remove:
+                        self.logger.info('Removing mapped groups in %s from Adobe-only user: %s',
+                                         umapi_name, user_key)
+                        self.post_sync_data.update_umapi_data(umapi_name, user_key, [], groups_to_remove)
+                        commands.remove_groups(groups_to_remove)
+                    else:
+                        continue
+                else:
+                    # haven't done anything, don't send commands
+                    continue
+                umapi_connector.send_commands(commands)
+        # make sure the commands for each umapi are executed before moving to the next
+        umapi_connector.flush()
 
     @staticmethod
     def get_user_attributes(directory_user):
@@ -719,12 +916,15 @@ class RuleProcessor(object):
             self.logger.error('Found adobe user with no identity type, using %s: %s', identity_type, umapi_user)
         return identity_type
 
-    def create_umapi_commands_for_directory_user(self, directory_user, do_update=False, console_trusted=False):
+    def create_umapi_commands_for_directory_user(self, directory_user, do_update=False, console_trusted=False,
+                                                 umapi_info=None):
         """
         Make the umapi commands to create this user, based on his directory attributes and type.
         Update the attributes of an existing user if do_update is True.
         :type directory_user: dict
         :type do_update: bool
+        :param umapi_info: the umapi the user is created in (the primary if not given)
+        :type umapi_info: UmapiTargetInfo
         :return user_sync.connector.umapi.Commands (or None if there's an error)
         """
         identity_type = self.get_identity_type_from_directory_user(directory_user)
@@ -733,7 +933,7 @@ class RuleProcessor(object):
         # check to see if AdobeID exist for FederatedID/EnterpriseID user. Skip user if same email exist.
         if ((identity_type == user_sync.identity_type.FEDERATED_IDENTITY_TYPE or
              identity_type == user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE) and
-                self.is_adobeID_email_exist(directory_user['email'])):
+                self.is_adobeID_email_exist(directory_user['email'], umapi_info)):
             self.logger.warning("Skipping user creation for: %s - AdobeID already exists with %s",
                                 self.get_directory_user_key(directory_user), directory_user['email'])
             return None
@@ -787,8 +987,11 @@ class RuleProcessor(object):
         :type umapi_connector: user_sync.connector.umapi.UmapiConnector
         """
         directory_user = self.directory_user_by_user_key[user_key]
+        if not self.is_primary_org(umapi_info):
+            # secondaries are synced in parallel, so each works on its own copy of the shared directory user
+            directory_user = directory_user.copy()
         commands = self.create_umapi_commands_for_directory_user(directory_user, self.will_update_user_info(umapi_info),
-                                                                 umapi_connector.trusted)
+                                                                 umapi_connector.trusted, umapi_info)
         if not commands:
             return
         if self.will_process_groups():
@@ -850,20 +1053,32 @@ class RuleProcessor(object):
             directory_user = umapi_user
             identity_type = umapi_user.get('type')
 
+        directory_username_override = ('@' in directory_user['username'] and
+                                       normalize_string(directory_user['email']) !=
+                                       normalize_string(directory_user['username']))
+        umapi_username_override = ('@' in umapi_user['username'] and
+                                   normalize_string(umapi_user['username']) != normalize_string(umapi_user['email']))
+        email_update = bool(attributes_to_update) and 'email' in attributes_to_update
+        if (directory_user is not umapi_user and not self.is_primary_org(umapi_info) and
+                ((directory_username_override and (groups_to_add or groups_to_remove or attributes_to_update)) or
+                 (email_update and umapi_username_override))):
+            # secondaries are synced in parallel, so the overrides below go on a copy of the shared directory user
+            directory_user = directory_user.copy()
+
         # if user has email-type username and it is different from email address, then we need to
         # override the username with email address
-        if '@' in directory_user['username'] and normalize_string(directory_user['email']) != normalize_string(directory_user['username']):
+        if directory_username_override:
             if groups_to_add or groups_to_remove or attributes_to_update:
                 directory_user['username'] = directory_user['email']
-            if attributes_to_update and 'email' in attributes_to_update:
+            if email_update:
                 directory_user['email'] = umapi_user['email']
                 attributes_to_update['username'] = umapi_user['username']
                 directory_user['username'] = umapi_user['email']
 
         # if email based username on umapi is differ than email on umapi and need to update email, then we need to
         # override the username with email address
-        if '@' in umapi_user['username'] and normalize_string(umapi_user['username']) != normalize_string(umapi_user['email']):
-            if attributes_to_update and 'email' in attributes_to_update:
+        if umapi_username_override:
+            if email_update:
                 directory_user['email'] = umapi_user['email']
                 directory_user['username'] = umapi_user['email']
 
@@ -900,6 +1115,7 @@ class RuleProcessor(object):
         in_primary_org = self.is_primary_org(umapi_info)
         update_user_info = self.will_update_user_info(umapi_info)
         process_groups = self.will_process_groups()
+        targeted = in_primary_org and self.will_use_targeted_lookups(umapi_connector)
 
         # prepare the strays map if we are going to be processing them
         if self.will_process_strays:
@@ -907,13 +1123,17 @@ class RuleProcessor(object):
 
         if self.options['adobe_group_filter'] is not None:
             umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        elif targeted:
+            umapi_users = umapi_connector.lookup_users(self.get_directory_user_ids())
+        elif not in_primary_org and self.options['secondary_fetch'] == 'restricted':
+            umapi_users = self.get_included_umapi_users(umapi_info, umapi_connector)
         else:
             umapi_users = umapi_connector.iter_users()
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
         for umapi_user in umapi_users:
             # let save adobeID users to a seperate list
-            self.filter_adobeID_user(umapi_user)
+            self.filter_adobeID_user(umapi_info, umapi_user)
             # get the basic data about this user; initialize change markers to "no change"
             user_key = self.get_umapi_user_key(umapi_user)
             if not user_key:
@@ -939,7 +1159,7 @@ class RuleProcessor(object):
             if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
                 continue
 
-            self.map_email_override(umapi_user)
+            self.map_email_override(umapi_info, umapi_user)
 
             directory_user = filtered_directory_user_by_user_key.get(user_key)
             if directory_user is None:
@@ -948,7 +1168,8 @@ class RuleProcessor(object):
                 # for removal from any mapped groups.
                 if self.exclude_strays:
                     self.logger.debug("Excluding Adobe-only user: %s", user_key)
-                    self.excluded_user_count += 1
+                    with self.lock:
+                        self.excluded_user_count += 1
                 elif self.will_process_strays:
                     self.logger.debug("Found Adobe-only user: %s", user_key)
                     self.add_stray(umapi_info.get_name(), user_key,
@@ -973,25 +1194,102 @@ class RuleProcessor(object):
         umapi_info.set_umapi_users_loaded()
         return user_to_group_map
 
-    def map_email_override(self, umapi_user):
+    @staticmethod
+    def map_email_override(umapi_info, umapi_user):
         """
         for users with email-type usernames that don't match the email address, we need to add some
         special cases to update and disentitle users
+        :param umapi_info: UmapiTargetInfo
         :param umapi_user: dict
         :return:
         """
         email = umapi_user.get('email', '')
         username = umapi_user.get('username', '')
         if '@' in username and username != email:
-            self.email_override[username] = email
+            umapi_info.email_override[username] = email
 
-    @staticmethod
-    def get_umapi_user_in_groups(umapi_info, umapi_connector, groups):
-        umapi_users_iters = []
-        for group in groups:
-            if group.get_umapi_name() == umapi_info.get_name():
-                umapi_users_iters.append(umapi_connector.iter_users(in_group=group.get_group_name()))
-        return chain.from_iterable(umapi_users_iters)
+    def get_umapi_user_in_groups(self, umapi_info, umapi_connector, groups):
+        group_names = [group.get_group_name() for group in groups if group.get_umapi_name() == umapi_info.get_name()]
+        return umapi_connector.iter_users_in_groups(group_names, choose_plan=self.options['adobe_users_auto'])
+
+    def will_use_targeted_lookups(self, umapi_connector):
+        """
+        Decide whether to look up the selected directory users in the primary umapi one by one, instead
+        of reading all its users.  That is off unless targeted_lookups is set.  With 'auto', they are
+        looked up when that takes fewer calls than reading all the pages of users, and Adobe-only users
+        aren't being processed (since they can't be found without reading every user).  'always' is only allowed when Adobe-only users
+        aren't processed.
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :rtype: bool
+        """
+        mode = self.options['targeted_lookups']
+        if mode == 'never' or self.push_umapi or self.options['adobe_group_filter'] is not None:
+            return False
+        lookup_count = len(self.filtered_directory_user_by_user_key)
+        if mode == 'auto':
+            # reading a current snapshot doesn't call UMAPI at all
+            if self.will_process_strays or umapi_connector.is_snapshot_current():
+                return False
+            user_count, full_pages, _ = umapi_connector.get_user_page_info()
+            if lookup_count >= full_pages:
+                self.logger.debug('Reading all %d users (%d pages) rather than looking up %d users',
+                                  user_count, full_pages, lookup_count)
+                return False
+            self.logger.info('Looking up %d selected users rather than reading all %d users (%d pages)',
+                             lookup_count, user_count, full_pages)
+        else:
+            self.logger.info('Looking up %d selected users', lookup_count)
+        return True
+
+    def get_directory_user_ids(self):
+        """
+        :return: the ids to look the selected directory users up with: each an email, or (username, domain)
+        for a username that isn't the user's email.  An email-type username that differs from the email is
+        looked up in its own domain unless the directory user has a domain.
+        """
+        user_ids = []
+        for directory_user in six.itervalues(self.filtered_directory_user_by_user_key):
+            username = directory_user.get('username')
+            email = directory_user.get('email')
+            if not username:
+                user_ids.append(email)
+            elif '@' not in username:
+                user_ids.append((username, directory_user.get('domain')))
+            elif email and normalize_string(username) != normalize_string(email):
+                user_ids.append((username, directory_user.get('domain') or username[username.index('@') + 1:]))
+            else:
+                user_ids.append(username)
+        return user_ids
+
+    def get_included_umapi_users(self, umapi_info, umapi_connector):
+        """
+        In a secondary umapi, only the users included from the primary umapi are synced, so only they
+        are read: either by reading the mapped groups or by looking up each included user, whichever
+        takes fewer calls.  Group reads miss the users in no mapped group, so they are only used when
+        Adobe-only users don't have to be removed (or disentitled) from the secondary.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :return: iterator of user dicts
+        """
+        primary_info = self.get_umapi_info(PRIMARY_UMAPI_NAME)
+        emails = set()
+        for user_key in self.included_user_keys:
+            primary_user = primary_info.get_umapi_user(user_key)
+            if primary_user is not None and primary_user.get('email'):
+                emails.add(primary_user['email'])
+        emails = sorted(emails)
+        group_names = list(umapi_info.get_non_normalize_mapped_groups())
+        group_pages = None
+        if not (self.will_process_strays and (self.options['disentitle_strays'] or self.options['remove_strays'] or
+                                              self.options['delete_strays'])):
+            group_pages = umapi_connector.estimate_group_read_pages(self.normalize_groups(group_names))
+        if group_pages is not None and group_pages < len(emails):
+            self.logger.info('Reading %d mapped groups (about %d pages) from secondary umapi %s, '
+                             'rather than looking up %d users', len(group_names), group_pages,
+                             umapi_info.get_name(), len(emails))
+            return umapi_connector.iter_users_in_groups(group_names)
+        self.logger.info('Looking up %d users in secondary umapi %s', len(emails), umapi_info.get_name())
+        return umapi_connector.lookup_users(emails)
 
     def is_umapi_user_excluded(self, in_primary_org, user_key, current_groups):
         if in_primary_org:
@@ -1001,16 +1299,20 @@ class RuleProcessor(object):
             if identity_type in self.exclude_identity_types:
                 self.logger.debug("Excluding adobe user (due to type): %s", user_key)
                 self.excluded_user_count += 1
+                self.exclusion_counts[('exclude_identity_types', identity_type)] += 1
                 return True
-            if len(current_groups & self.exclude_groups) > 0:
+            if not self.exclude_groups.isdisjoint(current_groups):
                 self.logger.debug("Excluding adobe user (due to group): %s", user_key)
                 self.excluded_user_count += 1
+                for group in self.exclude_groups & current_groups:
+                    self.exclusion_counts[('exclude_adobe_groups', group)] += 1
+                return True
+            re_ = self.match_exclude_users(username)
+            if re_ is not None:
+                self.logger.debug("Excluding adobe user (due to name): %s", user_key)
+                self.excluded_user_count += 1
+                self.exclusion_counts[('exclude_users', re_.pattern)] += 1
                 return True
-            for re_ in self.exclude_users:
-                if re_.match(username):
-                    self.logger.debug("Excluding adobe user (due to name): %s", user_key)
-                    self.excluded_user_count += 1
-                    return True
             self.included_user_keys.add(user_key)
             return False
         else:
@@ -1018,13 +1320,47 @@ class RuleProcessor(object):
             #  doesn't match an included user from the primary umapi
             return user_key not in self.included_user_keys
 
-    def filter_adobeID_user(self, umapi_user):
+    def match_exclude_users(self, username):
+        """
+        :type username: str
+        :return: the first exclude_users pattern that matches the username, or None
+        """
+        if self.exclude_users_pattern is not None:
+            match = self.exclude_users_pattern.match(username)
+            return self.exclude_users[int(match.lastgroup[len('pattern'):])] if match else None
+        for re_ in self.exclude_users:
+            if re_.match(username):
+                return re_
+        return None
+
+    def log_exclusion_counts(self):
+        """
+        Log the number of Adobe users excluded by each exclusion rule.  A user in more than one excluded group
+        is counted for each of them.
+        """
+        if not self.exclusion_counts:
+            return
+        self.logger.info('Adobe users excluded by each exclusion rule:')
+        for (option, rule), count in six.iteritems(self.exclusion_counts):
+            if option == 'exclude_users' and rule.startswith('\\A') and rule.endswith('\\Z'):
+                rule = rule[2:-2]
+            self.logger.info('  %s %s: %d%s', option, rule, count, '' if count else ' (never matched)')
+
+    def filter_adobeID_user(self, umapi_info, umapi_user):
         id_type = self.get_identity_type_from_umapi_user(umapi_user)
         if id_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE:
-            self.adobeid_user_by_email[normalize_string(umapi_user['email'])] = umapi_user
+            umapi_info.adobeid_user_by_email[normalize_string(umapi_user['email'])] = umapi_user
 
-    def is_adobeID_email_exist(self, email):
-        return bool(self.adobeid_user_by_email.get(normalize_string(email)))
+    def is_adobeID_email_exist(self, email, umapi_info=None):
+        """
+        Whether an AdobeID with this email was read from the primary umapi or from the given umapi.  Each
+        umapi only records its own AdobeIDs, so secondaries synced in parallel don't see each other's.
+        :type umapi_info: UmapiTargetInfo
+        """
+        email = normalize_string(email)
+        if self.get_umapi_info(PRIMARY_UMAPI_NAME).adobeid_user_by_email.get(email):
+            return True
+        return umapi_info is not None and bool(umapi_info.adobeid_user_by_email.get(email))
 
     @staticmethod
     def normalize_groups(group_names):
@@ -1032,12 +1368,9 @@ class RuleProcessor(object):
         :type group_names: iterator(str)
         :rtype set(str)
         """
-        result = set()
-        if group_names is not None:
-            for group_name in group_names:
-                normalized_group_name = normalize_string(group_name)
-                result.add(normalized_group_name)
-        return result
+        if group_names is None:
+            return set()
+        return set(map(normalize_shared_string, group_names))
 
 
     def get_user_attribute_difference(self, directory_user, umapi_user):
@@ -1075,20 +1408,20 @@ class RuleProcessor(object):
     def get_user_key(self, id_type, username, domain, email=None):
         """
         Construct the user key for a directory or adobe user.
-        The user key is the stringification of the tuple (id_type, username, domain)
+        The user key is the tuple (id_type, username, domain)
         but the domain part is left empty if the username is an email address.
         If the parameters are invalid, None is returned.
         :param username: (required) username of the user, can be his email
         :param domain: (optional) domain of the user
         :param email: (optional) email of the user
         :param id_type: (required) id_type of the user
-        :return: string "id_type,username,domain" (or None)
-        :rtype: str
+        :return: the key, which prints as "id_type,username,domain" (or None)
+        :rtype: UserKey
         """
         id_type = user_sync.identity_type.parse_identity_type(id_type)
         email = normalize_string(email) if email else None
         username = normalize_string(username) or email
-        domain = normalize_string(domain)
+        domain = normalize_shared_string(domain)
 
         if not id_type:
             return None
@@ -1098,7 +1431,7 @@ class RuleProcessor(object):
             domain = ""
         elif not domain:
             return None
-        return six.text_type(id_type) + u',' + six.text_type(username) + u',' + six.text_type(domain)
+        return self.user_keys.get_key(six.text_type(id_type), six.text_type(username), six.text_type(domain))
 
     def parse_user_key(self, user_key):
         """
@@ -1106,7 +1439,7 @@ class RuleProcessor(object):
         The domain part is empty except if the username is not an email address.
         :rtype: tuple
         """
-        return user_key.split(',')
+        return self.user_keys.parse_key(user_key)
 
     def get_username_from_user_key(self, user_key):
         return self.parse_user_key(user_key)[1]
@@ -1217,20 +1550,32 @@ class UmapiConnectors(object):
     def get_secondary_connectors(self):
         return self.secondary_connectors
 
+    def start_journals(self):
+        for connector in self.connectors:
+            connector.start_journal()
+
     def execute_actions(self):
         while True:
             had_work = False
             for connector in self.connectors:
-                action_manager = connector.get_action_manager()
-                if action_manager.has_work():
-                    action_manager.flush()
+                if connector.has_work():
+                    connector.flush()
                     had_work = True
             if not had_work:
                 break
+        for connector in self.connectors:
+            connector.save_snapshot()
 
 
 class AdobeGroup(object):
+    """
+    A group in a umapi.  Groups are equal (and hash the same) when they have the same name in the same umapi.
+    The groups created from the configuration are registered by name, and each group gets an integer ID.
+    """
     index_map = {}
+    # the registered groups by qualified name, including any other spellings they have been looked up by
+    qualified_index_map = {}
+    groups_by_id = []
 
     def __init__(self, group_name, umapi_name, index=True):
         """
@@ -1239,26 +1584,29 @@ class AdobeGroup(object):
         """
         self.group_name = group_name
         self.umapi_name = umapi_name
+        self.qualified_name = self._make_qualified_name(group_name, umapi_name)
+        self.group_id = len(AdobeGroup.groups_by_id)
+        AdobeGroup.groups_by_id.append(self)
         if index:
             AdobeGroup.index_map[(group_name, umapi_name)] = self
+            AdobeGroup.qualified_index_map[self.qualified_name] = self
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, AdobeGroup):
+            return NotImplemented
+        return self.group_name == other.group_name and self.umapi_name == other.umapi_name
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(frozenset(self.__dict__))
+        return hash((self.group_name, self.umapi_name))
 
     def __str__(self):
-        return str(self.__dict__)
+        return str({'group_name': self.group_name, 'umapi_name': self.umapi_name})
 
     def get_qualified_name(self):
-        prefix = ""
-        if self.umapi_name is not None and self.umapi_name != PRIMARY_UMAPI_NAME:
-            prefix = self.umapi_name + GROUP_NAME_DELIMITER
-        return prefix + self.group_name
+        return self.qualified_name
 
     def get_umapi_name(self):
         return self.umapi_name
@@ -1266,6 +1614,15 @@ class AdobeGroup(object):
     def get_group_name(self):
         return self.group_name
 
+    def get_group_id(self):
+        return self.group_id
+
+    @staticmethod
+    def _make_qualified_name(group_name, umapi_name):
+        if umapi_name is not None and umapi_name != PRIMARY_UMAPI_NAME:
+            return umapi_name + GROUP_NAME_DELIMITER + group_name
+        return group_name
+
     @staticmethod
     def _parse(qualified_name):
         """
@@ -1281,15 +1638,28 @@ class AdobeGroup(object):
 
     @classmethod
     def lookup(cls, qualified_name):
-        return cls.index_map.get(cls._parse(qualified_name))
+        group = cls.qualified_index_map.get(qualified_name)
+        if group is None:
+            group = cls.index_map.get(cls._parse(qualified_name))
+            if group is not None:
+                cls.qualified_index_map[qualified_name] = group
+        return group
+
+    @classmethod
+    def lookup_id(cls, group_id):
+        """
+        :type group_id: int
+        :rtype: AdobeGroup
+        """
+        return cls.groups_by_id[group_id]
 
     @classmethod
     def create(cls, qualified_name, index=True):
-        group_name, umapi_name = cls._parse(qualified_name)
-        existing = cls.index_map.get((group_name, umapi_name))
+        existing = cls.lookup(qualified_name)
         if existing:
             return existing
-        elif len(group_name) > 0:
+        group_name, umapi_name = cls._parse(qualified_name)
+        if len(group_name) > 0:
             return cls(group_name, umapi_name, index)
         else:
             return None
@@ -1298,6 +1668,109 @@ class AdobeGroup(object):
     def iter_groups(cls):
         return six.itervalues(cls.index_map)
 
+    @classmethod
+    def clear(cls):
+        """
+        Forget all the groups created so far.
+        """
+        cls.index_map.clear()
+        cls.qualified_index_map.clear()
+        del cls.groups_by_id[:]
+
+
+class AdditionalGroupMatcher(object):
+    """
+    Matches member groups against the additional_groups rules.  Each rule is applied to every member group it
+    matches, so the rules are still tried one by one, but only for member groups that a single combined
+    pattern of all the rules says match at least one of them.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: the additional_groups rules, each with a compiled 'source' and an AdobeGroup 'target'
+        :type rules: list(dict)
+        """
+        self.rules = rules
+        self.combined_source = combine_patterns([rule['source'] for rule in rules])
+
+    def iter_targets(self):
+        for rule in self.rules:
+            yield rule['target']
+
+    def match(self, member_group):
+        """
+        :type member_group: str
+        :return: the target group and renamed group of each rule that matches the member group
+        :rtype: list(tuple(AdobeGroup, str))
+        """
+        if self.combined_source is not None and not self.combined_source.match(member_group):
+            return []
+        matches = []
+        for rule in self.rules:
+            source = rule['source']
+            target = rule['target']
+            if not source.match(member_group):
+                continue
+            try:
+                rename_group = source.sub(target.get_group_name(), member_group)
+            except Exception as e:
+                raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
+            matches.append((target, rename_group))
+        return matches
+
+
+class UserKey(tuple):
+    """
+    A user key: the tuple (identity_type, username, domain) of a user, with the domain left empty if the
+    username is an email address.  Its parts are read without splitting a string, and it prints as the
+    "id_type,username,domain" string that user keys used to be, so logs and messages are unchanged.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return u','.join(self)
+
+    def __repr__(self):
+        return repr(str(self))
+
+
+class UserKeyRegistry(object):
+    """
+    The user keys made in a run.  Each distinct key is made once, so the directory users, the primary umapi
+    and every secondary umapi share one UserKey object for a user, and the registry holds one dict entry
+    for it.
+    """
+
+    def __init__(self):
+        self.keys = {}
+
+    def get_key(self, id_type, username, domain):
+        """
+        :return: the key for these (normalized) parts
+        :rtype: UserKey
+        """
+        parts = (id_type, username, domain)
+        user_key = self.keys.get(parts)
+        if user_key is None:
+            user_key = UserKey(parts)
+            # secondary umapis are read in parallel, so another thread may register the same key first
+            user_key = self.keys.setdefault(user_key, user_key)
+        return user_key
+
+    @staticmethod
+    def parse_key(user_key):
+        """
+        :return: the identity type, username and domain of a key
+        :rtype: tuple
+        """
+        if isinstance(user_key, tuple):
+            return user_key
+        # a key written as a string, e.g. by an extension
+        return tuple(user_key.split(','))
+
+    def __len__(self):
+        return len(self.keys)
+
 
 class UmapiTargetInfo(object):
     def __init__(self, name):
@@ -1308,11 +1781,18 @@ class UmapiTargetInfo(object):
         self.mapped_groups = set()
         self.non_normalize_mapped_groups = set()
         self.desired_groups_by_user_key = {}
+        # users with the same desired groups share one frozenset of them
+        self.desired_group_sets = {}
         self.umapi_user_by_user_key = {}
         self.umapi_users_loaded = False
         self.stray_by_user_key = {}
         self.groups_added_by_user_key = {}
         self.groups_removed_by_user_key = {}
+        # the AdobeID users read from this umapi, by normalized email
+        self.adobeid_user_by_email = {}
+        # map of username to email address for users in this umapi that have an email-type username that
+        # differs from the user's email address
+        self.email_override = {}  # type: dict[str, str]
 
         # keep track of auto-mapped additional groups for conflict tracking.
         # if feature is disabled, this dict will be empty
@@ -1325,12 +1805,12 @@ class UmapiTargetInfo(object):
         """
         :type group: str
         """
-        normalized_group_name = normalize_string(group)
+        normalized_group_name = normalize_shared_string(group)
         self.mapped_groups.add(normalized_group_name)
         self.non_normalize_mapped_groups.add(group)
 
     def add_additional_group(self, rename_group, member_group):
-        normalized_rename_group = normalize_string(rename_group)
+        normalized_rename_group = normalize_shared_string(rename_group)
         if member_group not in self.additional_group_map[normalized_rename_group]:
             self.additional_group_map[normalized_rename_group].append(member_group)
 
@@ -1358,12 +1838,28 @@ class UmapiTargetInfo(object):
         :type user_key: str
         :type group: Optional(str)
         """
-        desired_groups = self.get_desired_groups(user_key)
-        if desired_groups is None:
-            self.desired_groups_by_user_key[user_key] = desired_groups = set()
-        if group is not None:
-            normalized_group_name = normalize_string(group)
-            desired_groups.add(normalized_group_name)
+        self.add_desired_groups_for(user_key, () if group is None else (normalize_shared_string(group),))
+
+    def add_desired_groups_for(self, user_key, normalized_groups):
+        """
+        :type user_key: str
+        :type normalized_groups: frozenset(str) or tuple(str)
+        """
+        desired_groups = self.desired_groups_by_user_key.get(user_key)
+        if desired_groups:
+            if desired_groups.issuperset(normalized_groups):
+                return
+            normalized_groups = desired_groups.union(normalized_groups)
+        self.desired_groups_by_user_key[user_key] = self.intern_desired_groups(normalized_groups)
+
+    def intern_desired_groups(self, groups):
+        """
+        :type groups: iterable(str)
+        :return: the shared frozenset of these groups
+        :rtype: frozenset(str)
+        """
+        groups = frozenset(groups)
+        return self.desired_group_sets.setdefault(groups, groups)
 
     def add_umapi_user(self, user_key, user):
         """